@@ -0,0 +1,30 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tucupi_core import FSTree, RepFile, HashPool, make_fstree, walk_tree
+
+
+def write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+@pytest.fixture
+def scan():
+    """Scan and hash a folder, as the graphical interface does. Return its
+    FSTree and RepFile."""
+    def scan(root):
+        tree, sizes, same_size = FSTree(), {}, set()
+        make_fstree(walk_tree(os.fsencode(os.fspath(root))), tree, sizes, same_size, {})
+        rep_files = RepFile()
+        todo = [fn for s in sorted(same_size, reverse = True) for fn in sizes[s]]
+        pool = HashPool(todo, rep_files, 2, compare_max = 0)
+        pool.start()
+        pool.join()
+        tree.compute_aggr()
+        return tree, rep_files
+    return scan
@@ -0,0 +1,91 @@
+"""Deduper, with each method."""
+import os
+import stat
+
+import pytest
+
+from conftest import write
+from tucupi_core import Deduper, reflink, _NO_REFLINK
+
+#Not valid UTF-8
+NAME = b'caf\xe9'
+
+
+def reflink_supported(root):
+    src, dst = os.path.join(root, b'.probe1'), os.path.join(root, b'.probe2')
+    write(src, b'x')
+    write(dst, b'x')
+    try:
+        reflink(src, dst)
+        return True
+    except OSError as err:
+        if err.errno not in _NO_REFLINK:
+            raise
+        return False
+    finally:
+        os.unlink(src)
+        os.unlink(dst)
+
+
+def make_tree(root):
+    """A kept copy and two duplicates of it, one read-only and one with
+    a name that is not UTF-8, and a duplicate with another hard link."""
+    for d in (b'keep', b'dup'):
+        os.mkdir(os.path.join(root, d))
+    data = b'data' * 1000
+    write(os.path.join(root, b'keep', b'f'), data)
+    write(os.path.join(root, b'dup', NAME), data)
+    write(os.path.join(root, b'dup', b'ro'), data)
+    os.chmod(os.path.join(root, b'dup', b'ro'), 0o444)
+    #A file left by an interrupted run
+    write(os.path.join(root, b'dup', b'.ro.tucupi'), b'')
+    other = b'other' * 1000
+    write(os.path.join(root, b'keep', b'g'), other)
+    write(os.path.join(root, b'dup', b'g'), other)
+    os.link(os.path.join(root, b'dup', b'g'), os.path.join(root, b'g_link'))
+
+
+@pytest.mark.parametrize('method', ['auto', 'hardlink', 'reflink'])
+def test_dedupe(tmp_path, scan, method):
+    root = os.fsencode(str(tmp_path / 'tree'))
+    os.mkdir(root)
+    make_tree(root)
+    supported = reflink_supported(root)
+    tree, rep_files = scan(root)
+    kept = tree.get_leaf(os.path.join(root, b'keep', b'f'))
+    dups = [tree.get_leaf(os.path.join(root, b'dup', name)) for name in (NAME, b'ro')]
+    linked = tree.get_leaf(os.path.join(root, b'dup', b'g'))
+    linked = linked.link_of or linked
+    for fn in dups + [linked]:
+        assert rep_files.toggle_mark(fn)
+    old = {fn.fpath: os.lstat(fn.fpath) for fn in dups}
+    deduper = Deduper(dups + [linked], rep_files, tree, str(tmp_path / 'journal'), 2, method = method)
+    deduper.start()
+    deduper.join()
+    #Its other link would keep the old data
+    assert deduper.counts['skipped'] == 1
+    if method == 'reflink' and not supported:
+        assert deduper.counts['failed'] == 2
+        for fn in dups:
+            assert os.lstat(fn.fpath).st_ino == old[fn.fpath].st_ino
+        return
+    event = 'reflinked' if method == 'reflink' or (method == 'auto' and supported) else 'hardlinked'
+    assert deduper.counts[event] == 2
+    assert deduper.freed == 2 * kept.size
+    kst = os.stat(kept.fpath)
+    for fn in dups:
+        st = os.lstat(fn.fpath)
+        with open(fn.fpath, 'rb') as f:
+            assert f.read() == b'data' * 1000
+        assert not fn.marked
+        if event == 'hardlinked':
+            assert (st.st_dev, st.st_ino) == (kst.st_dev, kst.st_ino)
+            assert fn.link_of is kept and fn.rep is None
+        else:
+            assert st.st_ino == fn.ino != kst.st_ino
+            assert stat.S_IMODE(st.st_mode) == stat.S_IMODE(old[fn.fpath].st_mode)
+            assert st.st_mtime_ns == old[fn.fpath].st_mtime_ns
+    assert os.path.exists(os.path.join(root, b'dup', b'.ro.tucupi'))
+    assert not any(name.endswith(b'.tucupi') and name != b'.ro.tucupi'
+                   for name in os.listdir(os.path.join(root, b'dup')))
+    assert rep_files.marked_files() == [linked]
@@ -0,0 +1,136 @@
+"""Deleter and the journal it keeps."""
+import json
+import os
+
+import pytest
+
+from conftest import write
+from tucupi_core import Deleter, Deduper, Journal
+
+
+def make_tree(root):
+    """Three groups of copies. The first file of each is to be deleted."""
+    for k in range(3):
+        data = bytes([k]) * (1000 + k)
+        for name in ('a', 'b', 'c')[:k + 2]:
+            d = root / name
+            d.mkdir(exist_ok = True)
+            write(str(d / 'f{}'.format(k)), data)
+
+
+def mark_a(rep_files):
+    fns = [fn for key in rep_files.repeated for fn in rep_files.size_md5[key] if b'/a/' in fn.fpath]
+    for fn in fns:
+        assert rep_files.toggle_mark(fn)
+    return fns
+
+
+def run(action):
+    action.start()
+    action.join()
+    return action
+
+
+def test_delete(tmp_path, scan):
+    root = tmp_path / 'tree'
+    root.mkdir()
+    make_tree(root)
+    tree, rep_files = scan(root)
+    fns = mark_a(rep_files)
+    paths = [fn.fpath for fn in fns]
+    deleter = run(Deleter(fns, rep_files, tree, str(tmp_path / 'journal'), 2, verify = True, batch = 2))
+    assert deleter.counts == {'deleted': 3}
+    assert deleter.freed == sum(1000 + k for k in range(3))
+    assert not any(os.path.exists(p) for p in paths)
+    assert rep_files.marked_files() == []
+    for p in paths:
+        with pytest.raises(KeyError):
+            tree.get_leaf(p)
+    #A group left with one file is no longer repeated
+    assert len(rep_files.repeated) == 2
+    assert tree.aggr_attrib[0] == 5
+    assert Journal(str(tmp_path / 'journal')).pending() == []
+
+
+def test_delete_checks(tmp_path, scan):
+    root = tmp_path / 'tree'
+    root.mkdir()
+    make_tree(root)
+    tree, rep_files = scan(root)
+    fns = mark_a(rep_files)
+    by_name = {os.path.basename(fn.fpath): fn for fn in fns}
+    #Changed after the scan
+    write(str(root / 'a' / 'f1'), b'x' * 5)
+    #Its only kept copy is gone
+    os.unlink(str(root / 'b' / 'f0'))
+    #Same size and time, other content, only seen when verifying
+    st = os.stat(str(root / 'a' / 'f2'))
+    write(str(root / 'a' / 'f2'), b'y' * 1002)
+    os.utime(str(root / 'a' / 'f2'), ns = (st.st_atime_ns, st.st_mtime_ns))
+    deleter = run(Deleter(fns, rep_files, tree, str(tmp_path / 'journal'), 1, verify = True))
+    assert deleter.counts == {'skipped': 3}
+    assert all(os.path.exists(fn.fpath) for fn in fns)
+    reasons = {}
+    with open(str(tmp_path / 'journal')) as f:
+        for line in f:
+            rec = json.loads(line)
+            if rec['event'] == 'skipped':
+                reasons[os.path.basename(rec['path'])] = rec['reason']
+    assert reasons == {'f0': 'no kept copy left', 'f1': 'changed', 'f2': 'content differs'}
+    assert set(rep_files.marked_files()) == set(by_name.values())
+
+
+def test_resume(tmp_path, scan):
+    root = tmp_path / 'tree'
+    root.mkdir()
+    make_tree(root)
+    tree, rep_files = scan(root)
+    fns = mark_a(rep_files)
+    journal = str(tmp_path / 'journal')
+    #Interrupted right after planning, with a torn outcome line
+    deleter = Deleter(fns, rep_files, tree, journal, 1)
+    deleter.journal.close()
+    with open(journal, 'a') as f:
+        f.write('{"event": "dele')
+    assert len(Journal(journal).pending()) == 3
+    #Resumed without the state, from the journal alone
+    deleter = run(Deleter([], None, None, journal, 2))
+    assert deleter.total == 3
+    assert deleter.counts == {'deleted': 3}
+    assert not any(os.path.exists(fn.fpath) for fn in fns)
+    assert Journal(journal).pending() == []
+    #Nothing left to do
+    deleter = run(Deleter([], None, None, journal, 2))
+    assert deleter.total == 0
+
+
+def test_resume_other_action(tmp_path, scan):
+    root = tmp_path / 'tree'
+    root.mkdir()
+    make_tree(root)
+    tree, rep_files = scan(root)
+    fns = mark_a(rep_files)
+    journal = str(tmp_path / 'journal')
+    Deduper(fns, rep_files, tree, journal, 1).journal.close()
+    with pytest.raises(ValueError):
+        Deleter([], None, None, journal, 1)
+    assert all(os.path.exists(fn.fpath) for fn in fns)
+
+
+def test_delete_hard_link(tmp_path, scan):
+    root = tmp_path / 'tree'
+    root.mkdir()
+    make_tree(root)
+    os.link(str(root / 'a' / 'f0'), str(root / 'c' / 'link'))
+    tree, rep_files = scan(root)
+    fn = tree.get_leaf(os.fsencode(str(root / 'a' / 'f0')))
+    link = tree.get_leaf(os.fsencode(str(root / 'c' / 'link')))
+    primary = fn if fn.link_of is None else link
+    assert rep_files.toggle_mark(primary)
+    deleter = run(Deleter([primary], rep_files, tree, str(tmp_path / 'journal'), 1))
+    assert deleter.counts == {'deleted': 1}
+    #The data is still there, so nothing was freed
+    assert deleter.freed == 0
+    other = link if primary is fn else fn
+    assert other.link_of is None and other.rep is rep_files
+    assert other in rep_files.size_md5[(other.size, other.md5)]
@@ -0,0 +1,194 @@
+"""Grouping of HashPool, also when it is stopped and started again."""
+import hashlib
+import os
+import random
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from tucupi_core import (FSTree, RepFile, HashPool, HashCache, HASHERS, make_fstree, walk_tree, is_compared,
+                         register_hasher, read_log)
+
+#Number of identical files of each content, by size. Large sizes go
+#through the partial stage, small buckets are compared
+LAYOUT = {700000: [30, 2, 1], 300000: [2, 2], 5000: [3, 1, 1], 4000: [2], 3000: [4, 3]}
+
+
+def make_files(root):
+    """Write the files of LAYOUT. Return the expected groups, as sets of paths."""
+    groups = set()
+    n = 0
+    for size, counts in LAYOUT.items():
+        for c, count in enumerate(counts):
+            data = bytes([c + 1]) * (size - 1) + bytes([c])
+            paths = []
+            for k in range(count):
+                path = os.path.join(root, 'f{}'.format(n)).encode()
+                n += 1
+                with open(path, 'wb') as f:
+                    f.write(data)
+                paths.append(path)
+            if count > 1:
+                groups.add(frozenset(paths))
+    return groups
+
+
+def scan(root):
+    sizes, same_size = {}, set()
+    make_fstree(walk_tree(root.encode()), FSTree(), sizes, same_size, {})
+    return [fn for s in sorted(same_size, reverse = True) for fn in sizes[s]]
+
+
+def found_groups(rep_files):
+    return set(frozenset(fn.fpath for fn in rep_files.size_md5[key]) for key in rep_files.repeated)
+
+
+def hash_all(todo, rep_files, partials, stop_after = None, compare_max = 3):
+    """Hash the files like the graphical interface does, stopping the pool
+    after each of the delays of stop_after and starting it again with the
+    files left."""
+    delays = list(stop_after or [])
+    while todo:
+        pool = HashPool(todo, rep_files, 2, partials, compare_max = compare_max)
+        pool.start()
+        if delays:
+            time.sleep(delays.pop(0))
+            todo = pool.stop()
+        else:
+            todo = []
+        pool.join()
+
+
+def test_groups(tmp_path):
+    expected = make_files(str(tmp_path))
+    rep_files = RepFile()
+    hash_all(scan(str(tmp_path)), rep_files, {})
+    assert found_groups(rep_files) == expected
+
+
+def test_leftovers_of_hashed_size_are_hashed(tmp_path):
+    expected = make_files(str(tmp_path))
+    todo = scan(str(tmp_path))
+    #As if the pool was stopped with 3 files of a size left
+    big = [fn for fn in todo if fn.size == 700000]
+    rest = [fn for fn in todo if fn.size != 700000]
+    rep_files, partials = RepFile(), {}
+    hash_all(big[:-3], rep_files, partials)
+    hash_all(big[-3:] + rest, rep_files, partials)
+    assert found_groups(rep_files) == expected
+    assert not any(is_compared(fn) for key in rep_files.repeated for fn in rep_files.size_md5[key]
+                   if fn.size == 700000)
+
+
+def test_stop_and_resume(tmp_path):
+    expected = make_files(str(tmp_path))
+    rnd = random.Random(7)
+    for trial in range(20):
+        rep_files = RepFile()
+        hash_all(scan(str(tmp_path)), rep_files, {}, [rnd.uniform(0, 0.01) for k in range(4)])
+        assert found_groups(rep_files) == expected, trial
+
+
+def test_compared_files_rejoin_hashed_group(tmp_path):
+    make_files(str(tmp_path))
+    small = [fn for fn in scan(str(tmp_path)) if fn.size == 4000]
+    rep_files = RepFile()
+    hash_all(small, rep_files, {})
+    assert all(is_compared(fn) for fn in small)
+    #A new copy hashed without comparing brings the compared files back
+    with open(os.path.join(str(tmp_path), 'new'), 'wb') as f:
+        f.write(bytes([1]) * 3999 + bytes([0]))
+    new = [fn for fn in scan(str(tmp_path)) if fn.fpath.endswith(b'/new')]
+    hash_all(new, rep_files, {}, compare_max = 0)
+    assert found_groups(rep_files) == {frozenset([fn.fpath for fn in small] + [new[0].fpath])}
+    assert not any(is_compared(fn) for fn in small)
+
+
+def test_marks_survive_regrouping(tmp_path):
+    make_files(str(tmp_path))
+    small = [fn for fn in scan(str(tmp_path)) if fn.size == 3000]
+    rep_files = RepFile()
+    hash_all(small, rep_files, {}, compare_max = 7)
+    assert all(is_compared(fn) for fn in small)
+    marked = []
+    for key in rep_files.repeated:
+        marked.extend(rep_files.size_md5[key][:2])
+    for fn in marked:
+        assert rep_files.toggle_mark(fn)
+    #A new copy hashed without comparing brings the compared files back
+    with open(os.path.join(str(tmp_path), 'new'), 'wb') as f:
+        f.write(bytes([1]) * 2999 + bytes([0]))
+    new = [fn for fn in scan(str(tmp_path)) if fn.fpath.endswith(b'/new')]
+    hash_all(new, rep_files, {}, compare_max = 0)
+    assert not any(is_compared(fn) for fn in small)
+    assert set(rep_files.marked_files()) == set(marked)
+    for key in rep_files.repeated:
+        files = rep_files.size_md5[key]
+        assert rep_files.counts[key][0] == sum(not fn.marked for fn in files) > 0
+
+
+class BrokenCache(object):
+    def lookup(self, fn, algorithm):
+        raise sqlite3.OperationalError('database is locked')
+
+    def put_many(self, fns, algorithm):
+        raise sqlite3.OperationalError('database is locked')
+
+
+def test_failures_do_not_hang(tmp_path):
+    make_files(str(tmp_path))
+    todo = scan(str(tmp_path))
+    pool = HashPool(todo, RepFile(), 2, cache = BrokenCache(), compare_max = 0)
+    pool.start()
+    thr = threading.Thread(target = pool.join)
+    thr.start()
+    thr.join(30)
+    assert not thr.is_alive()
+    assert pool.fraction() == 1.0
+    assert all(fn.error == 'database is locked' for fn in todo)
+
+
+def test_cache_errors_turn_it_off(tmp_path):
+    root = tmp_path / 'files'
+    root.mkdir()
+    expected = make_files(str(root))
+    cache = HashCache(str(tmp_path / 'cache.sqlite'))
+    db = sqlite3.connect(str(tmp_path / 'cache.sqlite'))
+    db.execute('DROP TABLE hashes')
+    db.commit()
+    db.close()
+    rep_files = RepFile()
+    todo = scan(str(root))
+    pool = HashPool(todo, rep_files, 2, cache = cache, compare_max = 0)
+    pool.start()
+    pool.join()
+    assert cache.error is not None
+    assert not any(fn.error for fn in todo)
+    assert found_groups(rep_files) == expected
+    cache.close()
+
+
+def test_algorithm_names(tmp_path):
+    for name in ('3sum', 'sha/1', 'a b', 'size', ''):
+        with pytest.raises(ValueError):
+            register_hasher(name, hashlib.sha1)
+    register_hasher('sha3-256', hashlib.sha3_256)
+    try:
+        root = tmp_path / 'files'
+        root.mkdir()
+        make_files(str(root))
+        rep_files = RepFile('sha3-256')
+        hash_all(scan(str(root)), rep_files, {}, compare_max = 0)
+        for key in rep_files.repeated:
+            rep_files.toggle_mark(rep_files.size_md5[key][0])
+        rep_files.to_xmlfile(str(tmp_path / 'log.xml'))
+        recs = list(read_log(str(tmp_path / 'log.xml')))
+        assert len(recs) == len(rep_files.repeated)
+        for rec in recs:
+            data = open(rec['path'], 'rb').read()
+            assert rec['algorithm'] == 'sha3-256'
+            assert rec['digest'] == hashlib.sha3_256(data).hexdigest()
+    finally:
+        del HASHERS['sha3-256']
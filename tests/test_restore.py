@@ -0,0 +1,113 @@
+"""Restorer, on files deleted by Deleter."""
+import json
+import os
+
+from conftest import write
+from tucupi_core import Deleter, Restorer
+
+#Not valid UTF-8
+NAME = b'caf\xe9'
+
+
+def delete_copies(tmp_path, scan):
+    """Delete the copies in dup of a tree. Return the log and the data of
+    the deleted files by path."""
+    root = os.fsencode(str(tmp_path / 'tree'))
+    for d in (b'keep', b'dup'):
+        os.makedirs(os.path.join(root, d))
+    data = {}
+    for k, name in enumerate((NAME, b'b', b'c', b'd')):
+        content = bytes([k]) * (2000 + k)
+        write(os.path.join(root, b'keep', name), content)
+        write(os.path.join(root, b'dup', name), content)
+        data[os.path.join(root, b'dup', name)] = content
+    tree, rep_files = scan(root)
+    fns = [tree.get_leaf(path) for path in data]
+    for fn in fns:
+        assert rep_files.toggle_mark(fn)
+    log = str(tmp_path / 'log.xml')
+    rep_files.to_xmlfile(log)
+    deleter = Deleter(fns, rep_files, tree, log + '.journal', 2)
+    deleter.start()
+    deleter.join()
+    assert deleter.counts == {'deleted': len(fns)}
+    return log, data
+
+
+def run(restorer):
+    restorer.start()
+    restorer.join()
+    return restorer
+
+
+def reasons(journal):
+    out = {}
+    with open(journal) as f:
+        for line in f:
+            rec = json.loads(line)
+            if rec['event'] == 'skipped':
+                out[os.fsencode(rec['path'])] = rec['reason']
+    return out
+
+
+def test_delete_and_restore(tmp_path, scan):
+    log, data = delete_copies(tmp_path, scan)
+    restorer = run(Restorer(log, log + '.restore', 2, batch = 1))
+    assert restorer.error is None and restorer.planned
+    assert restorer.counts == {'restored': len(data)}
+    assert restorer.total == len(data)
+    assert restorer.total_bytes == sum(len(v) for v in data.values())
+    for path, content in data.items():
+        with open(path, 'rb') as f:
+            assert f.read() == content
+    assert not any(name.endswith(b'.tucupi') for name in os.listdir(os.path.dirname(path)))
+    #Files already restored are not planned again
+    assert run(Restorer(log, log + '.restore', 2)).total == 0
+
+
+def test_restore_checks(tmp_path, scan):
+    log, data = delete_copies(tmp_path, scan)
+    taken, corrupt = list(data)[:2]
+    write(taken, b'something else')
+    kept = corrupt.replace(b'/dup/', b'/keep/')
+    st = os.stat(kept)
+    write(kept, b'x' * st.st_size)
+    restorer = run(Restorer(log, log + '.restore', 2))
+    assert restorer.counts == {'restored': len(data) - 2, 'skipped': 2}
+    assert reasons(log + '.restore') == {taken: 'exists', corrupt: 'no valid kept copy'}
+    assert not os.path.exists(corrupt)
+    #Without verify only sizes are checked
+    restorer = run(Restorer(log, log + '.restore', 2, verify = False))
+    assert restorer.counts == {'restored': 1, 'skipped': 1}
+
+
+def test_resume(tmp_path, scan):
+    log, data = delete_copies(tmp_path, scan)
+    #Interrupted after journaling the plan of two batches
+    first = Restorer(log, log + '.restore', 1, batch = 1)
+    assert first._plan_batch() and first._plan_batch()
+    first.journal.close()
+    assert len(first.journal.pending()) == 2
+    second = run(Restorer(log, log + '.restore', 2, batch = 1))
+    assert second.counts == {'restored': len(data)}
+    assert second.total == len(data)
+    assert all(os.path.exists(path) for path in data)
+
+
+def test_stop(tmp_path, scan):
+    log, data = delete_copies(tmp_path, scan)
+    restorer = Restorer(log, log + '.restore', 1, batch = 1)
+    restorer.stop()
+    run(restorer)
+    assert restorer.planned and restorer.total == 0
+    assert not any(os.path.exists(path) for path in data)
+
+
+def test_bad_log(tmp_path):
+    log = str(tmp_path / 'log.xml')
+    with open(log, 'w') as f:
+        f.write('<data><file')
+    restorer = run(Restorer(log, log + '.restore', 2))
+    assert restorer.error is not None and restorer.planned
+    restorer = run(Restorer(str(tmp_path / 'missing.xml'), log + '.restore', 2))
+    assert isinstance(restorer.error, FileNotFoundError)
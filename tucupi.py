@@ -21,40 +21,360 @@ import threading
 
 from gi.repository import Gtk,GObject,GLib,GdkPixbuf
 
-import sys
-import subprocess as sb
-import numpy as np
+import os
+import sqlite3
+import time
 
-import math
-import pickle
+from tucupi_core import (human_size, Finder, FSTree, RepFile, HashPool, HashCache,
+                         needs_partial, default_cache_path, save_state, restore_state,
+                         read_state_count, WALK_WORKERS, HASH_WORKERS, metrics,
+                         HASHERS, DEFAULT_ALGORITHM, IO_POLICIES, IO_POLICY,
+                         HASH_ORDERS, HASH_ORDER, SortedKeys, Deleter, Deduper, DELETE_WORKERS,
+                         DEDUPE_METHODS)
 
-from xml.dom.minidom import getDOMImplementation
-impl = getDOMImplementation()
 
 
 
-
-def human_size(s,precision = 2):
-    """Return a string representing the size in the smallest binary prefix."""
-    s = int(s)
-    negative = False
-    if s < 0: negative = True
-    s = abs(s)
-    if s == 0:
-        return '0B'
-    pre_val = math.floor(math.log(s)/math.log(1024))
-    bin_prefix = ['', 'Ki', 'Mi', 'Gi', 'Ti', 'Pi', 'Ei', 'Zi', 'Yi']
-    pre_val = min(pre_val, 8)
-    if pre_val > 0:
-        return '{0:.{prec}f}{1}B'.format(s/(1024**pre_val),bin_prefix[pre_val], prec = precision)
-    else:
-        return '{0}B'.format(s)
-
 def col_human(tree_column, cell, tree_model, titer, col):
     size = tree_model[titer][col]
     cell.set_property('text',human_size(size))
 
 
+class RepFilesModel(GObject.Object, Gtk.TreeModel):
+    """Tree model of the groups of repeated files, for the left panel:
+    one row per group that passes the filters of RepFile, largest first,
+    and a child row per file of the group. Values are read from the
+    groups and file nodes when the view asks for them.
+
+    The keys of the rows and the files of each group, as the view knows
+    them, are kept apart, as the hashing thread changes RepFile at any
+    time; rows are resolved against them. sync brings them up to date
+    with the groups RepFile reports as changed, emitting the row signals.
+    Columns: digest or file name, size, processed or marked, and rank of
+    the group or file."""
+    column_types = (GObject.TYPE_STRING, GObject.TYPE_INT64, GObject.TYPE_BOOLEAN, GObject.TYPE_INT)
+
+    def __init__(self, rep_files = None):
+        GObject.Object.__init__(self)
+        self.rep_files = rep_files
+        self.keys = SortedKeys()
+        self.files = {}
+        if rep_files is not None:
+            with rep_files.lock:
+                #Later changes will be seen by sync
+                rep_files.take_changes()
+                rep_files.update_filter()
+                self.keys = SortedKeys(rep_files.filtered)
+                self.files = {key: list(rep_files.size_md5[key]) for key in self.keys}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def sync(self):
+        """Apply the changes of RepFile since the last call."""
+        t0 = time.perf_counter()
+        rep_files = self.rep_files
+        rep_files.update_filter()
+        for key in rep_files.take_changes():
+            with rep_files.lock:
+                shown = key in rep_files.filtered
+                new = list(rep_files.size_md5.get(key, ()))
+            if key not in self.keys:
+                if shown:
+                    self.keys.add(key)
+                    self.files[key] = new
+                    pos = self.keys.index_desc(key)
+                    path = Gtk.TreePath((pos,))
+                    self.row_inserted(path, self._iter(pos))
+                    self.row_has_child_toggled(path, self._iter(pos))
+                continue
+            pos = self.keys.index_desc(key)
+            if not shown:
+                self.keys.discard(key)
+                del self.files[key]
+                self.row_deleted(Gtk.TreePath((pos,)))
+                continue
+            self.row_changed(Gtk.TreePath((pos,)), self._iter(pos))
+            files = self.files[key]
+            old = len(files)
+            for k in range(min(old, len(new))):
+                files[k] = new[k]
+                self.row_changed(Gtk.TreePath((pos, k)), self._iter(pos, k))
+            for k in range(old, len(new)):
+                files.append(new[k])
+                self.row_inserted(Gtk.TreePath((pos, k)), self._iter(pos, k))
+            for k in range(old - 1, len(new) - 1, -1):
+                files.pop()
+                self.row_deleted(Gtk.TreePath((pos, k)))
+        metrics.observe('update_model', time.perf_counter() - t0)
+
+    def _key(self, pos):
+        return self.keys.slice_desc(pos, pos + 1)[0]
+
+    def get_fn(self, tpath):
+        """File node of a child row, as the view knows it."""
+        pos, k = tpath.get_indices()
+        return self.files[self._key(pos)][k]
+
+    def path_of(self, fn):
+        """Tree path of the row of a file node, or None if not shown."""
+        key = (fn.size, fn.md5)
+        if key not in self.keys or fn not in self.files[key]:
+            return None
+        return Gtk.TreePath((self.keys.index_desc(key), self.files[key].index(fn)))
+
+    def _iter(self, pos, child = None):
+        titer = Gtk.TreeIter()
+        #Offset by one, as a null user_data reads back as None
+        titer.user_data = pos + 1
+        titer.user_data2 = 0 if child is None else child + 1
+        return titer
+
+    def do_get_flags(self):
+        return Gtk.TreeModelFlags(0)
+
+    def do_get_n_columns(self):
+        return len(self.column_types)
+
+    def do_get_column_type(self, column):
+        return self.column_types[column]
+
+    def do_get_iter(self, path):
+        indices = path.get_indices()
+        pos = indices[0]
+        if pos >= len(self.keys):
+            return (False, None)
+        if len(indices) == 1:
+            return (True, self._iter(pos))
+        if len(indices) == 2 and indices[1] < len(self.files[self._key(pos)]):
+            return (True, self._iter(pos, indices[1]))
+        return (False, None)
+
+    def do_get_path(self, titer):
+        if titer.user_data2 == 0:
+            return Gtk.TreePath((titer.user_data - 1,))
+        return Gtk.TreePath((titer.user_data - 1, titer.user_data2 - 1))
+
+    def do_get_value(self, titer, column):
+        pos = titer.user_data - 1
+        key = self._key(pos)
+        if titer.user_data2 == 0:
+            return (key[1].decode(errors='replace'), key[0],
+                    self.rep_files.is_processed(key), pos)[column]
+        k = titer.user_data2 - 1
+        fn = self.files[key][k]
+        return (fn.label(), fn.size, fn.marked, k)[column]
+
+    def do_iter_next(self, titer):
+        if titer.user_data2 == 0:
+            if titer.user_data < len(self.keys):
+                titer.user_data += 1
+                return True
+            return False
+        if titer.user_data2 < len(self.files[self._key(titer.user_data - 1)]):
+            titer.user_data2 += 1
+            return True
+        return False
+
+    def do_iter_previous(self, titer):
+        if titer.user_data2 == 0:
+            if titer.user_data > 1:
+                titer.user_data -= 1
+                return True
+            return False
+        if titer.user_data2 > 1:
+            titer.user_data2 -= 1
+            return True
+        return False
+
+    def do_iter_children(self, parent):
+        return self.do_iter_nth_child(parent, 0)
+
+    def do_iter_has_child(self, titer):
+        return titer.user_data2 == 0 and len(self.files[self._key(titer.user_data - 1)]) > 0
+
+    def do_iter_n_children(self, titer):
+        if titer is None:
+            return len(self.keys)
+        if titer.user_data2 == 0:
+            return len(self.files[self._key(titer.user_data - 1)])
+        return 0
+
+    def do_iter_nth_child(self, parent, n):
+        if parent is None:
+            if n < len(self.keys):
+                return (True, self._iter(n))
+        elif parent.user_data2 == 0:
+            pos = parent.user_data - 1
+            if n < len(self.files[self._key(pos)]):
+                return (True, self._iter(pos, n))
+        return (False, None)
+
+    def do_iter_parent(self, child):
+        if child.user_data2 == 0:
+            return (False, None)
+        return (True, self._iter(child.user_data - 1))
+
+
+#Sort column id of a TreeSortable that is not sorted
+UNSORTED_SORT_COLUMN_ID = -2
+
+class FSTreeModel(GObject.Object, Gtk.TreeModel, Gtk.TreeSortable):
+    """List model of the contents of a FSTree branch, for the right panel.
+    Rows are not stored: values are read from the branch and its nodes
+    when the view asks for them, which with a fixed height TreeView is
+    only for the rows on screen. Columns are those of the former
+    ListStore: icon name, name, the aggregates (see FSTree) and the
+    index of the element for FSTree.get_index.
+
+    Sorting reorders a list of indexes. The keys of a column are computed
+    the first time it is sorted, and again after refresh."""
+    column_types = (GObject.TYPE_STRING, GObject.TYPE_STRING, GObject.TYPE_INT, GObject.TYPE_INT64,
+                    GObject.TYPE_INT, GObject.TYPE_INT64, GObject.TYPE_INT, GObject.TYPE_INT,
+                    GObject.TYPE_INT, GObject.TYPE_INT)
+
+    def __init__(self, branch = None, sort_column = UNSORTED_SORT_COLUMN_ID,
+                 sort_order = Gtk.SortType.ASCENDING):
+        GObject.Object.__init__(self)
+        self.branch = branch
+        self.items = branch.list_children() if branch is not None else []
+        self.nbranches = len(branch.branches) if branch is not None else 0
+        self.order = list(range(len(self.items)))
+        self.keys = {}
+        self.sort_column = sort_column
+        self.sort_order = sort_order
+        if sort_column >= 0:
+            self._sort()
+
+    def is_current(self, branch):
+        """Whether the rows still match the contents of branch."""
+        return (branch is self.branch and len(branch.branches) == self.nbranches
+                and len(branch.branches) + len(branch.leaves) == len(self.items))
+
+    def refresh(self):
+        """Forget the sort keys, as values changed, and sort again."""
+        self.keys = {}
+        if self.sort_column >= 0:
+            self._reorder()
+
+    def _value(self, ind, column):
+        item = self.items[ind]
+        folder = ind < self.nbranches
+        if column == 0:
+            return 'folder' if folder else 'gtk-file'
+        if column == 1:
+            return (item.name() if folder else item._name).decode(errors='replace')
+        if column == 9:
+            return ind
+        if folder:
+            return int(item.aggr_attrib[column-2])
+        return item.aggr_values()[column-2]
+
+    def _sort(self):
+        if self.sort_column == 0:
+            #Folders first, in their original order
+            keys = range(len(self.items))
+        else:
+            keys = self.keys.get(self.sort_column)
+            if keys is None:
+                keys = [self._value(ind, self.sort_column) for ind in range(len(self.items))]
+                self.keys[self.sort_column] = keys
+        self.order.sort(key = keys.__getitem__, reverse = self.sort_order == Gtk.SortType.DESCENDING)
+
+    def _reorder(self):
+        """Sort and tell the views where rows moved."""
+        old = list(self.order)
+        if self.sort_column >= 0:
+            self._sort()
+        else:
+            self.order.sort()
+        if len(old) == 0:
+            return
+        where = [0]*len(old)
+        for pos, ind in enumerate(old):
+            where[ind] = pos
+        self.rows_reordered(Gtk.TreePath(), None, [where[ind] for ind in self.order])
+
+    def _iter(self, pos):
+        titer = Gtk.TreeIter()
+        #Offset by one, as a null user_data reads back as None
+        titer.user_data = pos + 1
+        return titer
+
+    def do_get_flags(self):
+        return Gtk.TreeModelFlags.LIST_ONLY
+
+    def do_get_n_columns(self):
+        return len(self.column_types)
+
+    def do_get_column_type(self, column):
+        return self.column_types[column]
+
+    def do_get_iter(self, path):
+        pos = path.get_indices()[0]
+        if pos < len(self.order):
+            return (True, self._iter(pos))
+        return (False, None)
+
+    def do_get_path(self, titer):
+        return Gtk.TreePath((titer.user_data - 1,))
+
+    def do_get_value(self, titer, column):
+        return self._value(self.order[titer.user_data - 1], column)
+
+    def do_iter_next(self, titer):
+        if titer.user_data < len(self.order):
+            titer.user_data += 1
+            return True
+        return False
+
+    def do_iter_previous(self, titer):
+        if titer.user_data > 1:
+            titer.user_data -= 1
+            return True
+        return False
+
+    def do_iter_children(self, parent):
+        if parent is None and len(self.order) > 0:
+            return (True, self._iter(0))
+        return (False, None)
+
+    def do_iter_has_child(self, titer):
+        return False
+
+    def do_iter_n_children(self, titer):
+        return len(self.order) if titer is None else 0
+
+    def do_iter_nth_child(self, parent, n):
+        if parent is None and n < len(self.order):
+            return (True, self._iter(n))
+        return (False, None)
+
+    def do_iter_parent(self, child):
+        return (False, None)
+
+    def do_get_sort_column_id(self):
+        return (self.sort_column >= 0, self.sort_column, self.sort_order)
+
+    def do_set_sort_column_id(self, sort_column, order):
+        if (sort_column, order) == (self.sort_column, self.sort_order):
+            return
+        self.sort_column = sort_column
+        self.sort_order = order
+        self.sort_column_changed()
+        self._reorder()
+
+    def do_set_sort_func(self, sort_column, sort_func, user_data = None):
+        #Columns are only sorted by their values
+        pass
+
+    def do_set_default_sort_func(self, sort_func, user_data = None):
+        pass
+
+    def do_has_default_sort_func(self):
+        return False
+
+
 
 class MySpinner(Gtk.Image):
     """Quick and dirty spinner widget to reduce CPU usage"""
@@ -103,613 +423,6 @@ class MySpinner(Gtk.Image):
 
 
 
-
-
-
-class Finder(threading.Thread):
-    def __init__(self,path):
-        threading.Thread.__init__(self)
-        self.result = None
-        self.path = path
-
-    def run(self):
-        try:
-            self.result = sb.check_output(['find', self.path, '-type', 'f','-printf', '%s %h/%f\\0'])
-        except sb.CalledProcessError as err:
-            print('Error in find!')
-            self.result = err.output
-
-
-
-class FNode(object):
-    """Class to hold file specific data and state."""
-    def __init__(self,fpath,size):
-        self.fpath = fpath
-        self.md5 = None
-        self.size = size
-        self.marked = False
-        self.kept = False
-        self.repeated = False
-
-    def get_state(self):
-        """Ruturns a tuple with the instance's state."""
-        return (self.fpath, self.md5, self.size, self.marked, self.kept, self.repeated)
-
-    def set_state(self, state):
-        """Set the instance's state. Does NOT verify invariants."""
-        self.fpath, self.md5, self.size, self.marked, self.kept, self.repeated = state
-
-    
-    def mark(self,rep_file):
-        """Mark itself to be deleted."""
-        if self.repeated and not self.kept and not self.marked:
-            rep_file.toggle_mark(self)
-            
-    def keep(self):
-        """Mark itself to be kept. It is unmarked for deletion and can not be marked."""
-        self.marked = False
-        self.kept = True
-        
-
-
-class RepFile(object):
-    """Class holding the list of repeated files. It decides if a file
-    is repeated, controls which files are marked for deletion, and 
-    set up data for the repeated files' TreeView."""
-    def __init__(self,pagesize=100):
-        self.lock = threading.Lock()
-        self.size_md5 = {}
-        self.repeated = set()
-        self.filtered = set()
-        self.filters = {'NotProcessed':None, 'NotProcessedKept':None}
-        self.ts_contents = []
-        self.pagesize = pagesize
-        self.page = 0
-        
-    def add_fn(self,fn):
-        """Add a file node to the list, decide if it is repeated, and 
-        update the list of repeated files."""
-        if fn.md5 is None:
-            raise ValueError('md5sum not present')
-        key = (fn.size,fn.md5)
-        
-        with self.lock:
-            if key not in self.size_md5:
-                self.size_md5[key] = [fn]
-            else:
-                fn.repeated = True
-                self.size_md5[key].append(fn)
-                self.repeated.add(key)
-                if len(self.size_md5[key]) == 2:
-                    #If this is the second file added, the fist one with
-                    #this size and md5 is also repeated and should be 
-                    #marked as so
-                    self.size_md5[key][0].repeated = True
-        
-
-    def add_empty(self,empty_files):
-        """Add list of empty files to the repeated files."""
-        with self.lock:
-            key = (0, b'empty_file')
-            self.repeated.add(key)
-            self.size_md5[key] = empty_files.copy()
-            for fn in self.size_md5[key]:
-                fn.md5 = key[1]
-                fn.repeated = True
-
-    def update_model(self,ts,page=None):
-        """Update TreeStore data. Responsible for adding new data and
-        for changing the page shown."""
-        if page is None:
-            page = self.page
-
-        #Update filtered
-        self.update_filter()
-
-        npages = math.ceil(len(self.filtered)/self.pagesize)
-
-        #Force page shown to be a valid one
-        if page < 0:
-            page = 0
-        if page >= npages:
-            page = npages - 1
-
-        #If page is valid change to it. May be the same already shown.
-        self.page = page
-        #Sort all filtered files from largest downward
-        sorted_keys = sorted(self.filtered, reverse=True)
-        #Select files from this page
-        page_keys = sorted_keys[self.page*self.pagesize:(self.page+1)*self.pagesize]
-
-        
-        with self.lock:
-            #print('=====Update_model======')
-            ts_newcontents = []
-            main_iter = ts.get_iter_first()
-            while main_iter != None:
-                main_row = ts[main_iter]
-                key = self.ts_contents[main_row[-1]]
-                if len(page_keys) == 0 or page_keys[0] < key:
-                    #This key is not in the shown list. Remove the row.
-                    #print('Key removed: ',key)
-                    if not ts.remove(main_iter):
-                        main_iter = None
-                elif page_keys[0] > key:
-                    #A row must be inserted before this one
-                    key = page_keys.pop(0)
-                    #print('Row inserted: ',key)
-                    ts_newcontents.append(key)
-                    files = self.size_md5[key]
-                    allmarked = self._is_processed(files)
-                    row = [key[1].decode(errors='replace'), key[0] ,allmarked,False, len(ts_newcontents) -1 ]
-                    ts.insert_before(None,main_iter,row)
-
-                elif page_keys[0] == key:
-                    #print('Row updated: ',key)
-                    #Key is present in page_keys. Update row.
-                    page_keys.pop(0)
-                    ts_newcontents.append(key)
-                    main_row[-1] = len(ts_newcontents) -1 
-                    files = self.size_md5[key]
-                    allmarked = self._is_processed(files)
-                    if allmarked != main_row[2]:
-                        #Only update when necessary
-                        main_row[2] = allmarked
-                        
-                    if main_row[3]: #If the row has children
-                        nchildren = ts.iter_n_children(main_iter)
-                        nfiles = len(files)
-                        for k in range(nchildren):
-                            child = ts[ts.iter_nth_child(main_iter,k)]
-                            fn = files[k]
-                            assert k == child[-1], 'files out of order in treestore'
-                            if child[2] != fn.marked:
-                                child[2] = fn.marked
-                        for k in range(nfiles-nchildren):
-                            #Append new children if necessary
-                            self._append_child(ts,main_iter,files[k+nchildren],k+nchildren)
-                    #This row was updated. Get next row.
-                    main_iter = ts.iter_next(main_iter)
-                else:
-                    raise ValueError('Should not have reached this.')
-            
-            for key in page_keys:
-                #print('End key inserted: ',key)
-                #Add the remaining keys 
-                ts_newcontents.append(key)
-                files = self.size_md5[key]
-                allmarked = self._is_processed(files)
-                row = [key[1].decode(errors='replace'), key[0] ,allmarked,False, len(ts_newcontents) -1 ]
-                ts.append(None,row)
-            
-            self.ts_contents = ts_newcontents
-
-
-        return (self.page,npages,len(self.filtered))
-    
-    def _append_child(self,ts,main_iter,fn,index):
-        """This function should only be called from inside a with lock block"""
-        ts.append(main_iter,[fn.fpath.decode(errors='replace'), fn.size, fn.marked,False,index])
-        
-    def add_children(self,ts,tpath):
-        """Add the children of a row in TreeStore"""
-        main_row = ts[tpath]
-        main_iter = ts.get_iter(tpath)
-        key = self.ts_contents[main_row[-1]]
-        files = self.size_md5[key]
-        main_row[3] = True
-        with self.lock:
-            for kk, f in enumerate(files):
-                self._append_child(ts,main_iter,f,kk)
-
-    def _is_processed(self,file_list):
-        """Whether all but one file in the list are marked."""
-        flag = False
-        for fn in file_list:
-            if flag and not fn.marked:
-                #Stop as soon as we find two unmarked files
-                return False
-            flag = flag or not fn.marked
-        return True
-
-    def _is_processed_or_kept(self,file_list):
-        """Whether all but at most one file in the list are marked, ignoring kept."""
-        flag = False
-        for fn in file_list:
-            if fn.kept:
-                continue
-            if flag and not fn.marked:
-                #Stop as soon as we find two unmarked files
-                return False
-            flag = flag or not fn.marked
-        return True
-
-            
-
-    def not_processed_filter(self):
-        """Set of repeated files where more than one copy is unmarked"""
-        nproc = set()
-        with self.lock:
-            for key in self.repeated:
-                if not self._is_processed(self.size_md5[key]):
-                    nproc.add(key)
-        return nproc
-
-    def not_processed_kept_filter(self):
-        """Set of repeated files where more than one copy is unmarked"""
-        nproc = set()
-        with self.lock:
-            for key in self.repeated:
-                if not self._is_processed_or_kept(self.size_md5[key]):
-                    nproc.add(key)
-        return nproc
-
-
-    def update_filter(self):
-        """Update list of files to show."""
-        self.filtered.clear()
-        self.filtered.update(self.repeated)
-        for f in self.filters.values():
-            if f is not None:
-                self.filtered &= f()
-
-    def clear_filters(self):
-        """Clear all filters"""
-        for k in self.filters.keys():
-            self.filters[k] = None
-        
-
-
-    def is_processed(self,ind):
-        key = self.ts_contents[ind]
-        files = self.size_md5[key]
-        unmarked = [fn for fn in files if not fn.marked]
-        return len(unmarked) == 1
-    
-    
-    def getfn(self,ts,tpath):
-        assert tpath.get_depth() == 2, 'tree path not from a file'
-        with self.lock:
-            main_row = ts[tpath[0]]
-            key = self.ts_contents[main_row[-1]]
-            files = self.size_md5[key]
-            child = ts[tpath]
-            return files[child[-1]]
-
-    def get_page_tpath(self,fn):
-        """Find page and tree path corresponding to a FNode."""
-        key = (fn.size,fn.md5)
-        sorted_keys = sorted(self.repeated, reverse=True)
-        ind = sorted_keys.index(key)
-        files = self.size_md5[key]
-        child = files.index(fn)
-        page = ind // self.pagesize
-        row = ind % self.pagesize
-        return page, row, child
-    
-    def toggle_mark(self,fn):
-        key = (fn.size,fn.md5)
-        fl = self.size_md5[key]
-        ind = fl.index(fn)#TODO:possible unused
-        if fn.marked:
-            fn.marked = False
-            return True
-        else:
-            if fn.kept:
-                return False
-            allmarked = True
-            with self.lock:
-                for k in fl:
-                    if k is not fn:
-                        allmarked = allmarked and k.marked
-            if allmarked:
-                return False
-            else:
-                fn.marked = True
-                return True
-                
-    def mark_others(self, fn):
-        """Unmark this file and try to mark for deletion all the other copies of it."""
-        key = (fn.size, fn.md5)
-        with self.lock:
-            fl = self.size_md5[key]
-            fn.marked = False
-            for k in fl:
-                #We know that at least one file is not marked so we can go ahead and mark everything
-                if not k.kept and k is not fn:
-                    k.marked = True
-
-    def delete_marked(self,fobj):
-        with self.lock:
-            for key in sorted(self.repeated,reverse=True):
-                fn_list = self.size_md5[key]
-                marked = filter(lambda x:x.marked,fn_list)
-                for fn in marked:
-                    fobj.write(fn.fpath)
-                    fobj.write(b'\x00')
-                    
-    def to_xmlfile(self,fname):
-        with impl.createDocument(None, "data", None) as xmldoc:
-            root = xmldoc.documentElement
-            with self.lock:
-                for key in sorted(self.repeated,reverse=True):
-                    fn_list = self.size_md5[key]
-                    marked = list(filter(lambda x:x.marked,fn_list))
-                    if len(marked) > 0:
-                        f = xmldoc.createElement('file')
-                        size = xmldoc.createAttribute('size')
-                        size.value = str(key[0])
-                        md5 = xmldoc.createAttribute('md5')
-                        md5.value = key[1].decode(errors='replace')
-                        f.setAttributeNode(md5)
-                        f.setAttributeNode(size)
-                        for fn in fn_list:
-                            if fn.marked:
-                                ff = xmldoc.createElement('deleted')
-                            else:
-                                ff = xmldoc.createElement('kept')
-                            fpath = xmldoc.createTextNode(fn.fpath.decode(errors='replace'))
-                            ff.appendChild(fpath)
-                            f.appendChild(ff)
-                        root.appendChild(f)
-            f = open(fname,'wt')
-            f.write(xmldoc.toprettyxml(indent="    "))
-        
-                        
-
-
-
-
-class FSTree(object):
-    """Holds a file system tree. Every file found via 'find' is represented
-    here. Keeps a reference to every file node. Enforces that a unique 
-    path corresponds to a unique file and a unique file node. Every 
-    subtree is also a FSTree instance and most methods operate recursively."""
-    def __init__(self,path = b''):
-        self.branches = {} #Subtrees. Also FSTree instances
-        self.leaves = {}
-        self.path = path
-        self.shown = None
-        self.aggr_attrib = np.zeros((6,),dtype = np.int64)
-        
-    def add_leaf(self,leaf_path,leaf_attib):
-        """Add a leaf to the tree. Enforce unicity of files and create
-        subtrees as needed"""
-        p = leaf_path.partition(b'/')
-        if p[1] == b'': 
-            #Leaf
-            if p[0] not in self.leaves:
-                self.leaves[p[0]] = leaf_attib
-                return True
-            else:
-                #File already added
-                return False
-        elif len(p[0]) == 0:
-            #root node
-            return self.add_leaf(p[2],leaf_attib)
-        else:
-            assert len(p[2]) >0, 'Empty leaf inserted'
-            if p[0] not in self.branches:
-                self.branches[p[0]] = FSTree(path = self.path + b'/' + p[0])
-            return self.branches[p[0]].add_leaf(p[2],leaf_attib)
-
-    
-    def compute_aggr(self):
-        """Compute aggregate values for the branch."""
-        self.aggr_attrib[:] = 0
-        for bname,br in self.branches.items():
-            br.compute_aggr()
-            self.aggr_attrib[:] = self.aggr_attrib + br.aggr_attrib
-
-        for lname,lf in self.leaves.items():
-            self.aggr_attrib[:] = self.aggr_attrib + np.array([ 1, lf.size ,int(lf.repeated),
-                int(lf.repeated)*lf.size, int(lf.marked), int(lf.kept)],dtype=np.int64)
-            
-            
-    def get_branch(self,branch_path):
-        """Get the branch (a FSTree instance) corresponding to the path."""
-        p = branch_path.partition(b'/')
-        if  len(p[0]) == 0:
-            #root node
-            if p[1] == b'/':
-                return self.get_branch(p[2])
-            else:
-                return self
-                
-        elif p[1] == b'' or p[2] == b'': 
-            return self.branches[p[0]]
-        
-        else:
-            return self.branches[p[0]].get_branch(p[2])
-
-    def get_leaf(self,leaf_path):
-        p = leaf_path.partition(b'/')
-        if  len(p[0]) == 0:
-            #root node
-            return self.get_leaf(p[2])
-        elif p[1] == b'': 
-            #Leaf
-            return self.leaves[p[0]]#Will fail looking for a file that isn't there
-        else:
-            assert len(p[2]) >0, 'Trying to get an empty leaf'
-            return self.branches[p[0]].get_leaf(p[2])
-
-    def get_index(self,ind):
-        """Return an element (a branch or FNode) corresponding to the 
-        position in the shown list."""
-        return self.shown[ind]
-
-    
-    def copy_to_model(self,list_store):
-        """Copy branch contents to ListStore, keeping a list of shown 
-        elements. The index of the element in this list is also stored
-        in the ListStore."""
-        ncol = list_store.get_n_columns
-        list_store.clear()
-        self.shown = []
-        ind = 0
-        for br_name,br in self.branches.items():
-            row = ['folder', br_name.decode(errors='replace')]
-            row.extend(br.aggr_attrib.tolist())
-            row.append(ind)
-            list_store.append(row)
-            self.shown.append(br)
-            ind = ind +1
-        for lf_name,att in self.leaves.items():
-            row = ['gtk-file',lf_name.decode(errors='replace')]
-            row.extend([ 1, att.size ,int(att.repeated),int(att.repeated)*att.size,int(att.marked),int(att.kept),ind])
-            list_store.append(row)
-            self.shown.append(att)
-            ind = ind + 1
-    
-    def get_keys(self,keys = None):
-        """Get all the keys ((size,md5)) of this subtree recursively."""
-        if keys is None:
-            keys = set()
-
-        for br in self.branches.values():
-            br.get_keys(keys)
-        for fn in self.leaves.values():
-            if fn.md5 is not None:
-                keys.add((fn.size,fn.md5))
-        return keys
-        
-    def mark_all(self,rep_file):
-        """Mark recursively all repeated files in this subtree to be deleted."""
-        for fn in self.leaves.values():
-            fn.mark(rep_file)
-        for br in self.branches.values():
-            br.mark_all(rep_file)
-
-    def unmark_all(self):
-        """Remove deleted flag recursively from all files in this subtree."""
-        for fn in self.leaves.values():
-            fn.marked = False
-        for br in self.branches.values():
-            br.unmark_all()
-
-    def keep_all(self):
-        """Mark recursively all files in this subtree to be kept."""
-        for fn in self.leaves.values():
-            fn.keep()
-        for br in self.branches.values():
-            br.keep_all()
-
-    def unkeep_all(self):
-        """Remove kept flag recursively from all files in this subtree."""
-        for fn in self.leaves.values():
-            fn.kept = False
-        for br in self.branches.values():
-            br.unkeep_all()
-
-    def mark_others(self,rep_file):
-        """Mark for deletion all the other copies of  all files in this subtree."""
-        for fn in self.leaves.values():
-            if fn.repeated:
-                rep_file.mark_others(fn)
-        for br in self.branches.values():
-            br.mark_others(rep_file)
-            
-    def pickle_fnode(self, f, saved_fns):
-        """Recursively pickle every fnode in file f."""
-        for fn in self.leaves.values():
-            pickle.dump(fn.get_state(), f)
-            saved_fns[0] += 1
-        for br in self.branches.values():
-            br.pickle_fnode(f, saved_fns)
-
-
-    
-        
-        
-    def print(self,fill = ''):
-        """Old debug printing method. Probable does not work anymore."""
-        first = True
-        for bname,br in self.branches.items():
-            if not first:
-                print(fill+'',end='')
-            else:
-                first = False
-            print('/'+bname,end='')
-            br.print(fill+('+')*(len(bname)+1))
-            
-        for lname,lf in self.leaves.items():
-            if not first:
-                print(fill+'',end='')
-            else:
-                first = False
-            print('/'+lname)
-
-
-def make_fstree(find_output, tree_root, sizes , same_size):
-    """Update the root FSTree with an output of the 'find' run. For 
-    every file, add its size to the sizes dict. If the file's size was
-    already seen, add that size set of sizes with more than one file. In 
-    the end, update aggregates in FSTree."""
-    files = find_output.split(b'\x00')
-    for k in files[:-1]:
-        resp = k.partition(b' ')#An espace separates the size from the path
-        s = int(resp[0])
-        file_node = FNode(resp[2],s)
-        if tree_root.add_leaf(resp[2],file_node):
-            #Ignore a file already added
-            if s in sizes:
-                sizes[s].append(file_node)
-                same_size.add(s)
-            else:
-                sizes[s] = [file_node]
-
-    tree_root.compute_aggr()
-    #print('{} files with repeated size'.format(sum([len(sizes[k]) for k in same_size.keys()])))
-    return tree_root, sizes, same_size
-
-    
-def compute_md5(fnlist,rep_files):
-    """Compute md5 from every file in fnlist. Do not recompute md5 from
-    files already analized."""
-    while(len(fnlist)>0):
-        fn = fnlist.pop(0)
-        if fn.md5 is None:
-            try:
-                md5 = sb.check_output(['md5sum',fn.fpath])
-                md5 = md5[:32]
-            except sb.CalledProcessError:
-                md5 = b'Not found'
-            
-            fn.md5 = md5
-            rep_files.add_fn(fn)
-            
-def save_state(fpath, fstree, saved_fns):
-
-    total_fns = fstree.aggr_attrib[0]
-    with open(fpath, 'wb') as f:
-        pickle.dump(total_fns, f)
-        fstree.pickle_fnode(f,saved_fns)
-
-def restore_state(fpath, fstree, rep_files, restored_fns, sizes, same_size):
-    with open(fpath, 'rb') as f:
-        fns_torestore = pickle.load(f)
-        while True:
-            try:
-                fn_data = pickle.load(f)
-            except EOFError:
-                if restored_fns[0] != fns_torestore:
-                    print('Incomplete state restoration.')
-                return
-            fn = FNode(None, None)
-            fn.set_state(fn_data)
-            if not fstree.add_leaf(fn.fpath, fn):
-                raise ValueError('State file includes repeated entry in file system.')
-            if fn.size in sizes:
-                sizes[fn.size].append(fn)
-                same_size.add(fn.size)
-            else:
-                sizes[fn.size] = [fn]
-                
-            if fn.size > 0 and fn.md5 is not None:
-                rep_files.add_fn(fn)
-            restored_fns[0] += 1
-
                 
  
         
@@ -721,7 +434,6 @@ class UI(object):
         self.hbox = self.builder.get_object('hbox')
         self.path_label = self.builder.get_object('path_label')
         self.files_label = self.builder.get_object('files_label')
-        self.page = 0
         self.popup_menu = self.builder.get_object('popup_menu')
         self.scale = self.builder.get_object('scale')
         self.scale.set_range(1.,42.)
@@ -734,16 +446,26 @@ class UI(object):
         box.pack_start(self.spinner, False ,False, 0)
         box.reorder_child(self.spinner,0)
         self.hide_processed_button = self.builder.get_object('hide_processed_button')
-        self.page_adjustment = self.builder.get_object('page_adjustment')
+        self.hide_processed_kept_button = self.builder.get_object('hide_processed_kept_button')
 
         
         self.open_diag = None
-        self.finder_result = None
         self.repeated_tree_store = None
         self.fs_list_store = None
+        self.algorithm = DEFAULT_ALGORITHM
         self.clear_data()
-        self.md5_working = []
         self.md5_thr = None
+        self.deleter = None
+        self.hash_workers = HASH_WORKERS
+        self.delete_workers = DELETE_WORKERS
+        self.dedupe_method = 'auto'
+        self.cache = None
+        self.walk_workers = WALK_WORKERS
+        self.metrics_path = None
+        self.io_policy = IO_POLICY
+        self.hash_order = HASH_ORDER
+        self.device_workers = None
+        self.path = None
         self.shown_path = ''
         self.stop = False
         self.hide_processed_filter = False
@@ -758,22 +480,30 @@ class UI(object):
     
 
     def init_left_tree(self):
-        ts = Gtk.TreeStore(str,GObject.TYPE_INT64,bool,bool,int)
+        ts = RepFilesModel(self.rep_files)
         
         
         self.tv_left = Gtk.TreeView(ts)
+        #Rows are only read when shown (see RepFilesModel). All columns
+        #must have a fixed width
+        self.tv_left.set_fixed_height_mode(True)
         renderer = Gtk.CellRendererText()
         col = Gtk.TreeViewColumn('Size',renderer,text = 1)
         col.set_cell_data_func(renderer,col_human,1)
-        #col.set_sort_column_id(1)
-        #self.left_sort_col = col
+        col.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
+        col.set_fixed_width(90)
         self.tv_left.append_column(col)
         renderer = Gtk.CellRendererToggle()
         renderer.connect('toggled',self.on_left_toggled)
         col = Gtk.TreeViewColumn('Delete',renderer,active=2)
+        col.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
+        col.set_fixed_width(60)
         self.tv_left.append_column(col)
         renderer = Gtk.CellRendererText()
         col = Gtk.TreeViewColumn('Repeated files',renderer,text=0)
+        col.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
+        col.set_fixed_width(400)
+        col.set_resizable(True)
         self.tv_left.append_column(col)
         self.tv_left.connect('row-activated',self.activated_repeated_tree)
         scrol  = self.builder.get_object('scrolled_left')
@@ -781,16 +511,15 @@ class UI(object):
         
         
         self.repeated_tree_store = ts
-        #self.left_sort_col.set_sort_order(Gtk.SortType.DESCENDING)
-
-        #self.left_sort_col.clicked()
-        #self.left_sort_col.clicked()
 
         
     def init_right_tree(self):
-        store = Gtk.ListStore(str, str, int,GObject.TYPE_INT64, int,GObject.TYPE_INT64,int,int,int)
+        store = FSTreeModel()
         
         tree = Gtk.TreeView(store)
+        #Rows are only read when shown (see FSTreeModel). All columns must
+        #have a fixed width
+        tree.set_fixed_height_mode(True)
 
         name_renderer = Gtk.CellRendererText()
         icon_renderer = Gtk.CellRendererPixbuf()
@@ -800,6 +529,7 @@ class UI(object):
         name_column.add_attribute(icon_renderer,'icon-name',0)
         name_column.add_attribute(name_renderer,'text',1)
         name_column.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
+        name_column.set_fixed_width(300)
         name_column.set_sort_column_id(1)
         name_column.set_resizable(True)
         tree.append_column(name_column)
@@ -822,20 +552,31 @@ class UI(object):
 
         mark_renderer = Gtk.CellRendererText()
         mark_column = Gtk.TreeViewColumn("Marked", mark_renderer, text=6)
-        mark_column.set_sort_column_id(5)
+        mark_column.set_sort_column_id(6)
         tree.append_column(mark_column)
 
         keep_renderer = Gtk.CellRendererText()
         keep_column = Gtk.TreeViewColumn("Kept", keep_renderer, text=7)
-        keep_column.set_sort_column_id(6)
+        keep_column.set_sort_column_id(7)
         tree.append_column(keep_column)
 
 
+        links_renderer = Gtk.CellRendererText()
+        links_column = Gtk.TreeViewColumn("Hard links", links_renderer, text=8)
+        links_column.set_sort_column_id(8)
+        tree.append_column(links_column)
+
         size_renderer = Gtk.CellRendererText()
         size_column = Gtk.TreeViewColumn("Size", size_renderer, text=3)
         size_column.set_cell_data_func(size_renderer,col_human,3)
+        size_column.set_sort_column_id(3)
         tree.append_column(size_column)
 
+        for column in tree.get_columns()[1:]:
+            column.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
+            column.set_fixed_width(90)
+            column.set_resizable(True)
+
         tree.connect('row-activated',self.activated_fstree)
         tree.connect('button-press-event',self.right_button_press)
 
@@ -851,12 +592,14 @@ class UI(object):
         self.fstree_root = FSTree()
         self.sizes = {}
         self.same_size = set()
-        self.rep_files = RepFile()
+        self.rep_files = RepFile(algorithm = self.algorithm)
+        self.partials = {}
+        self.inodes = {}
         self.md5_todo = []
         if self.repeated_tree_store  is not None:
-            self.repeated_tree_store.clear()
+            self.set_left_model()
         if self.fs_list_store is not None:
-            self.fs_list_store.clear()
+            self.set_right_model(None)
 
 
 
@@ -879,22 +622,23 @@ class UI(object):
         path = self.open_diag.get_filename()
         #TODO: Temporary solution to utf errors
         self.shown_path = path.encode()
-        self.finder_thr = Finder(path)
+        self.finder_thr = Finder(path,self.fstree_root,self.sizes,self.same_size,self.inodes,self.walk_workers)
         self.finder_thr.start()
         GObject.timeout_add(100,self.check_finder)
         self.path = path
         print('Scanning path',path)
     
     def check_finder(self):
-        """Timeout function, call make_fstree when finder thread finishes."""
+        """Timeout function, start md5 computation when finder thread finishes."""
         if self.finder_thr.is_alive(): 
             self.pbar.pulse()
+            self.status_label.set_text('Scanning... {} files found, {:.0f} files/s'.format(
+                self.finder_thr.nfiles, metrics.rate('walk', 'walk_files')))
+            self.status_label.set_tooltip_text(metrics.summary())
             return True
         else:
-            print('Find process finished. Building file tree...')
-            self.finder_result = self.finder_thr.result
-            make_fstree(self.finder_result,self.fstree_root,self.sizes,self.same_size)
             print('File tree completed.')
+            self.write_metrics('scan')
             self.update_path()
             print('update_path completed')
             self.compute_md5list()
@@ -939,16 +683,14 @@ class UI(object):
         if self.md5_thr is None:
             #Thread not yet started. Create one if we have work to do
             if len(self.md5_todo) > 0 and not self.stop:
-                assert len(self.md5_working) == 0, 'working md5 list not empty'
                 #Process larger files first
-                
-                self.md5_working.extend([fn for fn in self.md5_todo if fn.size <= self.max_filesize])
-                self.md5_working.sort(key=lambda x:x.size,reverse=True)#This is COOL!
-                sizes = np.array([fn.size for fn in self.md5_working],dtype=np.int64)
-                self.progress = sizes.cumsum().astype(float)/sizes.sum()
+                md5_working = [fn for fn in self.md5_todo if fn.size <= self.max_filesize]
+                md5_working.sort(key=lambda x:x.size,reverse=True)#This is COOL!
                 self.md5_todo.clear()
 
-                self.md5_thr = threading.Thread(target= compute_md5, args = (self.md5_working,self.rep_files))
+                self.md5_thr = HashPool(md5_working,self.rep_files,self.hash_workers,self.partials,self.cache,
+                                        policy = self.io_policy, order = self.hash_order,
+                                        device_workers = self.device_workers)
                 self.md5_thr.start()
                 self.spinner.start()
                 return True #We will run again
@@ -961,18 +703,19 @@ class UI(object):
             if not self.stop:
                 #Thread still running. Come back later
                 self.update_repeated()
-                yet = len(self.md5_working)
+                yet = self.md5_thr.remaining()
                 if yet > 0:
-                    self.pbar.set_fraction(self.progress[-yet])
-                    self.status_label.set_text('Processing files of size {} and lower. Still {} files to process'.format(human_size(self.md5_working[0].size),yet))
+                    self.pbar.set_fraction(self.md5_thr.fraction())
+                    self.status_label.set_text('Processing files of size {} and lower. Still {} files to process, {}/s'.format(
+                        human_size(self.md5_thr.next_size()),yet,human_size(metrics.rate('hash', 'hash_bytes'))))
+                    self.status_label.set_tooltip_text(metrics.summary())
                 else:
                     self.pbar.set_fraction(1.0)
                     self.status_label.set_text('Finished?')
                 return True
             else:
                 #We must stop
-                self.md5_todo.extend(self.md5_working)
-                self.md5_working.clear()
+                self.md5_todo.extend(self.md5_thr.stop())
                 return True
         else:
             #Thread finished
@@ -983,7 +726,6 @@ class UI(object):
             else:
                 self.update_repeated()
                 self.stop = False
-                self.fstree_root.compute_aggr()
                 self.update_path()
                 self.spinner.stop()
                 if len(self.md5_todo) > 0:
@@ -991,6 +733,8 @@ class UI(object):
                 else:
                     msg = 'Finished!'
                 self.status_label.set_text(msg)
+                self.status_label.set_tooltip_text(metrics.summary())
+                self.write_metrics('hash')
                 #We are finished!
                 return False
 
@@ -1009,7 +753,9 @@ class UI(object):
             while len(self.sizes[s]) > 0:
                 fn = self.sizes[s].pop(0)
                 if s > 0 and s < self.max_filesize:
-                    if fn.md5 is None:
+                    if fn.md5 is None or needs_partial(fn):
+                        #Files hashed by older versions still need their
+                        #partial hash to be matched against new files
                         self.md5_todo.append(fn)
                 else:
                     untreated.append(fn)
@@ -1034,9 +780,8 @@ class UI(object):
             if resp == Gtk.ResponseType.OK:
                 fpath = save_diag.get_filename()
                 self.saved_fns = [0]
-                self.fstree_root.compute_aggr()
                 self.fns_tosave = self.fstree_root.aggr_attrib[0]
-                self.save_state_thr = threading.Thread(target= save_state, args = (fpath,self.fstree_root,self.saved_fns))
+                self.save_state_thr = threading.Thread(target= save_state, args = (fpath,self.fstree_root,self.saved_fns,self.rep_files.algorithm))
                 self.save_state_thr.start()
                 self.spinner.start()
                 self.status_label.set_text('Saving state...')
@@ -1071,11 +816,8 @@ class UI(object):
             resp = restore_diag.run()
             if resp == Gtk.ResponseType.OK:
                 fpath = restore_diag.get_filename()
-                f = open(fpath, 'rb')
                 try:
-                    self.fns_torestore = pickle.load(f)
-                    if type(self.fns_torestore) is not np.int64 or self.fns_torestore <= 0:
-                        raise ValueError('Improper value stored in state file')
+                    self.fns_torestore = read_state_count(fpath)
                 except Exception as ex:
                     restore_diag.destroy()
                     dialog = Gtk.MessageDialog(self.win, 0, Gtk.MessageType.ERROR,
@@ -1088,15 +830,13 @@ class UI(object):
                     #File seems good so far. Let us just proceed and hope for the best
                     self.clear_data()
                     self.restored_fns = [0]
-                    self.restore_state_thr = threading.Thread(target= restore_state, args = (fpath,self.fstree_root,self.rep_files, self.restored_fns,self.sizes,self.same_size))
+                    self.restore_state_thr = threading.Thread(target= restore_state, args = (fpath,self.fstree_root,self.rep_files, self.restored_fns,self.sizes,self.same_size,self.partials,self.inodes))
                     self.restore_state_thr.start()
                     self.spinner.start()
                     self.status_label.set_text('Restoring state...')
                     GObject.timeout_add(500,self.check_restore_state)
                     restore_diag.destroy()
                     
-                finally:
-                    f.close()
             else:
                 restore_diag.destroy()
         else:
@@ -1126,15 +866,45 @@ class UI(object):
             return False
 
 
+    def write_metrics(self, event):
+        """Append the metrics to the metrics file, if one was given."""
+        if self.metrics_path is None:
+            return
+        try:
+            metrics.write(self.metrics_path, event = event, path = self.path)
+        except OSError as err:
+            print('Could not write metrics: {}'.format(err))
+
+    def set_left_model(self):
+        """Show the groups of repeated files that pass the filters."""
+        self.repeated_tree_store = RepFilesModel(self.rep_files)
+        self.tv_left.set_model(self.repeated_tree_store)
+        self.update_files_label()
+
     def update_repeated(self):
-        """Append to model repeated files recently found."""
-        self.goto_page(None)#Force update of model and trigger
-                            #page label update
+        """Bring the left panel up to date with the repeated files found,
+        marked or kept since the last update."""
+        self.repeated_tree_store.sync()
+        self.update_files_label()
+
+    def update_files_label(self):
+        self.files_label.set_label('{} repeated files'.format(len(self.repeated_tree_store)))
     
+    def set_right_model(self, branch):
+        """Show a branch in the right pane, keeping the sort order."""
+        sorted_,column,order = self.fs_list_store.get_sort_column_id()
+        self.fs_list_store = FSTreeModel(branch, column if sorted_ else UNSORTED_SORT_COLUMN_ID, order)
+        self.tv_right.set_model(self.fs_list_store)
+
     def update_path(self):
-        """Show a new path in the right pane."""
+        """Show a new path in the right pane. If it is already shown, only
+        its values are updated."""
         branch = self.fstree_root.get_branch(self.shown_path)
-        branch.copy_to_model(self.fs_list_store)
+        if self.fs_list_store.is_current(branch):
+            self.fs_list_store.refresh()
+            self.tv_right.queue_draw()
+        else:
+            self.set_right_model(branch)
         self.path_label.set_label('Location: {}'.format(self.shown_path.decode(errors='replace')))
         
 
@@ -1143,16 +913,12 @@ class UI(object):
         #sp = treepath.split(':')
         if  treepath.get_depth() == 1:
             #Main row
-            row = self.repeated_tree_store[treepath]
-            if not row[3]:
-                self.rep_files.add_children(self.repeated_tree_store,treepath)
-                treeview.expand_row(treepath,False)
-            elif treeview.row_expanded(treepath):
+            if treeview.row_expanded(treepath):
                 treeview.collapse_row(treepath)
             else:
                 treeview.expand_row(treepath,False)
         else:
-            fn = self.rep_files.getfn(self.repeated_tree_store,treepath)
+            fn = self.repeated_tree_store.get_fn(treepath)
             fname = fn.fpath
             sp = fname.rpartition(b'/')
             self.shown_path = sp[0]
@@ -1169,15 +935,20 @@ class UI(object):
             self.update_path()
         else:
             fn = branch.get_index(ind)
+            if fn.link_of is not None:
+                #Show the group of the inode's primary link
+                fn = fn.link_of
             if fn.repeated:
-                page,row,child = self.rep_files.get_page_tpath(fn)
-                self.rep_files.clear_filters()
-                self.hide_processed_button.set_active(False)
-                self.goto_page(page)
-                path = Gtk.TreePath(str(row))
-                self.tv_left.set_cursor(path, None, False)
-                self.activated_repeated_tree(self.tv_left,path,None)
-                self.tv_left.expand_row(path,False)
+                self.update_repeated()
+                path = self.repeated_tree_store.path_of(fn)
+                if path is None:
+                    #Hidden by a filter
+                    self.hide_processed_button.set_active(False)
+                    self.hide_processed_kept_button.set_active(False)
+                    path = self.repeated_tree_store.path_of(fn)
+                if path is not None:
+                    self.tv_left.expand_to_path(path)
+                    self.tv_left.set_cursor(path, None, False)
 
 
 
@@ -1188,18 +959,12 @@ class UI(object):
             tpath = Gtk.TreePath(tpath)
         if tpath.get_depth() == 2:
             #Only in a child row
-            fn  = self.rep_files.getfn(self.repeated_tree_store,tpath)
-            success = self.rep_files.toggle_mark(fn)
-            if success:
-                self.repeated_tree_store[tpath][2] = fn.marked
-                main_row = self.repeated_tree_store[tpath[0]]
-                if self.rep_files.is_processed(main_row[-1]):
-                    main_row[2] = True
-                else:
-                    main_row[2] = False
-                
-            
+            fn  = self.repeated_tree_store.get_fn(tpath)
+            if self.rep_files.toggle_mark(fn):
+                #Updates the row, the group row, and hides it if filtered
+                self.update_repeated()
                 
+
     def up(self,widget,*args):
         """Callback to go up a level in the right panel."""
         paths = self.shown_path.rpartition(b'/')
@@ -1225,7 +990,7 @@ class UI(object):
                 self.rep_files.filters['NotProcessed'] = self.rep_files.not_processed_filter
             else:
                 self.rep_files.filters['NotProcessed'] = None
-            self.goto_page(None)
+            self.set_left_model()
 
     def on_hide_processed_kept_button_toggled(self,widget, data = None):
         self.hide_processed_kept_filter = widget.get_active()
@@ -1235,7 +1000,7 @@ class UI(object):
                 self.rep_files.filters['NotProcessedKept'] = self.rep_files.not_processed_kept_filter
             else:
                 self.rep_files.filters['NotProcessedKept'] = None
-            self.goto_page(None)
+            self.set_left_model()
         
     def on_action_mark_all_activate(self,action, data = None):
         model,selection = self.selection_right.get_selected_rows()
@@ -1248,10 +1013,8 @@ class UI(object):
                 ind = self.fs_list_store[titer][-1]
                 fn = self.fstree_root.get_branch(self.shown_path).get_index(ind)
                 fn.mark(self.rep_files)
-        branch = self.fstree_root.get_branch(self.shown_path)
-        branch.compute_aggr()
 
-        self.goto_page(None)
+        self.update_repeated()
         self.update_path()
 
         
@@ -1267,10 +1030,8 @@ class UI(object):
                 ind = self.fs_list_store[titer][-1]
                 fn = self.fstree_root.get_branch(self.shown_path).get_index(ind)
                 fn.marked = False
-        branch = self.fstree_root.get_branch(self.shown_path)
-        branch.compute_aggr()
 
-        self.goto_page(None)
+        self.update_repeated()
         self.update_path()
 
     def on_action_keep_all_activate(self,action, data = None):
@@ -1284,10 +1045,8 @@ class UI(object):
                 ind = self.fs_list_store[titer][-1]
                 fn = self.fstree_root.get_branch(self.shown_path).get_index(ind)
                 fn.keep()
-        branch = self.fstree_root.get_branch(self.shown_path)
-        branch.compute_aggr()
 
-        self.goto_page(None)
+        self.update_repeated()
         self.update_path()
 
     def on_action_unkeep_all_activate(self,action, data = None):
@@ -1301,10 +1060,8 @@ class UI(object):
                 ind = self.fs_list_store[titer][-1]
                 fn = self.fstree_root.get_branch(self.shown_path).get_index(ind)
                 fn.kept = False
-        branch = self.fstree_root.get_branch(self.shown_path)
-        branch.compute_aggr()
 
-        self.goto_page(None)
+        self.update_repeated()
         self.update_path()
 
     def on_action_mark_others_activate(self,action, data = None):
@@ -1320,9 +1077,6 @@ class UI(object):
                 self.rep_files.mark_others(fn)
         self.on_action_unmark_all_activate(action, data)
 
-    def on_page_adjustment_value_changed(self,adj,data=None):
-        #print('Page changed!',self.page_adjustment.get_value())
-        self.goto_page(int(self.page_adjustment.get_value())-1)
 
 
     def on_format_value(self,scale,value):
@@ -1340,19 +1094,91 @@ class UI(object):
             return False
     
     def delete_marked(self,widget,*args):
-        save_diag = Gtk.FileChooserDialog('Save as', self.win,
+        self.run_file_action('delete')
+
+    def dedupe_marked(self,widget,*args):
+        self.run_file_action('dedupe')
+
+    def run_file_action(self,action):
+        """Once confirmed, save the XML log, then delete or deduplicate the
+        marked files. Changes are journaled next to the log, in a file ending in
+        .journal (.dedupe.journal when deduplicating), and a run that was
+        interrupted is resumed when the same log is chosen."""
+        if self.md5_thr is not None or self.deleter is not None:
+            dialog = Gtk.MessageDialog(self.win, 0, Gtk.MessageType.ERROR,
+                Gtk.ButtonsType.OK, "Another task is still running. Stop it before deleting.")
+            dialog.run()
+            dialog.destroy()
+            return
+        save_diag = Gtk.FileChooserDialog('Save log as', self.win,
                     Gtk.FileChooserAction.SAVE,
                     (Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL,
                     "Save", Gtk.ResponseType.OK))
         save_diag.set_do_overwrite_confirmation(True)
         resp = save_diag.run()
-        if resp == Gtk.ResponseType.OK:
-            fpath = save_diag.get_filename()
-            self.rep_files.to_xmlfile(fpath)
-            with open('del_out','wb') as f:
-                self.rep_files.delete_marked(f)
+        fpath = save_diag.get_filename()
         save_diag.destroy()
-        
+        if resp != Gtk.ResponseType.OK:
+            return
+        fns = self.rep_files.marked_files()
+        if action == 'dedupe':
+            question = "Replace {} files by links to a kept copy?".format(len(fns))
+        else:
+            question = "Delete {} files?".format(len(fns))
+        diag = Gtk.MessageDialog(self.win, 0, Gtk.MessageType.QUESTION,
+            Gtk.ButtonsType.OK_CANCEL, question)
+        diag.format_secondary_text('{} will be freed. This can not be undone.'.format(
+            human_size(sum(fn.size for fn in fns if not fn.links))))
+        resp = diag.run()
+        diag.destroy()
+        if resp != Gtk.ResponseType.OK:
+            return
+        #The log only replaces an earlier one once the run is accepted
+        tmp = fpath + '.tmp'
+        try:
+            self.rep_files.to_xmlfile(tmp, action, self.dedupe_method)
+            if action == 'dedupe':
+                self.deleter = Deduper(fns, self.rep_files, self.fstree_root, fpath + '.dedupe.journal',
+                                       self.delete_workers, policy = self.io_policy,
+                                       method = self.dedupe_method)
+            else:
+                self.deleter = Deleter(fns, self.rep_files, self.fstree_root, fpath + '.journal',
+                                       self.delete_workers, policy = self.io_policy)
+            os.replace(tmp, fpath)
+        except (OSError, ValueError) as ex:
+            self.deleter = None
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            dialog = Gtk.MessageDialog(self.win, 0, Gtk.MessageType.ERROR,
+                Gtk.ButtonsType.OK, "Changing files failed.")
+            dialog.format_secondary_text('{0}'.format(ex))
+            dialog.run()
+            dialog.destroy()
+            return
+        self.deleter.start()
+        self.spinner.start()
+        self.status_label.set_text('Deduplicating files...' if action == 'dedupe' else 'Deleting files...')
+        GObject.timeout_add(500,self.check_delete)
+
+    def check_delete(self):
+        """Periodically check deletion or deduplication progress"""
+        self.pbar.set_fraction(self.deleter.fraction())
+        if self.deleter.is_alive():
+            return True
+        counts = self.deleter.counts
+        self.spinner.stop()
+        done = ('deleted', 'reflinked', 'hardlinked')
+        msg = 'Done. {}, {} freed.'.format(', '.join('{} files {}'.format(counts[event], event)
+            for event in done if counts[event] > 0) or 'No files changed', human_size(self.deleter.freed))
+        others = ', '.join('{} {}'.format(n, event) for event, n in sorted(counts.items()) if event not in done)
+        if others:
+            msg += ' ({}, see the journal)'.format(others)
+        self.status_label.set_text(msg)
+        self.deleter = None
+        self.update_repeated()
+        self.update_path()
+        return False
+
 
     
     def back(self,widget,*args):
@@ -1361,26 +1187,16 @@ class UI(object):
     def forward(self,widget,*args):
         self.rep_files.to_xmlfile('temp.xml')
         
-    def goto_page(self,page):
-        """Show requested page on the left panel. Update TreeModel with
-        latest data."""
-        #If page is None, only update data
-        page,npages,nrep = self.rep_files.update_model(self.repeated_tree_store,page)
-        self.files_label.set_label('Page {} of {} ({} repeated files)'.format(page+1,npages,nrep))
-        self.page_adjustment.set_upper(max(npages,1))
-        self.page_adjustment.set_value(page+1) 
-        self.page = page
-
-        
-        
     def on_first_page(self,widget,*args):
-        #self.goto_page(self.page-1)
-        self.page_adjustment.set_value(1)
+        """Scroll the left panel to the largest files."""
+        if len(self.repeated_tree_store) > 0:
+            self.tv_left.scroll_to_cell(Gtk.TreePath((0,)), None, False, 0, 0)
 
     def on_last_page(self,widget,*args):
-        #self.goto_page(self.page+1)
-        last_page = self.page_adjustment.get_upper()
-        self.page_adjustment.set_value(int(last_page))
+        """Scroll the left panel to the smallest files."""
+        n = len(self.repeated_tree_store)
+        if n > 0:
+            self.tv_left.scroll_to_cell(Gtk.TreePath((n-1,)), None, False, 0, 0)
 
 
     def quit(self,widget,*args):
@@ -1398,8 +1214,57 @@ class UI(object):
 
 
 if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description = 'Find and manage duplicated files.')
+    parser.add_argument('--walk-workers', type = int, default = WALK_WORKERS,
+                        help = 'threads reading directories (default: %(default)s)')
+    parser.add_argument('--hash-workers', type = int, default = HASH_WORKERS,
+                        help = 'threads hashing files (default: %(default)s)')
+    parser.add_argument('--cache', default = None, metavar = 'FILE',
+                        help = 'hash cache database (default: {})'.format(default_cache_path()))
+    parser.add_argument('--no-cache', action = 'store_true',
+                        help = 'do not use the persistent hash cache')
+    parser.add_argument('--invalidate-cache', action = 'append', default = [], metavar = 'PATH',
+                        help = 'forget cached hashes of files under PATH')
+    parser.add_argument('--metrics', default = None, metavar = 'FILE',
+                        help = 'append timings and throughput to FILE as JSON lines')
+    parser.add_argument('--algorithm', default = DEFAULT_ALGORITHM, choices = sorted(HASHERS),
+                        help = 'digest used to compare files (default: %(default)s)')
+    parser.add_argument('--io-policy', default = IO_POLICY, choices = IO_POLICIES,
+                        help = 'page cache use when hashing: cache, dontneed (drop what was read) '
+                               'or direct (O_DIRECT) (default: %(default)s)')
+    parser.add_argument('--hash-order', default = HASH_ORDER, choices = HASH_ORDERS,
+                        help = 'order of the files of each device: largest first, by inode or '
+                               'by physical position (default: %(default)s)')
+    parser.add_argument('--device-workers', type = int, default = None, metavar = 'N',
+                        help = 'at most N threads hash files of the same device, e.g. 1 for '
+                               'spinning disks (default: no limit)')
+    parser.add_argument('--delete-workers', type = int, default = DELETE_WORKERS,
+                        help = 'threads deleting or deduplicating files (default: %(default)s)')
+    parser.add_argument('--dedupe-method', default = 'auto', choices = DEDUPE_METHODS,
+                        help = 'how "Dedupe marked" replaces copies: reflink, hard link, or '
+                               'reflink when possible (default: %(default)s)')
+    args = parser.parse_args()
     
     GObject.threads_init()
 
     ui = UI()
+    ui.walk_workers = args.walk_workers
+    ui.hash_workers = args.hash_workers
+    ui.metrics_path = args.metrics
+    ui.io_policy = args.io_policy
+    ui.hash_order = args.hash_order
+    ui.device_workers = args.device_workers
+    ui.delete_workers = args.delete_workers
+    ui.dedupe_method = args.dedupe_method
+    ui.algorithm = args.algorithm
+    ui.clear_data()
+    if not args.no_cache:
+        try:
+            ui.cache = HashCache(args.cache)
+        except (OSError, sqlite3.Error) as err:
+            print('Hash cache disabled: {}'.format(err))
+        else:
+            for prefix in args.invalidate_cache:
+                ui.cache.invalidate(os.path.abspath(prefix))
     Gtk.main()
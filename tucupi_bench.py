@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+#Copyright 2015,2016,2017 Ubiratan S. Freitas
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmarks of the tucupi engine on reproducible synthetic file trees.
+Each measurement is written as a JSON line."""
+
+import os
+import sys
+import json
+import time
+import math
+import random
+import hashlib
+import shutil
+import tempfile
+import subprocess
+
+from tucupi_core import (parse_find_output, walk_tree, make_fstree, FSTree, RepFile, compute_md5,
+                         HashPool, save_state, restore_state, HASH_WORKERS, metrics,
+                         SortedKeys, HASHERS, DEFAULT_ALGORITHM, IO_POLICIES, IO_POLICY)
+
+
+class TreeSpec(object):
+    """Reproducible description of a synthetic file tree. Files are spread
+    over directories depth levels deep, each with fanout subdirectories.
+    Sizes follow a log-normal distribution ('lognormal'), a uniform one
+    ('uniform') or are all equal ('fixed'). A fraction dup_ratio of the
+    files are copies of an earlier file."""
+    def __init__(self, nfiles, depth = 3, fanout = 10, dist = 'lognormal', median = 1024,
+                 sigma = 1.5, max_size = 1024*1024, dup_ratio = 0.2, seed = 0):
+        self.nfiles = nfiles
+        self.depth = depth
+        self.fanout = fanout
+        self.dist = dist
+        self.median = median
+        self.sigma = sigma
+        self.max_size = max_size
+        self.dup_ratio = dup_ratio
+        self.seed = seed
+
+    def params(self):
+        return dict(self.__dict__)
+
+    def _size(self, rnd):
+        if self.dist == 'fixed':
+            return self.median
+        if self.dist == 'uniform':
+            return rnd.randint(1, 2*self.median)
+        return min(self.max_size, max(1, int(rnd.lognormvariate(math.log(self.median), self.sigma))))
+
+    def files(self):
+        """Yield (relative path, size, content id) of every file. Copies
+        share the content id of the original."""
+        rnd = random.Random(self.seed)
+        ndirs = self.fanout ** self.depth
+        contents = []
+        for k in range(self.nfiles):
+            if len(contents) > 0 and rnd.random() < self.dup_ratio:
+                cid, size = contents[rnd.randrange(len(contents))]
+            else:
+                cid, size = len(contents), self._size(rnd)
+                contents.append((cid, size))
+            d = rnd.randrange(ndirs)
+            parts = []
+            for level in range(self.depth):
+                d, r = divmod(d, self.fanout)
+                parts.append('d{}'.format(r))
+            parts.append('f{}'.format(k))
+            yield '/'.join(parts), size, cid
+
+    def find_output(self, root = b'/bench'):
+        """The tree as printed by 'find -printf "%s %h/%f\\0"'."""
+        return b''.join(b'%d %s/%s\x00' % (size, root, path.encode()) for path, size, cid in self.files())
+
+    def write(self, root):
+        """Create the tree under root. Files with the same content id have
+        the same data."""
+        for path, size, cid in self.files():
+            fpath = os.path.join(root, path)
+            os.makedirs(os.path.dirname(fpath), exist_ok = True)
+            block = hashlib.sha256(str(cid).encode()).digest() * 128
+            with open(fpath, 'wb') as f:
+                for k in range(size // len(block)):
+                    f.write(block)
+                f.write(block[:size % len(block)])
+
+
+def fake_md5(size, cid):
+    return hashlib.md5('{} {}'.format(size, cid).encode()).hexdigest().encode()
+
+
+class Bench(object):
+    """Time stages and write one JSON line per stage."""
+    def __init__(self, out, common):
+        self.out = out
+        self.common = common
+
+    def run(self, stage, func, nitems):
+        t0 = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - t0
+        self.write(stage, nitems, elapsed)
+
+    def write(self, stage, nitems, elapsed, **extra):
+        rec = dict(self.common)
+        rec.update(stage = stage, items = nitems, seconds = round(elapsed, 6),
+                   items_per_s = round(nitems/elapsed, 1) if elapsed > 0 else None)
+        rec.update(extra)
+        self.out.write(json.dumps(rec) + '\n')
+        self.out.flush()
+
+
+def bench_memory(spec, bench, workdir, algorithm):
+    """Stages that need no files on disk."""
+    n = spec.nfiles
+    find_output = spec.find_output()
+    cids = [cid for path, size, cid in spec.files()]
+
+    tree_root, sizes, same_size = FSTree(), {}, set()
+    bench.run('make_fstree', lambda: make_fstree(parse_find_output(find_output), tree_root, sizes, same_size), n)
+    bench.run('compute_aggr', tree_root.compute_aggr, n)
+
+    #Files come out of the tree in the order they were added
+    fns = [fn for s in sizes for fn in sizes[s]]
+    fns.sort(key = lambda fn: int(fn.fpath.rpartition(b'/f')[2]))
+    for fn, cid in zip(fns, cids):
+        fn.md5 = fake_md5(fn.size, cid)
+    rep_files = RepFile(algorithm = algorithm)
+    def add_all():
+        for fn in fns:
+            rep_files.add_fn(fn)
+    bench.run('RepFile.add_fn', add_all, n)
+
+    #What the repeated files panel does to show every row once
+    keys = SortedKeys(rep_files.index)
+    bench.run('SortedKeys.slice_desc', lambda: [keys.slice_desc(k, k+1) for k in range(len(keys))], len(keys))
+
+    bench.run('FSTree.mark_all', lambda: tree_root.mark_all(rep_files), n)
+    bench.run('FSTree.unmark_all', tree_root.unmark_all, n)
+    bench.run('FSTree.keep_all', tree_root.keep_all, n)
+    bench.run('FSTree.unkeep_all', tree_root.unkeep_all, n)
+    bench.run('FSTree.mark_others', lambda: tree_root.mark_others(rep_files), n)
+
+    fpath = os.path.join(workdir, 'state.npz')
+    bench.run('save_state', lambda: save_state(fpath, tree_root, [0], algorithm), n)
+    args = (fpath, FSTree(), RepFile(algorithm = algorithm), [0], {}, set())
+    bench.run('restore_state', lambda: restore_state(*args), n)
+
+
+def bench_disk(spec, bench, workdir, hash_workers, algorithm, policy):
+    """Hashing stages, on a tree written to disk."""
+    root = os.path.join(workdir, 'tree')
+    spec.write(root)
+    for name, run in (('compute_md5', lambda fns, rep: compute_md5(fns, rep, policy = policy)),
+                      ('HashPool', lambda fns, rep: run_pool(fns, rep, hash_workers, policy))):
+        tree_root, sizes, same_size = FSTree(), {}, set()
+        make_fstree(walk_tree(root), tree_root, sizes, same_size)
+        todo = [fn for s in sorted(same_size, reverse = True) if s > 0 for fn in sizes[s]]
+        nfiles, nbytes = len(todo), sum(fn.size for fn in todo)
+        t0 = time.perf_counter()
+        run(todo, RepFile(algorithm = algorithm))
+        elapsed = time.perf_counter() - t0
+        bench.write(name, nfiles, elapsed, bytes = nbytes,
+                    bytes_per_s = round(nbytes/elapsed) if elapsed > 0 else None)
+    shutil.rmtree(root)
+
+
+def run_pool(fns, rep_files, nworkers, policy):
+    pool = HashPool(fns, rep_files, nworkers, policy = policy)
+    pool.start()
+    pool.join()
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd = os.path.dirname(os.path.abspath(__file__)),
+                                       stderr = subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv = None):
+    import argparse
+    parser = argparse.ArgumentParser(description = 'Benchmark tucupi on synthetic file trees.')
+    parser.add_argument('--files', type = int, nargs = '+', default = [10**4, 10**5],
+                        help = 'number of files of each tree (default: %(default)s)')
+    parser.add_argument('--depth', type = int, default = 3)
+    parser.add_argument('--fanout', type = int, default = 10)
+    parser.add_argument('--dist', choices = ('lognormal', 'uniform', 'fixed'), default = 'lognormal',
+                        help = 'file size distribution (default: %(default)s)')
+    parser.add_argument('--median-size', type = int, default = 1024)
+    parser.add_argument('--sigma', type = float, default = 1.5,
+                        help = 'spread of the log-normal distribution (default: %(default)s)')
+    parser.add_argument('--max-size', type = int, default = 1024*1024)
+    parser.add_argument('--dup-ratio', type = float, default = 0.2,
+                        help = 'fraction of files that are copies (default: %(default)s)')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--disk-files', type = int, default = 10**4,
+                        help = 'only write trees up to this many files to disk to benchmark '
+                               'hashing (default: %(default)s)')
+    parser.add_argument('--hash-workers', type = int, default = HASH_WORKERS)
+    parser.add_argument('--algorithm', default = DEFAULT_ALGORITHM, choices = sorted(HASHERS))
+    parser.add_argument('--io-policy', default = IO_POLICY, choices = IO_POLICIES)
+    parser.add_argument('--workdir', default = None,
+                        help = 'where to write temporary files (default: system temporary folder)')
+    parser.add_argument('-o', '--output', default = '-', metavar = 'FILE',
+                        help = 'append results to FILE (default: standard output)')
+    args = parser.parse_args(argv)
+
+    out = sys.stdout if args.output == '-' else open(args.output, 'a')
+    for n in args.files:
+        spec = TreeSpec(n, args.depth, args.fanout, args.dist, args.median_size, args.sigma,
+                        args.max_size, args.dup_ratio, args.seed)
+        common = dict(commit = git_commit(), time = time.time(), python = sys.version.split()[0],
+                      algorithm = args.algorithm, io_policy = args.io_policy)
+        common.update(spec.params())
+        bench = Bench(out, common)
+        metrics.reset()
+        workdir = tempfile.mkdtemp(prefix = 'tucupi_bench', dir = args.workdir)
+        try:
+            bench_memory(spec, bench, workdir, args.algorithm)
+            if n <= args.disk_files:
+                bench_disk(spec, bench, workdir, args.hash_workers, args.algorithm, args.io_policy)
+            snap = metrics.snapshot()
+            bench.write('metrics', n, snap['uptime'], metrics = snap)
+        finally:
+            shutil.rmtree(workdir)
+    if out is not sys.stdout:
+        out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+
+#Copyright 2015,2016,2017 Ubiratan S. Freitas
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Command line front end of tucupi. Runs without GTK, so it can be used
+on headless machines and from cron."""
+
+import os
+import sys
+import json
+import sqlite3
+import threading
+import time
+
+from tucupi_core import (human_size, walk_tree_parallel, make_fstree, FSTree, RepFile,
+                         HashPool, HashCache, default_cache_path, save_state,
+                         WALK_WORKERS, HASH_WORKERS, metrics, HASHERS, DEFAULT_ALGORITHM,
+                         COMPARED_PREFIX, COMPARE_MAX, IO_POLICIES, IO_POLICY,
+                         HASH_ORDERS, HASH_ORDER, restore_state, Deleter, Deduper, DELETE_WORKERS,
+                         DEDUPE_METHODS, Restorer, RESTORE_METHODS)
+
+
+class GroupWriter(object):
+    """Write groups of repeated files as JSON lines, one group per line,
+    flushing after each size so readers see groups as soon as they are
+    final."""
+    def __init__(self, out, rep_files):
+        self.out = out
+        self.rep_files = rep_files
+        self.lock = threading.Lock()
+        self.ngroups = 0
+        self.nfiles = 0
+        self.wasted = 0
+
+    def write_key(self, key):
+        files = self.rep_files.size_md5[key]
+        size, md5 = key
+        #The digest is named after the algorithm, like in the XML log.
+        #Files compared byte by byte have none.
+        compared = md5[:1] == COMPARED_PREFIX
+        group = {'size': size,
+                 self.rep_files.algorithm: md5.decode() if size > 0 and not compared else None,
+                 'files': [os.fsdecode(fn.fpath) for fn in files]}
+        if compared:
+            group['compared'] = True
+        links = {os.fsdecode(fn.fpath): [os.fsdecode(lk.fpath) for lk in fn.links]
+                 for fn in files if fn.links}
+        if links:
+            group['links'] = links
+        self.out.write(json.dumps(group) + '\n')
+        self.ngroups += 1
+        self.nfiles += len(files)
+        self.wasted += size * (len(files) - 1)
+
+    def size_done(self, size):
+        """Write every group of this size. Called by HashPool."""
+        with self.lock:
+            for key in self.rep_files.keys_of_size(size):
+                self.write_key(key)
+            self.out.flush()
+
+
+def scan(args):
+    """Scan the paths, hash files of repeated sizes and write the groups
+    of repeated files as they are confirmed."""
+    tree_root = FSTree()
+    sizes = {}
+    same_size = set()
+    inodes = {}
+    for path in args.paths:
+        print('Scanning path', path, file = sys.stderr)
+        make_fstree(walk_tree_parallel(os.path.abspath(path), args.walk_workers),
+                    tree_root, sizes, same_size, inodes)
+    nfiles = int(tree_root.aggr_attrib[0])
+    print('{} files found, {}'.format(nfiles, human_size(tree_root.aggr_attrib[1])), file = sys.stderr)
+
+    todo = []
+    for s in sorted(same_size, reverse = True):
+        if s > 0 and (args.max_size is None or s <= args.max_size):
+            todo.extend(sizes[s])
+
+    cache = None
+    if not args.no_cache:
+        try:
+            cache = HashCache(args.cache)
+        except (OSError, sqlite3.Error) as err:
+            print('Hash cache disabled: {}'.format(err), file = sys.stderr)
+
+    if args.output == '-':
+        out = sys.stdout
+    else:
+        out = open(args.output, 'w')
+    rep_files = RepFile(algorithm = args.algorithm)
+    writer = GroupWriter(out, rep_files)
+    try:
+        if 0 in same_size:
+            rep_files.add_empty(sizes[0])
+            writer.size_done(0)
+        print('Hashing {} files, {}'.format(len(todo), human_size(sum(fn.size for fn in todo))), file = sys.stderr)
+        pool = HashPool(todo, rep_files, args.hash_workers, cache = cache, size_done = writer.size_done,
+                        compare_max = args.compare_max, policy = args.io_policy,
+                        order = args.hash_order, device_workers = args.device_workers)
+        pool.start()
+        pool.join()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        if cache is not None:
+            cache.close()
+
+    errors = [fn for fn in todo if fn.error is not None]
+    for fn in errors:
+        print('Error reading {}: {}'.format(os.fsdecode(fn.fpath), fn.error), file = sys.stderr)
+    if args.state is not None:
+        save_state(args.state, tree_root, [0], rep_files.algorithm)
+    print('{} groups of repeated files, {} files, {} wasted'.format(
+        writer.ngroups, writer.nfiles, human_size(writer.wasted)), file = sys.stderr)
+    print(metrics.summary(), file = sys.stderr)
+    if args.metrics is not None:
+        metrics.write(args.metrics, event = 'scan', paths = args.paths, groups = writer.ngroups,
+                      errors = len(errors))
+    return 1 if errors else 0
+
+
+def delete(args):
+    """Delete, or deduplicate, the files marked in a state file, journaling
+    every change, and save the updated state. The XML log the graphical
+    interface writes, which restore reads, is written first. Without a
+    state file, only finish the changes left pending in the journal."""
+    if args.state is None and args.journal is None:
+        print('A state file or a journal is needed', file = sys.stderr)
+        return 2
+    if args.journal is not None:
+        journal = args.journal
+    elif args.command == 'dedupe':
+        journal = args.state + '.dedupe.journal'
+    else:
+        journal = args.state + '.journal'
+    tree_root, rep_files, fns = None, None, []
+    if args.state is not None:
+        tree_root = FSTree()
+        rep_files = RepFile()
+        restore_state(args.state, tree_root, rep_files, [0], {}, set(), inodes = {})
+        tree_root.compute_aggr()
+        fns = rep_files.marked_files()
+    log = None
+    if len(fns) > 0:
+        log = args.log
+        if log is None:
+            log = '{}.{}.{}.xml'.format(args.state, time.strftime('%Y%m%d-%H%M%S'), args.command)
+    method = args.method if args.command == 'dedupe' else None
+    try:
+        if log is not None:
+            #Only put in place once the run is accepted
+            rep_files.to_xmlfile(log + '.tmp', args.command, method)
+        if args.command == 'dedupe':
+            deleter = Deduper(fns, rep_files, tree_root, journal, args.workers, verify = not args.no_verify,
+                              policy = args.io_policy, method = args.method)
+        else:
+            deleter = Deleter(fns, rep_files, tree_root, journal, args.workers, verify = args.verify,
+                              policy = args.io_policy)
+        if log is not None:
+            os.replace(log + '.tmp', log)
+    except (OSError, ValueError) as ex:
+        if log is not None and os.path.exists(log + '.tmp'):
+            os.remove(log + '.tmp')
+        print(ex, file = sys.stderr)
+        return 2
+    if log is not None:
+        print('Log of the changes: {}'.format(log), file = sys.stderr)
+    if args.command == 'dedupe':
+        print('Deduplicating {} files, {}'.format(deleter.total, human_size(deleter.total_bytes)), file = sys.stderr)
+    else:
+        print('Deleting {} files, {}'.format(deleter.total, human_size(deleter.total_bytes)), file = sys.stderr)
+    deleter.start()
+    deleter.join()
+    if args.state is not None:
+        save_state(args.state, tree_root, [0], rep_files.algorithm)
+    counts = deleter.counts
+    done = ('deleted', 'reflinked', 'hardlinked')
+    for event in done:
+        if counts[event] > 0:
+            print('{} files {}'.format(counts[event], event), file = sys.stderr)
+    print('{} freed'.format(human_size(deleter.freed)), file = sys.stderr)
+    for event in sorted(counts):
+        if event not in done:
+            print('{} files {}, see {}'.format(counts[event], event, journal), file = sys.stderr)
+    return 1 if counts['failed'] or counts['skipped'] else 0
+
+
+def restore(args):
+    """Recreate the files deleted in an XML log from the copies kept."""
+    journal = args.journal if args.journal is not None else args.log + '.restore'
+    try:
+        restorer = Restorer(args.log, journal, args.workers, verify = not args.no_verify,
+                            policy = args.io_policy, method = args.method)
+    except ValueError as ex:
+        print(ex, file = sys.stderr)
+        return 2
+    restorer.start()
+    restorer.join()
+    print('{} files to restore, {}'.format(restorer.total, human_size(restorer.total_bytes)), file = sys.stderr)
+    if restorer.error is not None:
+        print('Error reading {}: {}'.format(args.log, restorer.error), file = sys.stderr)
+    counts = restorer.counts
+    print('{} files restored'.format(counts['restored']), file = sys.stderr)
+    for event in sorted(counts):
+        if event != 'restored':
+            print('{} files {}, see {}'.format(counts[event], event, journal), file = sys.stderr)
+    return 1 if counts['failed'] or counts['skipped'] or restorer.error is not None else 0
+
+
+def main(argv = None):
+    import argparse
+    parser = argparse.ArgumentParser(description = 'Find duplicated files without the graphical interface.')
+    sub = parser.add_subparsers(dest = 'command')
+    sub.required = True
+    p = sub.add_parser('scan', help = 'scan folders and write groups of repeated files as JSON lines')
+    p.add_argument('paths', nargs = '+', metavar = 'PATH')
+    p.add_argument('-o', '--output', default = '-', metavar = 'FILE',
+                   help = 'where to write the groups (default: standard output)')
+    p.add_argument('--state', default = None, metavar = 'FILE',
+                   help = 'save a state file that can be opened in the graphical interface')
+    p.add_argument('--max-size', type = int, default = None, metavar = 'BYTES',
+                   help = 'do not hash files larger than this')
+    p.add_argument('--walk-workers', type = int, default = WALK_WORKERS,
+                   help = 'threads reading directories (default: %(default)s)')
+    p.add_argument('--hash-workers', type = int, default = HASH_WORKERS,
+                   help = 'threads hashing files (default: %(default)s)')
+    p.add_argument('--cache', default = None, metavar = 'FILE',
+                   help = 'hash cache database (default: {})'.format(default_cache_path()))
+    p.add_argument('--no-cache', action = 'store_true',
+                   help = 'do not use the persistent hash cache')
+    p.add_argument('--metrics', default = None, metavar = 'FILE',
+                   help = 'append timings and throughput to FILE as JSON lines')
+    p.add_argument('--algorithm', default = DEFAULT_ALGORITHM, choices = sorted(HASHERS),
+                   help = 'digest used to compare files (default: %(default)s)')
+    p.add_argument('--compare-max', type = int, default = COMPARE_MAX, metavar = 'N',
+                   help = 'compare files byte by byte instead of hashing them when at most N '
+                          'have the same size, 0 to always hash (default: %(default)s)')
+    p.add_argument('--io-policy', default = IO_POLICY, choices = IO_POLICIES,
+                   help = 'page cache use when hashing: cache, dontneed (drop what was read) '
+                          'or direct (O_DIRECT) (default: %(default)s)')
+    p.add_argument('--hash-order', default = HASH_ORDER, choices = HASH_ORDERS,
+                   help = 'order of the files of each device: largest first, by inode or '
+                          'by physical position (default: %(default)s)')
+    p.add_argument('--device-workers', type = int, default = None, metavar = 'N',
+                   help = 'at most N threads hash files of the same device, e.g. 1 for '
+                          'spinning disks (default: no limit)')
+    p.set_defaults(func = scan)
+    p = sub.add_parser('delete', help = 'delete the files marked in a state file, or resume an '
+                                        'interrupted deletion')
+    p.add_argument('state', nargs = '?', default = None, metavar = 'STATE',
+                   help = 'state file saved by the graphical interface; updated after deleting')
+    p.add_argument('--journal', default = None, metavar = 'FILE',
+                   help = 'journal of the deletions (default: STATE.journal)')
+    p.add_argument('--log', default = None, metavar = 'FILE',
+                   help = 'XML log of the deletions, for restore (default: STATE.TIME.delete.xml)')
+    p.add_argument('--verify', action = 'store_true',
+                   help = 'check the content of each file and of a kept copy before deleting')
+    p.add_argument('--workers', type = int, default = DELETE_WORKERS,
+                   help = 'threads deleting files (default: %(default)s)')
+    p.add_argument('--io-policy', default = IO_POLICY, choices = IO_POLICIES,
+                   help = 'page cache use when verifying (default: %(default)s)')
+    p.set_defaults(func = delete)
+    p = sub.add_parser('dedupe', help = 'replace the files marked in a state file by reflinks or '
+                                        'hard links to a kept copy, or resume an interrupted run')
+    p.add_argument('state', nargs = '?', default = None, metavar = 'STATE',
+                   help = 'state file saved by the graphical interface; updated afterwards')
+    p.add_argument('--journal', default = None, metavar = 'FILE',
+                   help = 'journal of the changes (default: STATE.dedupe.journal)')
+    p.add_argument('--log', default = None, metavar = 'FILE',
+                   help = 'XML log of the changes (default: STATE.TIME.dedupe.xml)')
+    p.add_argument('--method', default = 'auto', choices = DEDUPE_METHODS,
+                   help = 'reflink (share extents), hardlink, or reflink when the file '
+                          'system supports it (default: %(default)s)')
+    p.add_argument('--no-verify', action = 'store_true',
+                   help = 'do not check the content of each file and its copy before linking')
+    p.add_argument('--workers', type = int, default = DELETE_WORKERS,
+                   help = 'threads changing files (default: %(default)s)')
+    p.add_argument('--io-policy', default = IO_POLICY, choices = IO_POLICIES,
+                   help = 'page cache use when verifying (default: %(default)s)')
+    p.set_defaults(func = delete)
+    p = sub.add_parser('restore', help = 'recreate the files deleted in an XML log from the copies kept')
+    p.add_argument('log', metavar = 'LOG', help = 'XML log written when deleting')
+    p.add_argument('--journal', default = None, metavar = 'FILE',
+                   help = 'journal of the restored files, to resume an interrupted run '
+                          '(default: LOG.restore)')
+    p.add_argument('--method', default = 'auto', choices = RESTORE_METHODS,
+                   help = 'reflink (share extents), copy, or reflink when the file system '
+                          'supports it (default: %(default)s)')
+    p.add_argument('--no-verify', action = 'store_true',
+                   help = 'only check sizes, not digests, of the copies and of the new files')
+    p.add_argument('--workers', type = int, default = DELETE_WORKERS,
+                   help = 'threads copying files (default: %(default)s)')
+    p.add_argument('--io-policy', default = IO_POLICY, choices = IO_POLICIES,
+                   help = 'page cache use when verifying (default: %(default)s)')
+    p.set_defaults(func = restore)
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,2860 @@
+#Copyright 2015,2016,2017 Ubiratan S. Freitas
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+# 
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Scanning, hashing and grouping engine of Tucupi. It does not depend
+on GTK, so it can be used by the graphical interface (tucupi.py) as well
+as from the command line (tucupi_cli.py)."""
+
+import threading
+import os
+import hashlib
+import numpy as np
+
+import math
+import time
+import pickle
+import sqlite3
+import queue
+import bisect
+import collections
+import itertools
+import json
+import resource
+import mmap
+import errno
+import io
+import struct
+import stat
+import base64
+import re
+import shutil
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from xml.sax.saxutils import escape
+from xml.etree.ElementTree import iterparse
+
+
+
+def human_size(s,precision = 2):
+    """Return a string representing the size in the smallest binary prefix."""
+    s = int(s)
+    negative = False
+    if s < 0: negative = True
+    s = abs(s)
+    if s == 0:
+        return '0B'
+    pre_val = math.floor(math.log(s)/math.log(1024))
+    bin_prefix = ['', 'Ki', 'Mi', 'Gi', 'Ti', 'Pi', 'Ei', 'Zi', 'Yi']
+    pre_val = min(pre_val, 8)
+    if pre_val > 0:
+        return '{0:.{prec}f}{1}B'.format(s/(1024**pre_val),bin_prefix[pre_val], prec = precision)
+    else:
+        return '{0}B'.format(s)
+
+
+
+#Default number of threads reading directories. One means a sequential walk.
+WALK_WORKERS = 1
+
+def scan_dir(dpath):
+    """Read a single directory. Return a list of records of its regular
+    files (see walk_tree) and a list of its subdirectories."""
+    records = []
+    subdirs = []
+    try:
+        with os.scandir(dpath) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks = False):
+                        subdirs.append(entry.path)
+                    elif entry.is_file(follow_symlinks = False):
+                        st = entry.stat(follow_symlinks = False)
+                        records.append((st.st_size, entry.path, st.st_dev, st.st_ino, st.st_mtime_ns, st.st_nlink))
+                except OSError:
+                    #Entry removed while we were scanning
+                    pass
+    except OSError as err:
+        print('Error reading {}: {}'.format(dpath.decode(errors='replace'), err.strerror))
+    return records, subdirs
+
+def walk_tree(path):
+    """Yield a (size, path, dev, inode, mtime, nlink) record for every 
+    regular file under path, as 'find path -type f' would list them. 
+    Symbolic links are not followed. Paths are bytes and mtime is in 
+    nanoseconds.
+    Directories that can't be read are reported and skipped."""
+    stack = [os.fsencode(path)]
+    while len(stack) > 0:
+        records, subdirs = scan_dir(stack.pop())
+        stack.extend(subdirs)
+        yield from records
+
+def walk_tree_parallel(path, nworkers = WALK_WORKERS):
+    """Like walk_tree, but directories are read concurrently by nworkers
+    threads. This helps on network file systems and very wide trees, where
+    each readdir and stat waits for a round trip. The same records are
+    yielded, records of a directory together, but directories come in no
+    particular order."""
+    if nworkers <= 1:
+        yield from walk_tree(path)
+        return
+    dirs = queue.Queue()
+    out = queue.Queue()
+    lock = threading.Lock()
+    outstanding = [1] #Directories queued but not yet read
+
+    def worker():
+        while True:
+            dpath = dirs.get()
+            if dpath is None:
+                return
+            records, subdirs = scan_dir(dpath)
+            with lock:
+                outstanding[0] += len(subdirs)
+            for sd in subdirs:
+                dirs.put(sd)
+            out.put(records)
+            with lock:
+                outstanding[0] -= 1
+                done = outstanding[0] == 0
+            if done:
+                out.put(None)
+
+    dirs.put(os.fsencode(path))
+    threads = [threading.Thread(target = worker, daemon = True) for k in range(nworkers)]
+    for thr in threads:
+        thr.start()
+    try:
+        while True:
+            records = out.get()
+            if records is None:
+                break
+            yield from records
+    finally:
+        for thr in threads:
+            dirs.put(None)
+
+def parse_find_output(find_output):
+    """Yield records like walk_tree from the output of
+    'find -printf "%s %h/%f\\0"'. Device, inode and mtime are unknown and
+    files are taken as having a single link."""
+    files = find_output.split(b'\x00')
+    for k in files[:-1]:
+        resp = k.partition(b' ')#An espace separates the size from the path
+        yield (int(resp[0]), resp[2], None, None, None, 1)
+
+
+class Finder(threading.Thread):
+    """Walk a folder and add the files found to the file tree while the
+    walk is going on."""
+    def __init__(self, path, tree_root, sizes, same_size, inodes = None, nworkers = WALK_WORKERS):
+        threading.Thread.__init__(self)
+        self.path = path
+        self.nworkers = nworkers
+        self.tree_root = tree_root
+        self.sizes = sizes
+        self.same_size = same_size
+        self.inodes = inodes
+        self.nfiles = 0
+
+    def records(self):
+        for rec in walk_tree_parallel(self.path, self.nworkers):
+            self.nfiles += 1
+            yield rec
+
+    def run(self):
+        make_fstree(self.records(), self.tree_root, self.sizes, self.same_size, self.inodes)
+
+
+
+class Metrics(object):
+    """Counters and timings of the pipeline, shared by all threads.
+    Counters are plain sums (files and bytes walked or hashed). Timings
+    keep the number of samples, their total and the largest one. Stages
+    (walk, hash) are timings too, their running time included while
+    they are in progress."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.t0 = time.time()
+            self.counters = collections.Counter()
+            self.timings = {}
+            self.running = {}
+
+    def add(self, **values):
+        with self.lock:
+            self.counters.update(values)
+
+    def observe(self, name, seconds):
+        with self.lock:
+            t = self.timings.setdefault(name, [0, 0.0, 0.0])
+            t[0] += 1
+            t[1] += seconds
+            t[2] = max(t[2], seconds)
+
+    def start(self, stage):
+        with self.lock:
+            self.running.setdefault(stage, [time.perf_counter(), 0])[1] += 1
+
+    def stop(self, stage):
+        with self.lock:
+            r = self.running[stage]
+            r[1] -= 1
+            if r[1] > 0:
+                return
+            del self.running[stage]
+        self.observe(stage, time.perf_counter() - r[0])
+
+    def elapsed(self, stage):
+        """Time spent in a stage so far."""
+        with self.lock:
+            total = self.timings.get(stage, [0, 0.0, 0.0])[1]
+            if stage in self.running:
+                total += time.perf_counter() - self.running[stage][0]
+        return total
+
+    def rate(self, stage, counter):
+        """Counter value per second of the stage."""
+        t = self.elapsed(stage)
+        return self.counters[counter] / t if t > 0 else 0.0
+
+    def snapshot(self):
+        """All metrics as a dict that can be dumped as JSON."""
+        stages = ('walk', 'hash')
+        snap = {'time': time.time(), 'uptime': time.time() - self.t0,
+                'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+        with self.lock:
+            snap['counters'] = dict(self.counters)
+            snap['timings'] = {k: {'count': v[0], 'total': v[1], 'max': v[2]} for k, v in self.timings.items()}
+        for s in stages:
+            snap['timings'].setdefault(s, {'count': 0, 'total': 0.0, 'max': 0.0})['total'] = self.elapsed(s)
+            snap[s + '_files_per_s'] = self.rate(s, s + '_files')
+            snap[s + '_bytes_per_s'] = self.rate(s, s + '_bytes')
+        return snap
+
+    def write(self, fpath, **extra):
+        """Append a snapshot to fpath as a JSON line."""
+        snap = self.snapshot()
+        snap.update(extra)
+        with open(fpath, 'a') as f:
+            f.write(json.dumps(snap) + '\n')
+
+    def summary(self):
+        """Short text for the status bar."""
+        lock = self.timings.get('RepFile.lock', [0, 0.0, 0.0])
+        model = self.timings.get('update_model', [0, 0.0, 0.0])
+        return 'walk {:.0f} files/s, hash {:.0f} files/s {}/s, lock held {:.1f}s, model update {:.0f}ms max, RSS {}'.format(
+            self.rate('walk', 'walk_files'), self.rate('hash', 'hash_files'),
+            human_size(self.rate('hash', 'hash_bytes')), lock[1], model[2]*1000,
+            human_size(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024))
+
+#Metrics of this process
+metrics = Metrics()
+
+
+class TimedRLock(object):
+    """Reentrant lock that adds the time it is held to metrics, under its
+    name. Nested acquisitions by the owner are counted once."""
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.RLock()
+        self.depth = 0
+        self.t0 = 0.0
+
+    def __enter__(self):
+        self.lock.acquire()
+        self.depth += 1
+        if self.depth == 1:
+            self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.depth -= 1
+        if self.depth == 0:
+            metrics.observe(self.name, time.perf_counter() - self.t0)
+        self.lock.release()
+
+
+#Digest algorithms by name. Each value makes a new hashlib-like object.
+HASHERS = {
+    'md5': hashlib.md5,
+    'sha1': hashlib.sha1,
+    'sha256': hashlib.sha256,
+    'blake2b': hashlib.blake2b,
+    'blake2s': hashlib.blake2s,
+}
+try:
+    import xxhash
+except ImportError:
+    pass
+else:
+    #Not cryptographic, but much faster when only accidental matches matter
+    for name in ('xxh3_128', 'xxh64'):
+        if hasattr(xxhash, name):
+            HASHERS[name] = getattr(xxhash, name)
+
+#Algorithm used when none is chosen, and assumed for older state files
+DEFAULT_ALGORITHM = 'md5'
+
+def register_hasher(name, factory):
+    """Make a digest algorithm available. factory() must return an object
+    with the update and hexdigest methods of hashlib objects. The name
+    becomes an attribute name in XML logs, so it must be an XML name
+    (letters, digits, '_', '-' and '.', not starting with a digit, '-' or
+    '.') other than those of the other attributes there. Raise ValueError
+    if not."""
+    if not re.fullmatch('[A-Za-z_][0-9A-Za-z_.-]*', name) or name in ('size', 'compared'):
+        raise ValueError('Invalid digest algorithm name {!r}'.format(name))
+    HASHERS[name] = factory
+
+def check_algorithm(name):
+    """Return name if it is a known algorithm. Raise ValueError if not."""
+    if name not in HASHERS:
+        raise ValueError('Unknown digest algorithm {}. Choose one of {}'.format(name, ', '.join(sorted(HASHERS))))
+    return name
+
+
+#Columns of FSTree.aggr_attrib
+AGGR_FILES, AGGR_SIZE, AGGR_REPEATED, AGGR_REPSIZE, AGGR_MARKED, AGGR_KEPT, AGGR_LINKS = range(7)
+
+#Guards FSTree aggregates and the FNode flags they are computed from
+aggr_lock = threading.RLock()
+
+#Bits of FNode._flags
+FLAG_MARKED, FLAG_KEPT, FLAG_REPEATED = 1, 2, 4
+
+
+class FNode(object):
+    """Class to hold file specific data and state.
+
+    Changes of the marked, kept and repeated flags of a node that is in
+    a FSTree are propagated at once to the aggregates of its branch and
+    of every branch above it.
+
+    There is one node per file, so they are kept small: attributes are
+    slots, the flags are packed in one integer and the path is not 
+    stored. Once in a FSTree, a node only keeps its name (the same object
+    used as key in FSTree.leaves) and fpath is rebuilt from its branch."""
+    __slots__ = ('_name', 'md5', 'partial', 'size', 'dev', 'ino', 'mtime', 'nlink',
+                 'link_of', 'links', 'branch', 'rep', '_flags', 'error')
+    #Order of the fields in the state tuple. New fields are only appended,
+    #so states saved by older versions can still be restored.
+    state_fields = ('fpath', 'md5', 'size', 'marked', 'kept', 'repeated', 'partial',
+                    'dev', 'ino', 'mtime', 'nlink')
+
+    def __init__(self,fpath,size,dev = None,ino = None,mtime = None,nlink = 1):
+        self.branch = None #FSTree holding this node
+        self.rep = None #RepFile grouping this node
+        self._name = fpath #Full path until the node is added to a tree
+        self.md5 = None
+        self.partial = None #Digest of a few blocks of the file
+        self.size = size
+        self.dev = dev
+        self.ino = ino
+        self.mtime = mtime #In nanoseconds
+        self.nlink = nlink
+        #Hard links: the first node found for an inode is its primary and
+        #holds the list of the other links. Only primaries are hashed and
+        #can be repeated.
+        self.link_of = None
+        self.links = None
+        self._flags = 0
+        self.error = None
+
+    @property
+    def fpath(self):
+        if self.branch is None:
+            return self._name
+        return self.branch.path + b'/' + self._name
+
+    @fpath.setter
+    def fpath(self, value):
+        """Only meaningful before the node is added to a tree."""
+        self._name = value
+
+    def _set_flag(self, bit, col, value):
+        with aggr_lock:
+            old = self._flags
+            if bool(old & bit) == bool(value):
+                return
+            self._flags ^= bit
+            if self.branch is not None:
+                delta = 1 if value else -1
+                self.branch.add_aggr(col, delta)
+                if col == AGGR_REPEATED:
+                    self.branch.add_aggr(AGGR_REPSIZE, delta*self.size)
+        if self.rep is not None and bit != FLAG_REPEATED:
+            self.rep.flags_changed(self, old)
+
+    @property
+    def marked(self):
+        return bool(self._flags & FLAG_MARKED)
+
+    @marked.setter
+    def marked(self, value):
+        self._set_flag(FLAG_MARKED, AGGR_MARKED, value)
+
+    @property
+    def kept(self):
+        return bool(self._flags & FLAG_KEPT)
+
+    @kept.setter
+    def kept(self, value):
+        self._set_flag(FLAG_KEPT, AGGR_KEPT, value)
+
+    @property
+    def repeated(self):
+        return bool(self._flags & FLAG_REPEATED)
+
+    @repeated.setter
+    def repeated(self, value):
+        self._set_flag(FLAG_REPEATED, AGGR_REPEATED, value)
+
+    def aggr_values(self):
+        """Contribution of this node to the aggregates of its branch."""
+        flags = self._flags
+        rep = 1 if flags & FLAG_REPEATED else 0
+        return [1, self.size, rep, rep*self.size, 1 if flags & FLAG_MARKED else 0,
+                1 if flags & FLAG_KEPT else 0, int(self.link_of is not None)]
+
+    def get_state(self):
+        """Ruturns a tuple with the instance's state."""
+        return tuple(getattr(self, name) for name in self.state_fields)
+
+    def set_state(self, state):
+        """Set the instance's state. Does NOT verify invariants."""
+        for name, value in zip(self.state_fields, state):
+            setattr(self, name, value)
+
+    
+    def mark(self,rep_file):
+        """Mark itself to be deleted."""
+        if self.repeated and not self.kept and not self.marked:
+            rep_file.toggle_mark(self)
+            
+    def keep(self):
+        """Mark itself to be kept. It is unmarked for deletion and can not be marked."""
+        self.marked = False
+        self.kept = True
+
+    def add_link(self, fn):
+        """Make fn an extra hard link of this node's inode."""
+        with aggr_lock:
+            fn.link_of = self
+            if fn.branch is not None:
+                fn.branch.add_aggr(AGGR_LINKS, 1)
+        #Only the primary is grouped, so the flags of the link move to it
+        if fn.repeated:
+            fn.repeated = False
+            self.repeated = True
+        if fn.marked:
+            fn.marked = False
+            if self.repeated and not self.kept:
+                self.marked = True
+        fn.md5 = self.md5
+        fn.partial = self.partial
+        if self.links is None:
+            self.links = []
+        self.links.append(fn)
+
+    def label(self):
+        """Path to show in the repeated files' TreeView."""
+        name = self.fpath.decode(errors='replace')
+        if self.links:
+            name = '{} (+{} hard links)'.format(name, len(self.links))
+        return name
+        
+
+
+class SortedKeys(object):
+    """Sorted collection of unique keys, kept as a list of sorted blocks
+    of at most 2*load keys. Adding or removing a key costs a binary search
+    and moving part of one block. Rank lookups and slices use the block
+    offsets, which are recomputed only after the collection changes."""
+    def __init__(self, keys = (), load = 1000):
+        self.load = load
+        keys = sorted(keys)
+        self.blocks = [keys[k:k+load] for k in range(0, len(keys), load)]
+        self.maxes = [b[-1] for b in self.blocks]
+        self.length = len(keys)
+        self.offsets = None
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for b in self.blocks:
+            yield from b
+
+    def __reversed__(self):
+        for b in reversed(self.blocks):
+            yield from reversed(b)
+
+    def add(self, key):
+        """Add a key that is not yet present."""
+        self.offsets = None
+        self.length += 1
+        if len(self.blocks) == 0:
+            self.blocks.append([key])
+            self.maxes.append(key)
+            return
+        i = bisect.bisect_left(self.maxes, key)
+        if i == len(self.maxes):
+            #Largest key so far
+            i -= 1
+            self.blocks[i].append(key)
+            self.maxes[i] = key
+        else:
+            bisect.insort(self.blocks[i], key)
+        block = self.blocks[i]
+        if len(block) > 2*self.load:
+            self.blocks[i:i+1] = [block[:self.load], block[self.load:]]
+            self.maxes[i:i+1] = [block[self.load-1], block[-1]]
+
+    def discard(self, key):
+        """Remove a key if present. Return whether it was."""
+        i = bisect.bisect_left(self.maxes, key)
+        if i == len(self.maxes):
+            return False
+        block = self.blocks[i]
+        j = bisect.bisect_left(block, key)
+        if j == len(block) or block[j] != key:
+            return False
+        del block[j]
+        if len(block) == 0:
+            del self.blocks[i]
+            del self.maxes[i]
+        else:
+            self.maxes[i] = block[-1]
+        self.length -= 1
+        self.offsets = None
+        return True
+
+    def _offsets(self):
+        if self.offsets is None:
+            offsets = [0]
+            for b in self.blocks:
+                offsets.append(offsets[-1] + len(b))
+            self.offsets = offsets
+        return self.offsets
+
+    def index(self, key):
+        """Rank of the key in ascending order. Raise ValueError if it is
+        not present."""
+        i = bisect.bisect_left(self.maxes, key)
+        if i < len(self.maxes):
+            block = self.blocks[i]
+            j = bisect.bisect_left(block, key)
+            if j < len(block) and block[j] == key:
+                return self._offsets()[i] + j
+        raise ValueError('{} not in SortedKeys'.format(key))
+
+    def slice(self, start, stop):
+        """Keys with ranks from start to stop (excluded), in ascending order."""
+        start = max(start, 0)
+        stop = min(stop, self.length)
+        offsets = self._offsets()
+        keys = []
+        i = bisect.bisect_right(offsets, start) - 1
+        while start < stop:
+            j = start - offsets[i]
+            part = self.blocks[i][j:j + stop - start]
+            keys.extend(part)
+            start += len(part)
+            i += 1
+        return keys
+
+    def slice_desc(self, start, stop):
+        """Like slice, with ranks taken in descending order."""
+        n = self.length
+        keys = self.slice(n - stop, n - start)
+        keys.reverse()
+        return keys
+
+    def __contains__(self, key):
+        i = bisect.bisect_left(self.maxes, key)
+        if i == len(self.maxes):
+            return False
+        block = self.blocks[i]
+        j = bisect.bisect_left(block, key)
+        return j < len(block) and block[j] == key
+
+    def rank(self, key):
+        """Number of keys smaller than key."""
+        i = bisect.bisect_left(self.maxes, key)
+        if i == len(self.maxes):
+            return self.length
+        return self._offsets()[i] + bisect.bisect_left(self.blocks[i], key)
+
+    def index_desc(self, key):
+        """Rank of the key in descending order."""
+        return self.length - 1 - self.index(key)
+
+
+#Characters that can't be in XML text, or would not be read back as is
+_XML_UNSAFE = re.compile('[^\t\n\x20-\ud7ff\ue000-\ufffd\U00010000-\U0010ffff]')
+
+def xml_attr(value):
+    """Quoted attribute value, escaped as minidom does."""
+    return '"' + escape(value, {'"': '&quot;'}) + '"'
+
+def xml_path(tag, fpath):
+    """XML element holding a path. Paths that are not UTF-8, or hold
+    characters XML can't carry, are written in base64 with the attribute
+    encoding="base64", so they can be read back exactly (see
+    xml_read_path)."""
+    try:
+        text = fpath.decode()
+    except UnicodeDecodeError:
+        text = None
+    if text is None or _XML_UNSAFE.search(text):
+        return '<{0} encoding="base64">{1}</{0}>'.format(tag, base64.b64encode(fpath).decode())
+    return '<{0}>{1}</{0}>'.format(tag, escape(text, {'"': '&quot;'}))
+
+def xml_read_path(elem):
+    """Path held by an element written by xml_path, as bytes."""
+    if elem.get('encoding') == 'base64':
+        return base64.b64decode(elem.text or '')
+    return (elem.text or '').encode()
+
+def _unmarked_counts(flags):
+    """Contribution of a file with these flags to the counters of its
+    group: whether it is unmarked, and whether it is unmarked and not kept."""
+    unmarked = 0 if flags & FLAG_MARKED else 1
+    return unmarked, (0 if flags & FLAG_KEPT else unmarked)
+
+
+class RepFile(object):
+    """Class holding the list of repeated files. It decides if a file
+    is repeated, controls which files are marked for deletion, and 
+    records the groups changed since the repeated files' TreeView was
+    last updated (see take_changes).
+
+    For every group the number of unmarked files, and of unmarked files
+    not kept, is kept up to date as files are marked or kept (FNode
+    reports its changes through flags_changed). The groups that are not
+    processed are thus always known and the filters cost nothing.
+
+    Keys are (size, digest), all digests computed with algorithm. Files
+    compared directly (see compare_files) have a pseudo digest instead,
+    see compared_digest."""
+    def __init__(self,algorithm = DEFAULT_ALGORITHM):
+        self.lock = TimedRLock('RepFile.lock')
+        self.algorithm = check_algorithm(algorithm)
+        self.size_md5 = {}
+        self.repeated = set()
+        self.index = SortedKeys() #Sorted self.repeated
+        self.counts = {} #[unmarked, unmarked and not kept] per key
+        self.not_processed = SortedKeys() #Repeated with two or more unmarked
+        self.not_processed_kept = SortedKeys() #Same, ignoring kept files
+        self.filtered = self.index
+        self.compared = collections.defaultdict(set) #Pseudo digest keys per size
+        self.hashed = collections.Counter() #Keys with a real digest per size
+        self.remark = set() #Files taken back by take_compared while marked
+        self.filters = {'NotProcessed':None, 'NotProcessedKept':None}
+        self.changes = None #Keys of the groups changed, once tracked
+        
+    def add_fn(self,fn):
+        """Add a file node to the list, decide if it is repeated, and 
+        update the list of repeated files."""
+        with self.lock:
+            self._add_fn(fn)
+
+    def add_fns(self,fns):
+        """Add several file nodes at once, taking the lock only once."""
+        with self.lock:
+            for fn in fns:
+                self._add_fn(fn)
+
+    def _add_fn(self,fn):
+        """This function should only be called from inside a with lock block"""
+        if fn.md5 is None:
+            raise ValueError('md5sum not present')
+        key = (fn.size,fn.md5)
+        fn.rep = self
+        unmarked, free = _unmarked_counts(fn._flags)
+        if key not in self.size_md5:
+            self.size_md5[key] = [fn]
+            self.counts[key] = [unmarked, free]
+            if is_compared(fn):
+                self.compared[fn.size].add(key)
+            else:
+                self.hashed[fn.size] += 1
+        else:
+            counts = self.counts[key]
+            counts[0] += unmarked
+            counts[1] += free
+            fn.repeated = True
+            self.size_md5[key].append(fn)
+            if len(self.size_md5[key]) == 2:
+                self.repeated.add(key)
+                self.index.add(key)
+                #If this is the second file added, the fist one with
+                #this size and md5 is also repeated and should be 
+                #marked as so
+                self.size_md5[key][0].repeated = True
+            self._update_processed(key)
+            if self.remark:
+                self._remark(key)
+        if fn.links:
+            for lk in fn.links:
+                lk.md5 = fn.md5
+        
+
+    def _remark(self,key):
+        """Mark again the files of a group that were marked when
+        take_compared took them, as long as a copy stays unmarked. This
+        function should only be called from inside a with lock block"""
+        for fn in self.size_md5[key]:
+            if fn in self.remark and not fn.kept and self.counts[key][0] > 1:
+                self.remark.discard(fn)
+                fn.marked = True
+
+    def remove_fn(self,fn):
+        """Take a file node out of its group, unmarking it. A file left
+        alone in its group is no longer repeated, and is unmarked too."""
+        with self.lock:
+            self._remove_fn(fn)
+
+    def _remove_fn(self,fn):
+        """This function should only be called from inside a with lock block"""
+        key = (fn.size,fn.md5)
+        files = self.size_md5[key]
+        fn.marked = False
+        self.remark.discard(fn)
+        unmarked, free = _unmarked_counts(fn._flags)
+        counts = self.counts[key]
+        counts[0] -= unmarked
+        counts[1] -= free
+        files.remove(fn)
+        fn.repeated = False
+        fn.rep = None
+        if len(files) == 0:
+            self._changed(key)
+            del self.size_md5[key]
+            del self.counts[key]
+            if is_compared(fn):
+                self.compared[fn.size].discard(key)
+                if len(self.compared[fn.size]) == 0:
+                    del self.compared[fn.size]
+            else:
+                self.hashed[fn.size] -= 1
+                if self.hashed[fn.size] == 0:
+                    del self.hashed[fn.size]
+        elif len(files) == 1:
+            #A single copy must never stay marked
+            files[0].marked = False
+            files[0].repeated = False
+            self._changed(key)
+            self.repeated.discard(key)
+            self.index.discard(key)
+            self.not_processed.discard(key)
+            self.not_processed_kept.discard(key)
+        else:
+            self._update_processed(key)
+
+    def has_digests(self,size):
+        """Whether files of this size were grouped by a real digest."""
+        with self.lock:
+            return self.hashed[size] > 0
+
+    def take_compared(self,size):
+        """Remove the compared files of this size from their groups and
+        forget their pseudo digests. Return them. Files that were marked
+        are marked again once they are back in a group with an unmarked
+        copy (see _remark)."""
+        fns = []
+        with self.lock:
+            for key in list(self.compared.get(size, ())):
+                files = list(self.size_md5[key])
+                marked = [fn for fn in files if fn.marked]
+                for fn in files:
+                    self._remove_fn(fn)
+                    fn.md5 = None
+                    for lk in fn.links or ():
+                        lk.md5 = None
+                    fns.append(fn)
+                self.remark.update(marked)
+        return fns
+
+    def add_empty(self,empty_files):
+        """Add list of empty files to the repeated files."""
+        with self.lock:
+            key = (0, b'empty_file')
+            if key not in self.repeated:
+                self.repeated.add(key)
+                self.index.add(key)
+            self.size_md5[key] = empty_files.copy()
+            self.hashed[0] = 1
+            counts = [0, 0]
+            for fn in self.size_md5[key]:
+                fn.md5 = key[1]
+                fn.repeated = True
+                fn.rep = self
+                unmarked, free = _unmarked_counts(fn._flags)
+                counts[0] += unmarked
+                counts[1] += free
+            self.counts[key] = counts
+            self._update_processed(key)
+
+    def flags_changed(self,fn,old_flags):
+        """Update the counters of the file's group after its marked or kept 
+        flag changed from old_flags."""
+        key = (fn.size,fn.md5)
+        old_unmarked, old_free = _unmarked_counts(old_flags)
+        unmarked, free = _unmarked_counts(fn._flags)
+        with self.lock:
+            counts = self.counts.get(key)
+            if counts is None:
+                return
+            counts[0] += unmarked - old_unmarked
+            counts[1] += free - old_free
+            self._update_processed(key)
+
+    def _update_processed(self,key):
+        """Move a repeated group in or out of the not processed indexes.
+        This function should only be called from inside a with lock block"""
+        if key not in self.repeated:
+            return
+        self._changed(key)
+        counts = self.counts[key]
+        for index, count in ((self.not_processed, counts[0]), (self.not_processed_kept, counts[1])):
+            if count >= 2:
+                if key not in index:
+                    index.add(key)
+            else:
+                index.discard(key)
+
+    def _changed(self,key):
+        """This function should only be called from inside a with lock block"""
+        if self.changes is not None:
+            self.changes.add(key)
+
+    def take_changes(self):
+        """Keys of the groups that changed since the last call: files added
+        or removed, marked or kept, or the group became repeated or not.
+        Changes are only recorded after a first call."""
+        with self.lock:
+            changes = self.changes
+            self.changes = set()
+        return changes
+
+    def _is_processed(self,key):
+        """Whether all but at most one file of the group are marked."""
+        return self.counts[key][0] <= 1
+
+    def not_processed_filter(self):
+        """Sorted repeated files where more than one copy is unmarked"""
+        return self.not_processed
+
+    def not_processed_kept_filter(self):
+        """Sorted repeated files where more than one copy not kept is unmarked"""
+        return self.not_processed_kept
+
+
+    def update_filter(self):
+        """Update list of files to show."""
+        active = [f() for f in self.filters.values() if f is not None]
+        if len(active) == 0:
+            self.filtered = self.index
+        else:
+            #The filters are nested (a group processed is also processed
+            #ignoring kept files), so the smallest is their intersection
+            self.filtered = min(active, key = len)
+
+    def clear_filters(self):
+        """Clear all filters"""
+        for k in self.filters.keys():
+            self.filters[k] = None
+        
+
+
+    def is_processed(self,key):
+        """Like _is_processed, False for groups that are gone."""
+        with self.lock:
+            return key in self.counts and self._is_processed(key)
+
+    def keys_of_size(self,size):
+        """Sorted keys of the repeated files with this size."""
+        with self.lock:
+            return self.index.slice(self.index.rank((size, b'')), self.index.rank((size + 1, b'')))
+
+    def toggle_mark(self,fn):
+        key = (fn.size,fn.md5)
+        fl = self.size_md5[key]
+        ind = fl.index(fn)#TODO:possible unused
+        if fn.marked:
+            fn.marked = False
+            return True
+        else:
+            if fn.kept:
+                return False
+            allmarked = True
+            with self.lock:
+                for k in fl:
+                    if k is not fn:
+                        allmarked = allmarked and k.marked
+            if allmarked:
+                return False
+            else:
+                fn.marked = True
+                return True
+                
+    def mark_others(self, fn):
+        """Unmark this file and try to mark for deletion all the other copies of it."""
+        key = (fn.size, fn.md5)
+        with self.lock:
+            fl = self.size_md5[key]
+            fn.marked = False
+            for k in fl:
+                #We know that at least one file is not marked so we can go ahead and mark everything
+                if not k.kept and k is not fn:
+                    k.marked = True
+
+    def marked_files(self):
+        """Marked files, largest first."""
+        with self.lock:
+            return [fn for key in reversed(self.index) for fn in self.size_md5[key] if fn.marked]
+
+    def copies(self,fn):
+        """The other files of the group of a file."""
+        with self.lock:
+            return [g for g in self.size_md5.get((fn.size,fn.md5), ()) if g is not fn]
+                    
+    def to_xmlfile(self,fname,action = 'delete',method = None):
+        """Write the marked groups, with the files to be deleted, or
+        deduplicated, and the ones kept. Elements are written as each
+        group is read, taking the lock for one group at a time, in the
+        layout toprettyxml gave to older logs. Paths that are not valid
+        UTF-8 text are written in base64 (see xml_path)."""
+        marked_tag = 'deduped' if action == 'dedupe' else 'deleted'
+        attrs = [('algorithm', self.algorithm)]
+        if action == 'dedupe':
+            attrs += [('action', action), ('method', method)]
+        root = '<data' + ''.join(' {}={}'.format(k, xml_attr(v)) for k, v in attrs)
+        with self.lock:
+            keys = list(reversed(self.index))
+        with open(fname, 'wt', encoding = 'utf-8') as f:
+            f.write('<?xml version="1.0" ?>\n')
+            empty = True
+            for key in keys:
+                with self.lock:
+                    fn_list = self.size_md5.get(key, ())
+                    if not any(fn.marked for fn in fn_list):
+                        continue
+                    files = [(marked_tag if fn.marked else 'kept', fn.fpath) for fn in fn_list]
+                if empty:
+                    f.write(root + '>\n')
+                    empty = False
+                if key[1][:1] == COMPARED_PREFIX:
+                    #Compared byte by byte, there is no digest
+                    f.write('    <file compared="true" size="{}">\n'.format(key[0]))
+                else:
+                    #Named after the algorithm, md5 for older logs
+                    f.write('    <file {}={} size="{}">\n'.format(
+                        self.algorithm, xml_attr(key[1].decode(errors='replace')), key[0]))
+                for tag, fpath in files:
+                    f.write('        ' + xml_path(tag, fpath) + '\n')
+                f.write('    </file>\n')
+            f.write(root + '/>\n' if empty else '</data>\n')
+        
+                        
+
+
+
+
+class FSTree(object):
+    """Holds a file system tree. Every file found in a scan is represented
+    here. Keeps a reference to every file node. Enforces that a unique 
+    path corresponds to a unique file and a unique file node. Every 
+    subtree is also a FSTree instance and most methods operate recursively.
+
+    Aggregates are kept up to date incrementally: flag changes of file
+    nodes update their branch and its ancestors (see FNode). New leaves are
+    only accounted for by compute_aggr, which is run after adding files in
+    bulk."""
+    __slots__ = ('branches', 'leaves', 'path', 'parent', 'shown', 'aggr_attrib')
+
+    def __init__(self,path = b'',parent = None):
+        self.branches = {} #Subtrees. Also FSTree instances
+        self.leaves = {}
+        self.path = path
+        self.parent = parent
+        self.shown = None
+        #Number of files, size, repeated files, size of repeated files,
+        #marked, kept and extra hard links
+        self.aggr_attrib = np.zeros((7,),dtype = np.int64)
+
+    def attach_leaf(self,name,fn):
+        """Add a file node directly to this branch. Return False if a file 
+        with this name is already there."""
+        if self.leaves.setdefault(name,fn) is not fn:
+            return False
+        #From now on fn.fpath is derived from the branch
+        fn._name = name
+        fn.branch = self
+        return True
+        
+    def remove_leaf(self,fn):
+        """Remove a file node from this branch and its contribution from
+        the aggregates. Return False if it is not there."""
+        with aggr_lock:
+            if self.leaves.get(fn._name) is not fn:
+                return False
+            fpath = fn.fpath
+            values = fn.aggr_values()
+            del self.leaves[fn._name]
+            fn.branch = None
+            fn._name = fpath
+            for col, value in enumerate(values):
+                if value != 0:
+                    self.add_aggr(col, -value)
+        return True
+
+    def add_leaf(self,leaf_path,leaf_attib):
+        """Add a leaf to the tree. Enforce unicity of files and create
+        subtrees as needed"""
+        p = leaf_path.partition(b'/')
+        if p[1] == b'': 
+            #Leaf. Fails if the file was already added
+            return self.attach_leaf(p[0],leaf_attib)
+        elif len(p[0]) == 0:
+            #root node
+            return self.add_leaf(p[2],leaf_attib)
+        else:
+            assert len(p[2]) >0, 'Empty leaf inserted'
+            if p[0] not in self.branches:
+                self.branches[p[0]] = FSTree(path = self.path + b'/' + p[0], parent = self)
+            return self.branches[p[0]].add_leaf(p[2],leaf_attib)
+
+    def make_branch(self,branch_path):
+        """Get the branch corresponding to the path, creating it and the
+        subtrees above it as needed."""
+        p = branch_path.partition(b'/')
+        if len(p[0]) == 0:
+            #root node
+            return self.make_branch(p[2]) if len(p[2]) > 0 else self
+        if p[0] not in self.branches:
+            self.branches[p[0]] = FSTree(path = self.path + b'/' + p[0], parent = self)
+        br = self.branches[p[0]]
+        return br.make_branch(p[2]) if len(p[2]) > 0 else br
+
+    
+    def add_aggr(self,col,value):
+        """Add value to an aggregate column of this branch and of all the
+        branches above it."""
+        with aggr_lock:
+            br = self
+            while br is not None:
+                br.aggr_attrib[col] += value
+                br = br.parent
+
+    def compute_aggr(self):
+        """Recompute aggregate values for the branch from scratch. The 
+        difference is also applied to the branches above it."""
+        with aggr_lock:
+            old = self.aggr_attrib.copy()
+            self._compute_aggr()
+            br = self.parent
+            while br is not None:
+                br.aggr_attrib += self.aggr_attrib - old
+                br = br.parent
+
+    def _compute_aggr(self):
+        self.aggr_attrib[:] = 0
+        for bname,br in self.branches.items():
+            br._compute_aggr()
+            self.aggr_attrib += br.aggr_attrib
+
+        total = [0]*len(self.aggr_attrib)
+        for lname,lf in self.leaves.items():
+            for k, v in enumerate(lf.aggr_values()):
+                total[k] += v
+        self.aggr_attrib += np.array(total, dtype = np.int64)
+            
+            
+    def get_branch(self,branch_path):
+        """Get the branch (a FSTree instance) corresponding to the path."""
+        p = branch_path.partition(b'/')
+        if  len(p[0]) == 0:
+            #root node
+            if p[1] == b'/':
+                return self.get_branch(p[2])
+            else:
+                return self
+                
+        elif p[1] == b'' or p[2] == b'': 
+            return self.branches[p[0]]
+        
+        else:
+            return self.branches[p[0]].get_branch(p[2])
+
+    def get_leaf(self,leaf_path):
+        p = leaf_path.partition(b'/')
+        if  len(p[0]) == 0:
+            #root node
+            return self.get_leaf(p[2])
+        elif p[1] == b'': 
+            #Leaf
+            return self.leaves[p[0]]#Will fail looking for a file that isn't there
+        else:
+            assert len(p[2]) >0, 'Trying to get an empty leaf'
+            return self.branches[p[0]].get_leaf(p[2])
+
+    def get_index(self,ind):
+        """Return an element (a branch or FNode) corresponding to the 
+        position in the shown list."""
+        return self.shown[ind]
+
+    
+    def list_children(self):
+        """List the subbranches, then the files, of this branch, keeping the
+        list for get_index. Nothing is read from the elements, so it costs
+        a copy of the references."""
+        #Lists are copied because a Finder may be adding to the tree
+        self.shown = list(self.branches.values())
+        self.shown.extend(self.leaves.values())
+        return self.shown
+
+    def name(self):
+        """Last component of the path."""
+        return self.path.rpartition(b'/')[2]
+    
+    def get_keys(self,keys = None):
+        """Get all the keys ((size,md5)) of this subtree recursively."""
+        if keys is None:
+            keys = set()
+
+        for br in self.branches.values():
+            br.get_keys(keys)
+        for fn in self.leaves.values():
+            if fn.md5 is not None:
+                keys.add((fn.size,fn.md5))
+        return keys
+        
+    def mark_all(self,rep_file):
+        """Mark recursively all repeated files in this subtree to be deleted."""
+        for fn in self.leaves.values():
+            fn.mark(rep_file)
+        for br in self.branches.values():
+            br.mark_all(rep_file)
+
+    def unmark_all(self):
+        """Remove deleted flag recursively from all files in this subtree."""
+        for fn in self.leaves.values():
+            fn.marked = False
+        for br in self.branches.values():
+            br.unmark_all()
+
+    def keep_all(self):
+        """Mark recursively all files in this subtree to be kept."""
+        for fn in self.leaves.values():
+            fn.keep()
+        for br in self.branches.values():
+            br.keep_all()
+
+    def unkeep_all(self):
+        """Remove kept flag recursively from all files in this subtree."""
+        for fn in self.leaves.values():
+            fn.kept = False
+        for br in self.branches.values():
+            br.unkeep_all()
+
+    def mark_others(self,rep_file):
+        """Mark for deletion all the other copies of  all files in this subtree."""
+        for fn in self.leaves.values():
+            if fn.repeated:
+                rep_file.mark_others(fn)
+        for br in self.branches.values():
+            br.mark_others(rep_file)
+            
+    def iter_branches(self):
+        """Iterate over this branch and all its subtrees."""
+        stack = [self]
+        while len(stack) > 0:
+            br = stack.pop()
+            yield br
+            stack.extend(br.branches.values())
+
+
+    
+        
+        
+    def print(self,fill = ''):
+        """Old debug printing method. Probable does not work anymore."""
+        first = True
+        for bname,br in self.branches.items():
+            if not first:
+                print(fill+'',end='')
+            else:
+                first = False
+            print('/'+bname,end='')
+            br.print(fill+('+')*(len(bname)+1))
+            
+        for lname,lf in self.leaves.items():
+            if not first:
+                print(fill+'',end='')
+            else:
+                first = False
+            print('/'+lname)
+
+
+def add_fnode(fn, tree_root, sizes, same_size, inodes = None):
+    """Add a file node to the tree. If the file is new, add it to the 
+    sizes dict, and if its size was already seen, add that size to the 
+    set of sizes with more than one file. Extra hard links of an inode 
+    already in the inodes dict are attached to it instead and are not
+    added to sizes, so they are neither hashed nor seen as repeated.
+    Return whether the file was new."""
+    if not tree_root.add_leaf(fn.fpath,fn):
+        #Ignore a file already added
+        return False
+    register_fnode(fn, sizes, same_size, inodes)
+    return True
+
+def register_fnode(fn, sizes, same_size, inodes = None):
+    """Bookkeeping of add_fnode for a file node already in the tree."""
+    if inodes is not None and fn.nlink > 1 and fn.ino is not None:
+        primary = inodes.setdefault((fn.dev, fn.ino), fn)
+        if primary is not fn:
+            primary.add_link(fn)
+            return
+    s = fn.size
+    if s in sizes:
+        sizes[s].append(fn)
+        same_size.add(s)
+    else:
+        sizes[s] = [fn]
+
+def make_fstree(records, tree_root, sizes , same_size, inodes = None):
+    """Update the root FSTree with the records of a scan (see walk_tree).
+    Records are consumed as they come, so the tree grows during the walk.
+    Files are added with add_fnode. In the end, update aggregates in 
+    FSTree."""
+    metrics.start('walk')
+    n = nbytes = 0
+    for s, fpath, dev, ino, mtime, nlink in records:
+        add_fnode(FNode(fpath,s,dev,ino,mtime,nlink), tree_root, sizes, same_size, inodes)
+        n += 1
+        nbytes += s
+        if n == 1000:
+            metrics.add(walk_files = n, walk_bytes = nbytes)
+            n = nbytes = 0
+    metrics.add(walk_files = n, walk_bytes = nbytes)
+    metrics.stop('walk')
+
+    tree_root.compute_aggr()
+    #print('{} files with repeated size'.format(sum([len(sizes[k]) for k in same_size.keys()])))
+    return tree_root, sizes, same_size
+
+    
+#Size of each block read by the partial hash
+PARTIAL_BLOCK = 64*1024
+#Whether the partial hash also reads a block from the middle of the file
+PARTIAL_MIDDLE = True
+#Files up to this size are always fully hashed
+PARTIAL_MIN = 4*PARTIAL_BLOCK
+
+def needs_partial(fn):
+    """Whether the file should go through the partial hash before a full
+    hash is considered."""
+    return fn.partial is None and fn.size > PARTIAL_MIN
+
+
+#How files are read for hashing. 'cache' goes through the page cache as
+#usual. 'dontneed' reads sequentially and drops the pages read from the
+#page cache as it goes, so hashing a large archive does not evict what
+#other programs use. 'direct' bypasses the page cache with O_DIRECT, and
+#falls back to 'dontneed' where the file system does not support it.
+IO_POLICIES = ('cache', 'dontneed', 'direct')
+IO_POLICY = 'cache'
+#Alignment of O_DIRECT reads (offsets, sizes and buffer address)
+DIRECT_ALIGN = 4096
+
+def _fadvise(fd, offset, length, advice):
+    """posix_fadvise where available. Hints are best effort."""
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, offset, length, advice)
+        except OSError:
+            pass
+
+def open_for_read(fpath, policy):
+    """Open a file for reading with the I/O policy. Return the unbuffered
+    file and whether it is opened with O_DIRECT."""
+    if policy == 'direct' and hasattr(os, 'O_DIRECT'):
+        try:
+            fd = os.open(fpath, os.O_RDONLY | os.O_DIRECT)
+        except OSError as err:
+            if err.errno != errno.EINVAL:
+                raise
+        else:
+            return io.FileIO(fd, 'rb'), True
+    f = open(fpath, 'rb', buffering = 0)
+    if policy != 'cache':
+        _fadvise(f.fileno(), 0, 0, getattr(os, 'POSIX_FADV_SEQUENTIAL', 0))
+    return f, False
+
+def drop_cache(f, offset, length, policy):
+    """Drop pages of the file from the page cache if the policy asks for
+    it. A length of 0 means up to the end of the file."""
+    if policy != 'cache':
+        _fadvise(f.fileno(), offset, length, getattr(os, 'POSIX_FADV_DONTNEED', 4))
+
+
+class Hasher(object):
+    """Compute file digests inside the process. Files are read in chunks
+    into a single reusable buffer, so memory use does not depend on the
+    file size. hashlib releases the GIL while hashing large chunks.
+
+    The buffer is an anonymous mmap, page aligned as O_DIRECT requires.
+    How the page cache is used depends on policy (see IO_POLICIES)."""
+    def __init__(self, bufsize = 1024*1024, algorithm = DEFAULT_ALGORITHM, policy = None):
+        bufsize = max(bufsize, PARTIAL_BLOCK + DIRECT_ALIGN)
+        bufsize += -bufsize % DIRECT_ALIGN
+        self.buf = mmap.mmap(-1, bufsize)
+        self.view = memoryview(self.buf)
+        self.algorithm = check_algorithm(algorithm)
+        self.new = HASHERS[self.algorithm]
+        if policy is None:
+            policy = IO_POLICY
+        if policy not in IO_POLICIES:
+            raise ValueError('Unknown I/O policy {}'.format(policy))
+        self.policy = policy
+
+    def _retry(self, func, *args):
+        """Call func with the policy, and again with 'dontneed' if reading
+        with O_DIRECT fails with EINVAL, which some file systems only
+        report when reading."""
+        try:
+            return func(*args, self.policy)
+        except OSError as err:
+            if self.policy != 'direct' or err.errno != errno.EINVAL:
+                raise
+            return func(*args, 'dontneed')
+
+    def digest(self, fpath):
+        """Return the hex digest of the file as bytes, the same characters
+        md5sum (or sha256sum, b2sum...) prints. Raise OSError if the file
+        can't be read."""
+        return self._retry(self._digest, fpath)
+
+    def _digest(self, fpath, policy):
+        h = self.new()
+        total = 0
+        f, direct = open_for_read(fpath, policy)
+        with f:
+            while True:
+                n = f.readinto(self.view)
+                if not n:
+                    break
+                h.update(self.view[:n])
+                if not direct:
+                    drop_cache(f, total, n, policy)
+                total += n
+            if not direct:
+                #Also what the kernel read ahead
+                drop_cache(f, 0, 0, policy)
+        metrics.add(hash_files = 1, hash_bytes = total)
+        return h.hexdigest().encode()
+
+    def partial_digest(self, fpath, size):
+        """Return the hex digest of the head and tail blocks of the file
+        (and a middle one if PARTIAL_MIDDLE is set)."""
+        return self._retry(self._partial_digest, fpath, size)
+
+    def _partial_digest(self, fpath, size, policy):
+        offsets = [0]
+        if PARTIAL_MIDDLE:
+            offsets.append((size // 2) - (size // 2) % PARTIAL_BLOCK)
+        offsets.append(max(size - PARTIAL_BLOCK, 0))
+        h = self.new()
+        #Reads start at an aligned offset, whatever the policy, and the
+        #block is sliced from what was read
+        block = self.view[:PARTIAL_BLOCK + DIRECT_ALIGN]
+        total = 0
+        f, direct = open_for_read(fpath, policy)
+        with f:
+            for off in offsets:
+                start = off - off % DIRECT_ALIGN
+                f.seek(start)
+                n = f.readinto(block)
+                skip = off - start
+                h.update(block[skip:max(skip, min(n, skip + PARTIAL_BLOCK))])
+                total += n
+                if not direct:
+                    drop_cache(f, start, n, policy)
+        metrics.add(partial_files = 1, hash_bytes = total)
+        return h.hexdigest().encode()
+
+    def hash_partial(self, fn):
+        """Set the partial digest of a file node. Same error handling as
+        hash_fn."""
+        try:
+            fn.partial = self.partial_digest(fn.fpath, fn.size)
+        except OSError as err:
+            fn.error = err.strerror or str(err)
+            return False
+        return True
+
+    def hash_fn(self, fn):
+        """Set the md5 of a file node. On error, leave md5 unset and record
+        the reason in the node. Return whether the digest was computed."""
+        try:
+            fn.md5 = self.digest(fn.fpath)
+        except OSError as err:
+            fn.error = err.strerror or str(err)
+            return False
+        fn.error = None
+        return True
+
+
+#Buckets of files of the same size with at most this many files are
+#compared directly instead of hashed
+COMPARE_MAX = 3
+#Prefix of the pseudo digests of compared files
+COMPARED_PREFIX = b'='
+
+def is_compared(fn):
+    """Whether the file was grouped by direct comparison."""
+    return fn.md5 is not None and fn.md5[:1] == COMPARED_PREFIX
+
+def compared_digest(group):
+    """Pseudo digest shared by a group of identical files found by
+    compare_files. It only has to be unique among files of that size, and
+    to survive a save and restore."""
+    return COMPARED_PREFIX + hashlib.md5(min(fn.fpath for fn in group)).hexdigest().encode()
+
+def compare_files(fns, bufsize = 1024*1024, policy = None):
+    """Read files of the same size in lockstep and split them into groups
+    of identical contents, as soon as they diverge. A file that differs
+    from all others is not read further. Blocks start small and grow up
+    to bufsize, so files differing early cost little. Return the list of
+    groups, files alone included. Files that can't be read are left out
+    and keep the error in FNode.error. With the 'direct' I/O policy the
+    files are read as with 'dontneed'."""
+    if policy is None:
+        policy = IO_POLICY
+    if policy == 'direct':
+        policy = 'dontneed'
+    groups = []
+    todo = []
+    try:
+        for fn in fns:
+            try:
+                todo.append((fn, open_for_read(fn.fpath, policy)[0]))
+            except OSError as err:
+                fn.error = err.strerror or str(err)
+        todo = [todo]
+        block = PARTIAL_BLOCK
+        nbytes = 0
+        while len(todo) > 0:
+            split = []
+            for members in todo:
+                parts = {}
+                for fn, f in members:
+                    try:
+                        data = f.read(block)
+                    except OSError as err:
+                        fn.error = err.strerror or str(err)
+                        f.close()
+                        continue
+                    drop_cache(f, f.tell() - len(data), len(data), policy)
+                    nbytes += len(data)
+                    parts.setdefault(data, []).append((fn, f))
+                for data, part in parts.items():
+                    if len(data) == 0 or len(part) == 1:
+                        #Identical up to the end, or different from all others
+                        for fn, f in part:
+                            drop_cache(f, 0, 0, policy)
+                            f.close()
+                            fn.error = None
+                        groups.append([fn for fn, f in part])
+                    else:
+                        split.append(part)
+            todo = split
+            block = min(2*block, bufsize)
+    finally:
+        for members in todo:
+            for fn, f in members:
+                f.close()
+    metrics.add(compare_files = len(fns), compare_bytes = nbytes)
+    return groups
+
+
+class CompareGroup(object):
+    """Queue entry of HashPool for a bucket of files of the same size
+    that are compared instead of hashed."""
+    __slots__ = ('size', 'fns')
+    def __init__(self, size, fns):
+        self.size = size
+        self.fns = fns
+
+def _entry_bytes(entry):
+    if isinstance(entry, CompareGroup):
+        return entry.size * len(entry.fns)
+    return entry.size
+
+
+#Maximum number of digests kept in the persistent cache
+CACHE_MAX_ENTRIES = 20000000
+
+def default_cache_path():
+    """Path of the persistent hash cache, under the XDG cache folder."""
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'tucupi', 'hashes.sqlite')
+
+def _sql_int(value):
+    """Map an unsigned 64 bit value (inode numbers may use all bits) to
+    the signed integers SQLite stores."""
+    return value - 2**64 if value >= 2**63 else value
+
+
+class HashCache(object):
+    """Persistent cache of file digests stored in a SQLite database.
+
+    Entries are keyed by (st_dev, st_ino, size, mtime), so a file that was
+    modified or replaced is simply not found. Each digest algorithm has
+    its own table, created on first use ('hashes' for md5, see _table_name). The least recently used
+    entries are dropped when the cache grows beyond max_entries. One
+    connection is shared by all hashing threads, guarded by a lock.
+    Lookups only record hits in memory; they are written, together with
+    new digests, by put_many. A database error while hashing, e.g. a
+    locked or corrupt file, turns the cache off: it is kept in error and
+    later lookups miss."""
+    def __init__(self, fpath = None, max_entries = CACHE_MAX_ENTRIES):
+        if fpath is None:
+            fpath = default_cache_path()
+            os.makedirs(os.path.dirname(fpath), exist_ok = True)
+        self.fpath = fpath
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.hits = {}
+        self.tables = set()
+        self.error = None
+        self.db = sqlite3.connect(fpath, check_same_thread = False)
+        with self.lock, self.db:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            for (name,) in self.db.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall():
+                #Table names go into SQL statements, only plain identifiers are used
+                if re.fullmatch('hashes(_[0-9A-Za-z_]+)?', name):
+                    self.tables.add(name)
+            self._table(DEFAULT_ALGORITHM)
+            self.count = self._count()
+
+    @staticmethod
+    def _table_name(algorithm):
+        """SQL identifier of the table of an algorithm. Characters other
+        than letters, digits and underscores are replaced, and a digest of
+        the name is appended so that different names never share a table."""
+        if algorithm == DEFAULT_ALGORITHM:
+            return 'hashes'
+        name = re.sub('[^0-9A-Za-z_]', '_', check_algorithm(algorithm))
+        if name != algorithm:
+            name += '_' + hashlib.md5(algorithm.encode()).hexdigest()[:8]
+        return 'hashes_' + name
+
+    def _table(self, algorithm):
+        """Name of the table of the algorithm, created if needed. Call
+        with the lock held."""
+        name = self._table_name(algorithm)
+        if name not in self.tables:
+            self.db.execute('CREATE TABLE IF NOT EXISTS {0} (dev INTEGER, ino INTEGER, '
+                            'size INTEGER, mtime INTEGER, path BLOB, digest BLOB, used INTEGER, '
+                            'PRIMARY KEY (dev, ino, size, mtime))'.format(name))
+            self.db.execute('CREATE INDEX IF NOT EXISTS {0}_path ON {0} (path)'.format(name))
+            self.db.execute('CREATE INDEX IF NOT EXISTS {0}_used ON {0} (used)'.format(name))
+            self.tables.add(name)
+        return name
+
+    def _count(self):
+        return sum(self.db.execute('SELECT COUNT(*) FROM {}'.format(t)).fetchone()[0] for t in self.tables)
+
+    @staticmethod
+    def _key(fn):
+        """Cache key of a file node, or None if it lacks inode data."""
+        if fn.ino is None or fn.mtime is None:
+            return None
+        return (_sql_int(fn.dev), _sql_int(fn.ino), fn.size, fn.mtime)
+
+    def lookup(self, fn, algorithm = DEFAULT_ALGORITHM):
+        """Set the digest of the file node from the cache. Return whether
+        it was found."""
+        key = self._key(fn)
+        if key is None:
+            return False
+        with self.lock:
+            if self.error is not None:
+                return False
+            try:
+                table = self._table(algorithm)
+                row = self.db.execute('SELECT digest FROM {} WHERE dev=? AND ino=? AND size=? AND mtime=?'.format(table),
+                                      key).fetchone()
+            except sqlite3.Error as err:
+                self._failed(err)
+                return False
+            if row is None:
+                return False
+            self.hits.setdefault(table, []).append(key)
+        fn.md5 = bytes(row[0])
+        return True
+
+    def put_many(self, fns, algorithm = DEFAULT_ALGORITHM):
+        """Store the digests of the file nodes and the pending hits, in a 
+        single transaction. Evict old entries if needed."""
+        now = int(time.time())
+        rows = []
+        for fn in fns:
+            key = self._key(fn)
+            if key is not None and fn.md5 is not None:
+                rows.append(key + (fn.fpath, fn.md5, now))
+        with self.lock:
+            if self.error is not None:
+                return
+            hits, self.hits = self.hits, {}
+            try:
+                with self.db:
+                    for table, keys in hits.items():
+                        self.db.executemany('UPDATE {} SET used=? WHERE dev=? AND ino=? AND size=? AND mtime=?'.format(table),
+                                            [(now,) + key for key in keys])
+                    self.db.executemany('INSERT OR REPLACE INTO {} VALUES (?,?,?,?,?,?,?)'.format(self._table(algorithm)), rows)
+                    self.count += len(rows)
+                    if self.count > self.max_entries:
+                        self._evict()
+            except sqlite3.Error as err:
+                self._failed(err)
+
+    def _failed(self, err):
+        """Turn the cache off after a database error. Call with the lock
+        held."""
+        self.error = str(err)
+        print('Hash cache disabled: {}'.format(err))
+
+    def _evict(self):
+        """Drop the least recently used entries. Call with the lock held."""
+        self.count = self._count()
+        excess = self.count - self.max_entries
+        if excess > 0:
+            #Leave some room so we don't evict on every write
+            excess += self.max_entries // 10
+            if len(self.tables) == 1:
+                t = next(iter(self.tables))
+                self.db.execute('DELETE FROM {0} WHERE rowid IN '
+                                '(SELECT rowid FROM {0} ORDER BY used LIMIT ?)'.format(t), (excess,))
+            else:
+                union = ' UNION ALL '.join("SELECT '{0}' AS t, rowid AS r, used FROM {0}".format(t)
+                                           for t in self.tables)
+                old = collections.defaultdict(list)
+                for t, r in self.db.execute('SELECT t, r FROM ({}) ORDER BY used LIMIT ?'.format(union), (excess,)):
+                    old[t].append((r,))
+                for t, rows in old.items():
+                    self.db.executemany('DELETE FROM {} WHERE rowid=?'.format(t), rows)
+            self.count = max(self.count - excess, 0)
+
+    def invalidate(self, prefix):
+        """Drop every entry for the path prefix and the files below it.
+        Return the number of entries removed."""
+        prefix = os.fsencode(prefix).rstrip(b'/')
+        removed = 0
+        with self.lock, self.db:
+            for t in self.tables:
+                cur = self.db.execute('DELETE FROM {} WHERE path=? OR (path>=? AND path<?)'.format(t),
+                                      (prefix, prefix + b'/', prefix + b'0'))
+                removed += cur.rowcount
+            self.count = max(self.count - removed, 0)
+            return removed
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def compute_md5(fnlist,rep_files,cache = None,policy = None):
+    """Compute md5 from every file in fnlist. Do not recompute md5 from
+    files already analized. Files that can't be read are skipped and
+    keep their error in FNode.error. If a HashCache is given, it is used
+    before reading a file and updated after hashing it. Digests are computed
+    with the algorithm of rep_files, reading files with the I/O policy."""
+    hasher = Hasher(algorithm = rep_files.algorithm, policy = policy)
+    algorithm = rep_files.algorithm
+    while(len(fnlist)>0):
+        fn = fnlist.pop(0)
+        if fn.md5 is None:
+            if cache is not None and cache.lookup(fn, algorithm):
+                rep_files.add_fn(fn)
+            elif hasher.hash_fn(fn):
+                rep_files.add_fn(fn)
+                if cache is not None:
+                    cache.put_many([fn], algorithm)
+    if cache is not None:
+        cache.put_many([], algorithm)
+
+
+#Default number of threads hashing files concurrently
+HASH_WORKERS = 4
+
+#Order of the files of a device in HashPool. 'size' is largest first,
+#'inode' by inode number and 'extent' by the physical position of the
+#first extent (FIEMAP), the last two to spare seeks on spinning disks.
+HASH_ORDERS = ('size', 'inode', 'extent')
+HASH_ORDER = 'size'
+
+#ioctl number of FS_IOC_FIEMAP on Linux
+FS_IOC_FIEMAP = 0xC020660B
+
+def physical_offset(fpath):
+    """Position on its device of the first extent of the file, using the
+    FIEMAP ioctl. None if unknown: no extent, or a file system or platform
+    without FIEMAP."""
+    if fcntl is None:
+        return None
+    #struct fiemap with room for one struct fiemap_extent
+    buf = bytearray(struct.pack('=QQLLLL', 0, 2**64 - 1, 0, 0, 1, 0) + bytes(56))
+    try:
+        fd = os.open(fpath, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        fcntl.ioctl(fd, FS_IOC_FIEMAP, buf)
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+    if struct.unpack_from('=L', buf, 20)[0] == 0:
+        return None
+    return struct.unpack_from('=Q', buf, 40)[0]
+
+def _entry_files(entry):
+    return entry.fns if isinstance(entry, CompareGroup) else (entry,)
+
+class HashPool(object):
+    """Pool of threads computing the digests of a list of file nodes.
+
+    Files are queued per device (st_dev), so that devices are read
+    concurrently: a worker takes the next file from the device with the
+    fewest workers busy on it, and at most device_workers work on the same
+    device. Within a device files are taken in the given order (largest
+    first) or by physical layout, see HASH_ORDERS. Results go to a single
+    collector thread that adds them to RepFile in batches, so the RepFile
+    lock is taken once per batch instead of once per file. The interface
+    mimics threading.Thread.
+
+    Large files are hashed in two stages. First only a few blocks are
+    hashed (the partial hash). The collector groups files by size and
+    partial hash in the partials dict, and files whose group has more
+    than one member are put back at the front of their queue for a full
+    hash. Files alone in their group are never fully read.
+
+    If a HashCache is given, files found there are not read at all, and
+    the digests computed are stored there by the collector. Files are read
+    with the I/O policy (see IO_POLICIES).
+
+    Sizes with at most compare_max files to hash are not hashed: their
+    files are compared with compare_files by a single worker. Files
+    compared in an earlier run are taken back from RepFile when new files
+    of their size come in (see RepFile.take_compared).
+
+    If size_done is given, it is called from the collector thread with a
+    file size as soon as every file of that size in the list is settled,
+    that is, hashed, dropped after the partial stage or failed. Groups of
+    repeated files of that size in RepFile are then complete."""
+    def __init__(self, fnlist, rep_files, nworkers = HASH_WORKERS, partials = None, cache = None,
+                 size_done = None, compare_max = COMPARE_MAX, policy = None, order = HASH_ORDER,
+                 device_workers = None):
+        if order not in HASH_ORDERS:
+            raise ValueError('Unknown hashing order {}'.format(order))
+        self.rep_files = rep_files
+        self.policy = policy
+        self.order = order
+        self.device_workers = device_workers
+        if partials is None:
+            partials = {}
+        self.partials = partials
+        entries = self._plan(fnlist, compare_max)
+        self.queues = collections.OrderedDict() #Entries to process, per device
+        self.busy = collections.Counter() #Workers busy, per device
+        for e in entries:
+            self._queue(e).append(e)
+        #Sorting by extent needs an ioctl per file, done by start in a thread
+        self.ready = order != 'extent'
+        if order == 'inode':
+            for dev, q in self.queues.items():
+                self.queues[dev] = collections.deque(sorted(q, key = self._inode_key))
+        self.cache = cache
+        self.full = set() #Files that passed the partial stage
+        self.full_started = set()
+        self.nworkers = max(1, nworkers)
+        self.cond = threading.Condition()
+        self.pending = 0 #Files taken by a worker but not yet collected
+        self.running = 0
+        self.results = queue.Queue()
+        self.total_bytes = sum(_entry_bytes(e) for e in entries)
+        self.done_bytes = 0
+        self.threads = []
+        self.size_done = size_done
+        #Queue entries not yet collected, per file size
+        self.size_left = collections.Counter(e.size for e in entries)
+
+    def _plan(self, fnlist, compare_max):
+        """Queue entries for the files, in the same order. Buckets that are
+        small enough become a CompareGroup, unless files of their size
+        already have a real digest or a partial one, e.g. after a stop or a
+        restored state: then the files compared earlier are taken back and
+        every file of the size is hashed, so that they all end up in the
+        same groups."""
+        partial_sizes = set(size for size, partial in self.partials)
+        entries = []
+        k = 0
+        while k < len(fnlist):
+            s = fnlist[k].size
+            end = k
+            while end < len(fnlist) and fnlist[end].size == s:
+                end += 1
+            bucket = fnlist[k:end]
+            k = end
+            hashed = s in partial_sizes or self.rep_files.has_digests(s)
+            if not any(fn.md5 is None for fn in bucket) and not (hashed and s in self.rep_files.compared):
+                entries.extend(fn for fn in bucket if not is_compared(fn))
+                continue
+            seen = set(bucket)
+            bucket.extend(fn for fn in self.rep_files.take_compared(s) if fn not in seen)
+            if not hashed and 2 <= len(bucket) <= compare_max and all(fn.md5 is None for fn in bucket):
+                entries.append(CompareGroup(s, bucket))
+            else:
+                entries.extend(bucket)
+        return entries
+
+    def _queue(self, entry):
+        """Queue of the device of an entry, created if needed."""
+        dev = _entry_files(entry)[0].dev
+        q = self.queues.get(dev)
+        if q is None:
+            q = self.queues[dev] = collections.deque()
+        return q
+
+    @staticmethod
+    def _inode_key(entry):
+        return min(fn.ino or 0 for fn in _entry_files(entry))
+
+    def _sort_extents(self):
+        """Sort the queues by physical position, then let workers go."""
+        keys = {}
+        with self.cond:
+            entries = [e for q in self.queues.values() for e in q]
+        for e in entries:
+            offsets = [physical_offset(fn.fpath) for fn in _entry_files(e)]
+            offsets = [k for k in offsets if k is not None]
+            keys[e] = (len(offsets) == 0, min(offsets) if offsets else 0, self._inode_key(e))
+        with self.cond:
+            for dev, q in self.queues.items():
+                self.queues[dev] = collections.deque(sorted(q, key = keys.__getitem__))
+            self.ready = True
+            self.cond.notify_all()
+
+    def start(self):
+        metrics.start('hash')
+        self.running = self.nworkers
+        self.threads = [threading.Thread(target = self._worker) for k in range(self.nworkers)]
+        self.threads.append(threading.Thread(target = self._collector))
+        if not self.ready:
+            self.threads.append(threading.Thread(target = self._sort_extents))
+        for thr in self.threads:
+            thr.start()
+
+    def is_alive(self):
+        return any(thr.is_alive() for thr in self.threads)
+
+    def join(self):
+        for thr in self.threads:
+            thr.join()
+
+    def remaining(self):
+        """Number of files (or buckets to compare) not yet handed to a
+        worker."""
+        return sum(len(q) for q in list(self.queues.values()))
+
+    def next_size(self):
+        """Size of the largest of the next files to be processed."""
+        with self.cond:
+            return max([q[0].size for q in self.queues.values() if len(q) > 0], default = 0)
+
+    def fraction(self):
+        """Fraction of the bytes already processed."""
+        if self.total_bytes == 0:
+            return 1.0
+        return min(self.done_bytes / self.total_bytes, 1.0)
+
+    def stop(self):
+        """Stop handing out files. Files already being hashed are finished.
+        Return the list of files that were not started."""
+        with self.cond:
+            left = []
+            for q in self.queues.values():
+                for e in q:
+                    left.extend(_entry_files(e))
+                q.clear()
+            self.cond.notify_all()
+        #Keep the largest first order callers expect
+        left.sort(key = lambda fn: fn.size, reverse = True)
+        return left
+
+    def _pick(self):
+        """Device to take the next entry from, or None if all devices
+        with work have device_workers busy."""
+        best = None
+        for dev, q in self.queues.items():
+            if len(q) == 0:
+                continue
+            busy = self.busy[dev]
+            if self.device_workers is not None and busy >= self.device_workers:
+                continue
+            if best is None or busy < self.busy[best]:
+                best = dev
+        return best
+
+    def _get(self):
+        """Next file to hash, whether it is a repeated queue entry and its
+        device, or None when there is no more work."""
+        with self.cond:
+            while True:
+                if self.ready:
+                    dev = self._pick()
+                    if dev is not None:
+                        fn = self.queues[dev].popleft()
+                        again = False
+                        if fn in self.full:
+                            #Queued twice, e.g. after being restored
+                            again = fn in self.full_started
+                            self.full_started.add(fn)
+                        self.pending += 1
+                        self.busy[dev] += 1
+                        return fn, again, dev
+                    if self.pending == 0 and not any(len(q) > 0 for q in self.queues.values()):
+                        return None
+                #Wait for the collector or other workers, there may still
+                #be work for us
+                self.cond.wait()
+
+    def _worker(self):
+        hasher = Hasher(algorithm = self.rep_files.algorithm, policy = self.policy)
+        while True:
+            item = self._get()
+            if item is None:
+                break
+            fn, again, dev = item
+            try:
+                stage = self._process(fn, again, hasher)
+            except Exception as err:
+                #Every entry must reach the collector, or join would wait
+                #for it forever
+                for f in _entry_files(fn):
+                    f.error = str(err) or type(err).__name__
+                    if isinstance(fn, CompareGroup):
+                        f.md5 = None
+                stage = None
+            self.results.put((fn, stage))
+            with self.cond:
+                self.busy[dev] -= 1
+                self.cond.notify_all()
+        with self.cond:
+            self.running -= 1
+            last = self.running == 0
+        if last:
+            #Tell the collector we are done
+            self.results.put(None)
+
+    def _process(self, fn, again, hasher):
+        """Hash or compare a queue entry. Return its stage for the
+        collector, None if there is nothing to add."""
+        if isinstance(fn, CompareGroup):
+            return self._compare(fn)
+        if again:
+            return None
+        if fn.md5 is None and self.cache is not None and self.cache.lookup(fn, self.rep_files.algorithm):
+            metrics.add(hash_cached = 1)
+            return 'cached'
+        if fn in self.full or (fn.md5 is None and fn.size <= PARTIAL_MIN):
+            return 'full' if fn.md5 is None and hasher.hash_fn(fn) else None
+        if needs_partial(fn):
+            return 'partial' if hasher.hash_partial(fn) else None
+        if fn.md5 is None:
+            #Partial hash already known, from a restored state
+            return 'partial'
+        return None
+
+    def _compare(self, group):
+        """Group the files of a CompareGroup, giving them their digest from
+        the cache when all are there, or a pseudo digest otherwise."""
+        algorithm = self.rep_files.algorithm
+        if self.cache is not None:
+            if all([self.cache.lookup(fn, algorithm) for fn in group.fns]):
+                metrics.add(hash_cached = len(group.fns))
+                return 'compared'
+            for fn in group.fns:
+                fn.md5 = None
+        for same in compare_files(group.fns, policy = self.policy):
+            digest = compared_digest(same)
+            for fn in same:
+                fn.md5 = digest
+        return 'compared'
+
+    def _collector(self):
+        while True:
+            batch = [self.results.get()]
+            if batch[0] is None:
+                metrics.stop('hash')
+                return
+            try:
+                while len(batch) < 1000:
+                    batch.append(self.results.get_nowait())
+            except queue.Empty:
+                pass
+            try:
+                again = self._store(batch)
+            except Exception as err:
+                #The batch is still accounted for below, so that workers
+                #and join do not wait for it
+                again = []
+                for e, stage in batch:
+                    for fn in _entry_files(e):
+                        fn.error = fn.error or str(err) or type(err).__name__
+            with self.cond:
+                self.pending -= len(batch)
+                #Files fully hashed after the partial stage were counted then
+                self.done_bytes += sum(_entry_bytes(e) for e, stage in batch if e not in self.full)
+                self.full.update(again)
+                #Colliding files already had their first blocks read, so
+                #they go first
+                for fn in reversed(again):
+                    self._queue(fn).appendleft(fn)
+                self.cond.notify_all()
+            if self.size_done is not None:
+                self._count_sizes(batch, again)
+
+    def _store(self, batch):
+        """Add the digests of a batch of results to RepFile and the cache,
+        and the partial hashes to the partials dict. Return the files that
+        need a full hash."""
+        added = [fn for fn, stage in batch if stage in ('full', 'cached')]
+        for group, stage in batch:
+            if stage == 'compared':
+                added.extend(fn for fn in group.fns if fn.md5 is not None)
+        self.rep_files.add_fns(added)
+        if self.cache is not None:
+            self.cache.put_many([fn for fn, stage in batch if stage == 'full'], self.rep_files.algorithm)
+        again = []
+        for fn, stage in batch:
+            if stage == 'partial':
+                again.extend(add_partial(self.partials, fn))
+        return again
+
+    def _count_sizes(self, batch, again):
+        """Account for collected and requeued entries. Call size_done for
+        the sizes that have nothing left."""
+        for fn in again:
+            self.size_left[fn.size] += 1
+        finished = []
+        for fn, stage in batch:
+            self.size_left[fn.size] -= 1
+            if self.size_left[fn.size] == 0:
+                del self.size_left[fn.size]
+                finished.append(fn.size)
+        for s in finished:
+            self.size_done(s)
+
+
+def add_partial(partials, fn):
+    """Add a file node to the partials dict, which maps (size, partial)
+    to the first two files seen with it. Return the files of the group
+    that still need a full hash."""
+    group = partials.setdefault((fn.size, fn.partial), [])
+    new = len(group) < 2 and fn not in group
+    if new:
+        #Once a collision is known there is no need to keep more files
+        group.append(fn)
+    if len(group) < 2:
+        return []
+    if new:
+        #First collision, the other file is also needed
+        return [g for g in group if g.md5 is None]
+    return [fn] if fn.md5 is None else []
+            
+#Version of the state file format written by save_state
+STATE_VERSION = 2
+#Bits of the flags column in state files
+STATE_MARKED, STATE_KEPT, STATE_REPEATED, STATE_INODE, STATE_MTIME, STATE_LINK = 1, 2, 4, 8, 16, 32
+
+def _blob(items):
+    """Pack a list of bytes into an uint8 array and an array of offsets."""
+    offsets = np.zeros((len(items) + 1,), dtype = np.int64)
+    np.cumsum([len(k) for k in items], out = offsets[1:])
+    return np.frombuffer(b''.join(items), dtype = np.uint8), offsets
+
+def _unblob(data, offsets):
+    """Inverse of _blob."""
+    data = data.tobytes()
+    offsets = offsets.tolist()
+    return [data[offsets[k]:offsets[k+1]] for k in range(len(offsets) - 1)]
+
+def _digests(items):
+    """Array of optional digests. None is stored as an empty string."""
+    return np.array([b'' if k is None else k for k in items], dtype = np.bytes_)
+
+def save_state(fpath, fstree, saved_fns, algorithm = DEFAULT_ALGORITHM):
+    """Save the state of every file in the tree as a NumPy .npz archive
+    with one array per field. Directory paths and file names are stored
+    once each, as blobs. algorithm is the one the digests were computed
+    with."""
+    dirs = []
+    cols = {k:[] for k in ('dir', 'name', 'md5', 'partial', 'size', 'flags', 'dev', 'ino', 'mtime', 'nlink')}
+    for br in fstree.iter_branches():
+        if len(br.leaves) == 0:
+            continue
+        dirs.append(br.path)
+        d = len(dirs) - 1
+        for name, fn in br.leaves.items():
+            flags = fn.marked * STATE_MARKED | fn.kept * STATE_KEPT | fn.repeated * STATE_REPEATED
+            if fn.ino is not None:
+                flags |= STATE_INODE
+            if fn.mtime is not None:
+                flags |= STATE_MTIME
+            if fn.link_of is not None:
+                flags |= STATE_LINK
+            cols['dir'].append(d)
+            cols['name'].append(name)
+            cols['md5'].append(fn.md5)
+            cols['partial'].append(fn.partial)
+            cols['size'].append(fn.size)
+            cols['flags'].append(flags)
+            cols['dev'].append(fn.dev or 0)
+            cols['ino'].append(fn.ino or 0)
+            cols['mtime'].append(fn.mtime or 0)
+            cols['nlink'].append(fn.nlink)
+        saved_fns[0] += len(br.leaves)
+    dir_data, dir_offsets = _blob(dirs)
+    name_data, name_offsets = _blob(cols['name'])
+    with open(fpath, 'wb') as f:
+        np.savez(f, format = np.array('tucupi-state'), version = np.array(STATE_VERSION),
+                 algorithm = np.array(algorithm),
+                 count = np.array(len(cols['size']), dtype = np.int64),
+                 dir_data = dir_data, dir_offsets = dir_offsets,
+                 name_data = name_data, name_offsets = name_offsets,
+                 dir = np.array(cols['dir'], dtype = np.int64),
+                 size = np.array(cols['size'], dtype = np.int64),
+                 flags = np.array(cols['flags'], dtype = np.uint8),
+                 md5 = _digests(cols['md5']), partial = _digests(cols['partial']),
+                 dev = np.array(cols['dev'], dtype = np.uint64),
+                 ino = np.array(cols['ino'], dtype = np.uint64),
+                 mtime = np.array(cols['mtime'], dtype = np.int64),
+                 nlink = np.array(cols['nlink'], dtype = np.int64))
+
+def _is_npz(fpath):
+    with open(fpath, 'rb') as f:
+        return f.read(4) == b'PK\x03\x04'
+
+def read_state_count(fpath):
+    """Return the number of files in a state file, checking its header.
+    Both the current format and the old pickle streams are accepted."""
+    if _is_npz(fpath):
+        with np.load(fpath) as data:
+            if 'format' not in data or str(data['format']) != 'tucupi-state':
+                raise ValueError('Not a tucupi state file')
+            if int(data['version']) > STATE_VERSION:
+                raise ValueError('State file written by a newer version')
+            count = int(data['count'])
+    else:
+        with open(fpath, 'rb') as f:
+            count = pickle.load(f)
+        if type(count) is not np.int64:
+            raise ValueError('Improper value stored in state file')
+    if count <= 0:
+        raise ValueError('Improper value stored in state file')
+    return int(count)
+
+def _use_algorithm(rep_files, partials, algorithm):
+    """Whether digests computed with algorithm can go into rep_files. If
+    nothing was hashed yet, rep_files switches to that algorithm."""
+    with rep_files.lock:
+        if algorithm == rep_files.algorithm:
+            return True
+        if len(rep_files.size_md5) == 0 and not partials and algorithm in HASHERS:
+            rep_files.algorithm = algorithm
+            return True
+    print('Ignoring {} digests of the state file, {} is in use.'.format(algorithm, rep_files.algorithm))
+    return False
+
+def restore_state(fpath, fstree, rep_files, restored_fns, sizes, same_size, partials = None, inodes = None):
+    """Add the files of a state file to the tree and the other structures.
+    Files are added one directory at a time and grouped in RepFile in 
+    batches. Extra hard links are registered after every other file, so
+    the primary of each inode is the one that was saved as such. If the
+    digests of the file can't be used (see _use_algorithm),
+    files are restored without them and will be hashed again. States saved
+    as pickle streams by older versions are read with
+    restore_pickled_state."""
+    if not _is_npz(fpath):
+        restore_pickled_state(fpath, fstree, rep_files, restored_fns, sizes, same_size, partials, inodes)
+        return
+    with np.load(fpath) as data:
+        algorithm = str(data['algorithm']) if 'algorithm' in data else DEFAULT_ALGORITHM
+        count = int(data['count'])
+        dirs = _unblob(data['dir_data'], data['dir_offsets'])
+        names = _unblob(data['name_data'], data['name_offsets'])
+        dir_col = data['dir'].tolist()
+        size = data['size'].tolist()
+        flags = data['flags'].tolist()
+        md5 = data['md5'].tolist()
+        partial = data['partial'].tolist()
+        dev = data['dev'].tolist()
+        ino = data['ino'].tolist()
+        mtime = data['mtime'].tolist()
+        nlink = data['nlink'].tolist()
+    if not _use_algorithm(rep_files, partials, algorithm):
+        #Groups and marks are rebuilt once the files are hashed again
+        md5 = partial = [b''] * count
+        flags = [fl & ~(STATE_MARKED | STATE_REPEATED) for fl in flags]
+    hashed = []
+    links = []
+    start = 0
+    while start < count:
+        d = dir_col[start]
+        end = start
+        while end < count and dir_col[end] == d:
+            end += 1
+        dpath = dirs[d]
+        branch = fstree.make_branch(dpath)
+        for k in range(start, end):
+            fl = flags[k]
+            fn = FNode(dpath + b'/' + names[k], size[k])
+            if fl & STATE_INODE:
+                fn.dev = dev[k]
+                fn.ino = ino[k]
+            if fl & STATE_MTIME:
+                fn.mtime = mtime[k]
+            fn.nlink = nlink[k]
+            fn.md5 = md5[k] or None
+            fn.partial = partial[k] or None
+            fn.marked = bool(fl & STATE_MARKED)
+            fn.kept = bool(fl & STATE_KEPT)
+            fn.repeated = bool(fl & STATE_REPEATED)
+            if not branch.attach_leaf(names[k], fn):
+                raise ValueError('State file includes repeated entry in file system.')
+            if fl & STATE_LINK:
+                links.append(fn)
+                continue
+            register_fnode(fn, sizes, same_size, inodes)
+            if fn.link_of is None and fn.size > 0 and fn.md5 is not None:
+                hashed.append(fn)
+            if partials is not None and fn.link_of is None and fn.partial is not None:
+                add_partial(partials, fn)
+        if len(hashed) > 10000:
+            rep_files.add_fns(hashed)
+            hashed = []
+        restored_fns[0] += end - start
+        start = end
+    rep_files.add_fns(hashed)
+    for fn in links:
+        register_fnode(fn, sizes, same_size, inodes)
+
+def restore_pickled_state(fpath, fstree, rep_files, restored_fns, sizes, same_size, partials = None, inodes = None):
+    """Restore a state saved as a stream of pickled FNode states. Their
+    digests are md5."""
+    usable = _use_algorithm(rep_files, partials, 'md5')
+    with open(fpath, 'rb') as f:
+        fns_torestore = pickle.load(f)
+        while True:
+            try:
+                fn_data = pickle.load(f)
+            except EOFError:
+                if restored_fns[0] != fns_torestore:
+                    print('Incomplete state restoration.')
+                return
+            fn = FNode(None, None)
+            if not usable:
+                fields = FNode.state_fields[:len(fn_data)]
+                fn_data = dict(zip(fields, fn_data))
+                fn_data.update(md5 = None, partial = None, marked = False, repeated = False)
+                fn_data = [fn_data[k] for k in fields]
+            fn.set_state(fn_data)
+            if not add_fnode(fn, fstree, sizes, same_size, inodes):
+                raise ValueError('State file includes repeated entry in file system.')
+                
+            if fn.link_of is None and fn.size > 0 and fn.md5 is not None:
+                rep_files.add_fn(fn)
+            if partials is not None and fn.link_of is None and fn.partial is not None:
+                add_partial(partials, fn)
+            restored_fns[0] += 1
+
+
+#Default number of threads deleting files
+DELETE_WORKERS = 4
+#Files handled by a worker at a time, and logged with a single sync
+DELETE_BATCH = 1000
+
+class Journal(object):
+    """Append-only log of a run changing files, one JSON object per line.
+    Every file is first recorded with a 'plan' line, and later with the
+    outcome ('deleted', 'missing', 'skipped', 'failed'...). Lines are
+    synced to disk in batches, before the tree is updated, so after a
+    crash the files planned without an outcome are the ones to retry (see
+    pending). A line torn by a crash is dropped."""
+    def __init__(self, fpath):
+        self.fpath = fpath
+        self.planned = collections.OrderedDict() #Plan records by path
+        self.finished = {} #Last outcome by path
+        if os.path.exists(fpath):
+            self._load()
+        self.f = open(fpath, 'a')
+
+    def _load(self):
+        with open(self.fpath, 'rb') as f:
+            data = f.read()
+        end = data.rfind(b'\n') + 1
+        if end < len(data):
+            #Torn last line. Later lines must not be appended to it
+            with open(self.fpath, 'r+b') as f:
+                f.truncate(end)
+        for line in data[:end].splitlines():
+            rec = json.loads(line.decode())
+            if rec['event'] == 'plan':
+                self.planned[rec['path']] = rec
+                self.finished.pop(rec['path'], None)
+            else:
+                self.finished[rec['path']] = rec['event']
+
+    def pending(self):
+        """Plan records of the files without an outcome."""
+        return [rec for path, rec in self.planned.items() if path not in self.finished]
+
+    def write(self, records):
+        """Append records and sync them to disk."""
+        for rec in records:
+            self.f.write(json.dumps(rec) + '\n')
+            if rec['event'] == 'plan':
+                self.planned[rec['path']] = rec
+                self.finished.pop(rec['path'], None)
+            else:
+                self.finished[rec['path']] = rec['event']
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def close(self):
+        self.f.close()
+
+
+def plan_record(fn, action, rep_files):
+    """Journal 'plan' line for a file node: what is expected to be found
+    at its path, and the copies that must still exist."""
+    copies = rep_files.copies(fn) if rep_files is not None else []
+    return {'event': 'plan', 'action': action, 'path': os.fsdecode(fn.fpath), 'size': fn.size,
+            'mtime': fn.mtime, 'dev': fn.dev, 'ino': fn.ino,
+            'digest': fn.md5.decode() if fn.md5 is not None else None,
+            'algorithm': rep_files.algorithm if rep_files is not None else DEFAULT_ALGORITHM,
+            'kept': [os.fsdecode(g.fpath) for g in copies if not g.marked]}
+
+def record_fnode(rec):
+    """File node described by a plan record, for files not in a tree."""
+    fn = FNode(os.fsencode(rec['path']), rec['size'], rec['dev'], rec['ino'], rec['mtime'])
+    if rec['digest'] is not None:
+        fn.md5 = rec['digest'].encode()
+    return fn
+
+
+class FileAction(object):
+    """Pool of threads applying an action to files, in batches, logged to
+    a Journal. Subclasses define the action name and apply(rec). Files
+    still pending in the journal from an interrupted run are done first.
+
+    Right before a file is changed, it is checked against its plan record:
+    same type, size and mtime (and inode when known), and one of the kept
+    copies must still be there with the same size. With verify, the file
+    and that copy are also checked to have the recorded content.
+
+    Results go to a collector thread. It journals them, then updates the
+    RepFile and FSTree, if given, with update(fn, event). The interface
+    mimics threading.Thread. A journal with files pending for another
+    action raises ValueError.
+
+    Files are planned, and journaled, up front unless the subclass sets
+    stream: then each batch is planned when a worker asks for it, and
+    total and total_bytes grow until planned is set. An error planning
+    files stops the run and is kept in error."""
+    action = None
+    stream = False
+
+    def __init__(self, fns, rep_files, fstree, journal_path, nworkers = DELETE_WORKERS,
+                 verify = False, batch = DELETE_BATCH, policy = None):
+        self.rep_files = rep_files
+        self.fstree = fstree
+        self.verify = verify
+        self.policy = policy
+        self.journal = Journal(journal_path)
+        self.nworkers = max(1, nworkers)
+        pending = self.journal.pending()
+        others = sorted(set(rec['action'] for rec in pending) - {self.action})
+        if others:
+            self.journal.close()
+            raise ValueError('{} has files pending to {}. Finish that run first.'.format(
+                journal_path, ' and '.join(others)))
+        items = []
+        for rec in pending:
+            items.append((rec, self._find(rec)))
+        resumed = set(rec['path'] for rec, fn in items)
+        self.total = len(items)
+        self.total_bytes = sum(rec['size'] for rec, fn in items)
+        self.batch = batch
+        self.batches = collections.deque(items[k:k+batch] for k in range(0, len(items), batch))
+        self.new = (item for item in self.plan(fns) if item[0]['path'] not in resumed)
+        self.planned = False
+        self.error = None
+        self.lock = threading.Lock()
+        self.journal_lock = threading.Lock() #Shared with the collector
+        if not self.stream:
+            while self._plan_batch():
+                pass
+        self.results = queue.Queue()
+        self.counts = collections.Counter()
+        self.done = 0
+        self.freed = 0
+        self.threads = []
+
+    def plan(self, fns):
+        """(plan record, file node) of each file to change."""
+        return [(plan_record(fn, self.action, self.rep_files), fn) for fn in fns]
+
+    def _plan_batch(self):
+        """Journal the next batch of planned files and queue it. Return
+        False once every file was planned. Called with lock held, or
+        before the threads start."""
+        items = list(itertools.islice(self.new, self.batch))
+        if len(items) == 0:
+            self.planned = True
+            return False
+        with self.journal_lock:
+            self.journal.write([rec for rec, fn in items])
+        self.total += len(items)
+        self.total_bytes += sum(rec['size'] for rec, fn in items)
+        self.batches.append(items)
+        return True
+
+    def _find(self, rec):
+        """File node of a resumed plan record, from the tree if possible."""
+        if self.fstree is not None:
+            try:
+                return self.fstree.get_leaf(os.fsencode(rec['path']))
+            except KeyError:
+                pass
+        return record_fnode(rec)
+
+    def start(self):
+        self.running = self.nworkers
+        self.threads = [threading.Thread(target = self._worker) for k in range(self.nworkers)]
+        self.threads.append(threading.Thread(target = self._collector))
+        for thr in self.threads:
+            thr.start()
+
+    def is_alive(self):
+        return any(thr.is_alive() for thr in self.threads)
+
+    def join(self):
+        for thr in self.threads:
+            thr.join()
+
+    def fraction(self):
+        """Fraction of the files done. While files are still being planned,
+        of those planned so far."""
+        if self.total == 0:
+            return 1.0 if self.planned else 0.0
+        return self.done / self.total
+
+    def stop(self):
+        """Do not start new batches. Files left stay pending in the journal."""
+        with self.lock:
+            self.batches.clear()
+            self.new.close()
+            self.planned = True
+
+    def check(self, rec, hasher):
+        """Reason not to touch the file of a plan record, or None. Raise
+        FileNotFoundError if it is gone."""
+        path = os.fsencode(rec['path'])
+        st = os.lstat(path)
+        if not stat.S_ISREG(st.st_mode):
+            return 'not a regular file'
+        if st.st_size != rec['size'] or (rec['mtime'] is not None and st.st_mtime_ns != rec['mtime']):
+            return 'changed'
+        if rec['ino'] is not None and (st.st_dev, st.st_ino) != (rec['dev'], rec['ino']):
+            return 'replaced'
+        kept = None
+        for k in rec['kept']:
+            try:
+                kst = os.stat(os.fsencode(k))
+            except OSError:
+                continue
+            if stat.S_ISREG(kst.st_mode) and kst.st_size == rec['size'] and (kst.st_dev, kst.st_ino) != (st.st_dev, st.st_ino):
+                kept = os.fsencode(k)
+                break
+        if kept is None:
+            return 'no kept copy left'
+        if self.verify and not self._same_content(rec, path, kept, hasher):
+            return 'content differs'
+        rec['_kept'] = kept
+        return None
+
+    def _same_content(self, rec, path, kept, hasher):
+        digest = rec['digest']
+        if digest is None or digest.encode()[:1] == COMPARED_PREFIX or rec['algorithm'] != hasher.algorithm:
+            a, b = FNode(path, rec['size']), FNode(kept, rec['size'])
+            groups = compare_files([a, b], policy = self.policy)
+            for fn in (a, b):
+                if fn.error is not None:
+                    raise OSError(fn.error)
+            return len(groups) == 1
+        return hasher.digest(path) == digest.encode() and hasher.digest(kept) == digest.encode()
+
+    def apply(self, rec, hasher):
+        """Change the file of a checked plan record. Return the outcome
+        event. Raise OSError on failure."""
+        raise NotImplementedError
+
+    def _worker(self):
+        hasher = None
+        while True:
+            with self.lock:
+                if len(self.batches) == 0 and not self.planned:
+                    try:
+                        self._plan_batch()
+                    except (OSError, ValueError, SyntaxError) as err:
+                        #SyntaxError covers a malformed XML log
+                        self.error = err
+                        self.planned = True
+                if len(self.batches) == 0:
+                    break
+                items = self.batches.popleft()
+            if hasher is None:
+                algorithm = items[0][0]['algorithm']
+                hasher = Hasher(algorithm = algorithm if algorithm in HASHERS else DEFAULT_ALGORITHM,
+                                policy = self.policy)
+            out = []
+            for rec, fn in items:
+                try:
+                    reason = self.check(rec, hasher)
+                    if reason is not None:
+                        out.append((rec, fn, 'skipped', reason))
+                    else:
+                        out.append((rec, fn, self.apply(rec, hasher), None))
+                except FileNotFoundError:
+                    out.append((rec, fn, 'missing', None))
+                except OSError as err:
+                    out.append((rec, fn, 'failed', err.strerror or str(err)))
+            self.results.put(out)
+        with self.lock:
+            self.running -= 1
+            last = self.running == 0
+        if last:
+            self.results.put(None)
+
+    def _collector(self):
+        while True:
+            out = self.results.get()
+            if out is None:
+                self.journal.close()
+                return
+            lines = []
+            for rec, fn, event, reason in out:
+                line = {'event': event, 'path': rec['path']}
+                if reason is not None:
+                    line['reason'] = reason
+                lines.append(line)
+            with self.journal_lock:
+                self.journal.write(lines)
+            for rec, fn, event, reason in out:
+                self.counts[event] += 1
+                self.update(fn, event, rec)
+            self.done += len(out)
+
+    def update(self, fn, event, rec):
+        """Bring RepFile and FSTree up to date after the outcome event of a
+        file."""
+        raise NotImplementedError
+
+
+class Deleter(FileAction):
+    """Delete files, see FileAction. Deleted and missing files are removed
+    from RepFile and FSTree. An extra hard link of a deleted file takes
+    its place in its group."""
+    action = 'delete'
+
+    def apply(self, rec, hasher):
+        os.unlink(os.fsencode(rec['path']))
+        return 'deleted'
+
+    def update(self, fn, event, rec):
+        if event not in ('deleted', 'missing'):
+            return
+        if event == 'deleted' and not fn.links:
+            self.freed += fn.size
+        rep = fn.rep
+        if rep is not None:
+            rep.remove_fn(fn)
+        if fn.links:
+            #Another link of the inode keeps the data
+            primary = fn.links[0]
+            with aggr_lock:
+                for lk in fn.links:
+                    lk.link_of = None if lk is primary else primary
+                primary.links = fn.links[1:] or None
+                fn.links = None
+                if primary.branch is not None:
+                    primary.branch.add_aggr(AGGR_LINKS, -1)
+            if rep is not None and primary.md5 is not None:
+                rep.add_fn(primary)
+        if fn.link_of is not None:
+            fn.link_of.links.remove(fn)
+            if len(fn.link_of.links) == 0:
+                fn.link_of.links = None
+        if fn.branch is not None:
+            fn.branch.remove_leaf(fn)
+
+
+#ioctl sharing the extents of a file with another one (Btrfs, XFS...)
+FICLONE = 0x40049409
+#How Deduper replaces copies: clone the extents of the kept copy, make a
+#hard link to it, or clone when the file system supports it and link
+#otherwise
+DEDUPE_METHODS = ('auto', 'reflink', 'hardlink')
+#Errors of FICLONE meaning the file system can't share these extents
+_NO_REFLINK = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS)
+
+def _temp_path(dst):
+    """Unused name, next to dst, for the file that will replace it. A
+    temporary file left by an interrupted run is not in the way."""
+    head, tail = os.path.split(dst)
+    return os.path.join(head, b'.' + tail + b'.' + base64.b16encode(os.urandom(4)).lower() + b'.tucupi')
+
+def reflink(src, dst):
+    """Replace dst with a file sharing the extents of src, which must have
+    the same size. The clone is made under a temporary name, given the
+    owner, permissions and times of dst, and renamed over dst, so dst is
+    never missing and may be read-only. Raise OSError, with EOPNOTSUPP if
+    reflinks are not available."""
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, os.strerror(errno.EOPNOTSUPP))
+    st = os.lstat(dst)
+    tmp = _temp_path(dst)
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    try:
+        try:
+            with open(src, 'rb') as fsrc:
+                fcntl.ioctl(fd, FICLONE, fsrc.fileno())
+            tst = os.fstat(fd)
+            if (tst.st_uid, tst.st_gid) != (st.st_uid, st.st_gid):
+                os.fchown(fd, st.st_uid, st.st_gid)
+            os.fchmod(fd, stat.S_IMODE(st.st_mode))
+        finally:
+            os.close(fd)
+        os.utime(tmp, ns = (st.st_atime_ns, st.st_mtime_ns))
+        os.replace(tmp, dst)
+    except OSError:
+        os.unlink(tmp)
+        raise
+
+def hardlink(src, dst):
+    """Replace dst with a hard link to src. The link is made under a
+    temporary name and renamed over dst, so dst is never missing."""
+    tmp = _temp_path(dst)
+    os.link(src, tmp)
+    try:
+        os.replace(tmp, dst)
+    except OSError:
+        os.unlink(tmp)
+        raise
+
+
+class Deduper(FileAction):
+    """Replace files by a kept copy of the same data, see FileAction.
+    With reflinks the paths get a new inode, with the owner, permissions
+    and times of the old one, and only the storage is shared. Hard linked files become hard links of the kept copy in the
+    FSTree and leave their group. Contents are verified before linking
+    unless verify is False. Files with other hard links are skipped: they
+    would keep the old data."""
+    action = 'dedupe'
+
+    def __init__(self, fns, rep_files, fstree, journal_path, nworkers = DELETE_WORKERS,
+                 verify = True, batch = DELETE_BATCH, policy = None, method = 'auto'):
+        if method not in DEDUPE_METHODS:
+            raise ValueError('Unknown deduplication method {}'.format(method))
+        self.method = method
+        FileAction.__init__(self, fns, rep_files, fstree, journal_path, nworkers, verify, batch, policy)
+
+    def check(self, rec, hasher):
+        if os.lstat(os.fsencode(rec['path'])).st_nlink > 1:
+            return 'has other hard links'
+        return FileAction.check(self, rec, hasher)
+
+    def apply(self, rec, hasher):
+        path, kept = os.fsencode(rec['path']), rec['_kept']
+        if self.method != 'hardlink':
+            try:
+                reflink(kept, path)
+                rec['_ino'] = os.lstat(path).st_ino
+                return 'reflinked'
+            except OSError as err:
+                if self.method == 'reflink' or err.errno not in _NO_REFLINK:
+                    raise
+        hardlink(kept, path)
+        return 'hardlinked'
+
+    def _kept_fnode(self, fn, rec):
+        kept = rec['_kept']
+        for g in self.rep_files.copies(fn):
+            if g.fpath == kept:
+                return g
+        return None
+
+    def update(self, fn, event, rec):
+        if event == 'missing':
+            Deleter.update(self, fn, event, rec)
+            return
+        if event not in ('reflinked', 'hardlinked'):
+            return
+        self.freed += fn.size
+        if event == 'reflinked':
+            fn.ino = rec.get('_ino', fn.ino)
+        if event == 'reflinked' or fn.rep is None:
+            fn.marked = False
+            return
+        #Now another path of the kept copy
+        primary = self._kept_fnode(fn, rec)
+        fn.rep.remove_fn(fn)
+        if primary is not None:
+            primary.nlink = (primary.nlink or 1) + 1
+            fn.dev, fn.ino, fn.mtime, fn.nlink = primary.dev, primary.ino, primary.mtime, primary.nlink
+            primary.add_link(fn)
+
+
+#How Restorer recreates files: share the extents of the kept copy, copy
+#the data, or share when the file system supports it and copy otherwise
+RESTORE_METHODS = ('auto', 'reflink', 'copy')
+
+def read_log(fpath):
+    """Yield a 'restore' plan record (see plan_record) for every deleted
+    file of an XML log written by RepFile.to_xmlfile. The log is parsed
+    one group at a time."""
+    algorithm = DEFAULT_ALGORITHM
+    root = None
+    for event, elem in iterparse(fpath, events = ('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+                algorithm = elem.get('algorithm', DEFAULT_ALGORITHM)
+            continue
+        if elem.tag != 'file':
+            continue
+        digest = elem.get(algorithm)
+        kept = [os.fsdecode(xml_read_path(e)) for e in elem if e.tag == 'kept']
+        for e in elem:
+            if e.tag == 'deleted':
+                yield {'event': 'plan', 'action': 'restore', 'path': os.fsdecode(xml_read_path(e)),
+                       'size': int(elem.get('size')), 'mtime': None, 'dev': None, 'ino': None,
+                       'digest': digest, 'algorithm': algorithm, 'kept': kept}
+        root.clear()
+
+
+class Restorer(FileAction):
+    """Recreate the files deleted in an XML log from the copies kept, see
+    FileAction. A file is only recreated if its path is free. The copy
+    used must have the logged size and, with verify, the logged digest;
+    the new file is checked the same way before it is put in place, under
+    a temporary name. Files restored by an earlier run with the same
+    journal are not planned again. The log is read as the files are
+    restored, so total and total_bytes are only final once planned is
+    set."""
+    action = 'restore'
+    stream = True
+
+    def __init__(self, log_path, journal_path, nworkers = DELETE_WORKERS, verify = True,
+                 batch = DELETE_BATCH, policy = None, method = 'auto'):
+        if method not in RESTORE_METHODS:
+            raise ValueError('Unknown restore method {}'.format(method))
+        self.method = method
+        FileAction.__init__(self, read_log(log_path), None, None, journal_path, nworkers,
+                            verify, batch, policy)
+
+    def plan(self, recs):
+        return ((rec, None) for rec in recs if self.journal.finished.get(rec['path']) != 'restored')
+
+    def _check_copy(self, rec, fpath, hasher):
+        """Whether a file has the size, and digest, of the plan record."""
+        st = os.stat(fpath)
+        if not stat.S_ISREG(st.st_mode) or st.st_size != rec['size']:
+            return False
+        digest = rec['digest']
+        if not self.verify or digest is None or rec['algorithm'] != hasher.algorithm:
+            #Files compared byte by byte have no digest to check
+            return True
+        return hasher.digest(fpath) == digest.encode()
+
+    def check(self, rec, hasher):
+        if os.path.lexists(os.fsencode(rec['path'])):
+            return 'exists'
+        for k in rec['kept']:
+            try:
+                if self._check_copy(rec, os.fsencode(k), hasher):
+                    rec['_kept'] = os.fsencode(k)
+                    return None
+            except OSError:
+                continue
+        return 'no valid kept copy'
+
+    def apply(self, rec, hasher):
+        path, kept = os.fsencode(rec['path']), rec['_kept']
+        head, tail = os.path.split(path)
+        os.makedirs(head, exist_ok = True)
+        tmp = os.path.join(head, b'.' + tail + b'.tucupi')
+        try:
+            with open(tmp, 'wb'):
+                pass
+            copied = self.method == 'copy'
+            if not copied:
+                try:
+                    reflink(kept, tmp)
+                except OSError as err:
+                    if self.method == 'reflink' or err.errno not in _NO_REFLINK:
+                        raise
+                    copied = True
+            if copied:
+                with open(kept, 'rb') as fsrc, open(tmp, 'wb') as fdst:
+                    shutil.copyfileobj(fsrc, fdst, 1024*1024)
+                    fdst.flush()
+                    os.fsync(fdst.fileno())
+            shutil.copystat(kept, tmp)
+            if not self._check_copy(rec, tmp, hasher):
+                raise OSError(errno.EIO, 'Copy differs from the kept file')
+            #Fails if the path was taken in the meantime
+            os.link(tmp, path)
+        finally:
+            if os.path.lexists(tmp):
+                os.unlink(tmp)
+        return 'restored'
+
+    def update(self, fn, event, rec):
+        #No tree to update
+        pass